@@ -1,17 +1,37 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from datetime import timedelta
+from datetime import date, datetime, timedelta
+import asyncio
+import json
 import uuid
 import sqlite3
 
 
-from database import get_db, init_db
+from database import get_db, init_db, close_pool, pool
+from async_db import offload, run_db, run_hash, shutdown_executors
+from metrics import MetricsMiddleware, render as render_metrics
+from responses import FastJSONResponse, iso_datetime, trusted
+from http_cache import cached_read, response_cache, versions
 from models import *
 from auth import *
 from mqtt_handler import *
+from constraints import constraint_cache
+from telemetry import parse_resolution, start_retention_worker, stop_retention_worker
+from readings_cache import latest_readings
+from workers import election, migration_lock, multiprocess, state_path, stream_poller, SharedCounters, FOLLOWER_CACHE_TTL
+from workers import stats as worker_stats
+from streaming import stream_hub, HEARTBEAT_INTERVAL
+from notifications import fetch_notifications, unread_count, mark_read, MAX_MARK_READ
+from notifications import DEFAULT_PAGE_SIZE as NOTIFICATION_PAGE_SIZE, MAX_PAGE_SIZE as MAX_NOTIFICATION_PAGE_SIZE
+from excursions import excursion_aggregator, excursion_report, fetch_summaries
+from lifecycle import transition_shipments, MAX_TRANSITIONS, RECIPIENT_STATUSES
+from nfc import tag_index, TagAlreadyRegistered, MAX_BATCH_TAGS
+from shipments import fetch_shipments, create_shipments, shipment_filter, shipment_summary
+from shipments import InvalidCursor, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, MAX_BULK_SHIPMENTS
 
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -25,46 +45,95 @@ app.add_middleware(
         "Access-Control-Allow-Origin",
         "Access-Control-Allow-Methods",
         "Access-Control-Allow-Headers",
+        "If-None-Match",
     ],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
+app.add_middleware(MetricsMiddleware)
+
+def start_ingest():
+        """What only the ingest process runs, every process when there is only one."""
+        excursion_aggregator.start_catch_up()
+        start_retention_worker()
+        # Its streams are fed by ingest from now on
+        stream_poller.stop()
+        subscribe_mqtt()
 
 @app.on_event("startup")
 def startup_event():
-        init_db()
-        setup_mqtt()
-        
-@app.post("/api/register", response_model=UserResponse)
-def register(user: UserCreate):
+        with migration_lock():
+                init_db()
         conn = get_db()
+        latest_readings.warm(conn)
+        tag_index.load(conn)
+        token_cache.sync(conn)
+        conn.close()
+        if multiprocess():
+                counters = SharedCounters(state_path("versions"))
+                versions.share(counters)
+                token_cache.share(counters)
+                tag_index.start_sync()
+                latest_readings.ttl = min(latest_readings.ttl, FOLLOWER_CACHE_TTL)
+        setup_mqtt(subscribe=False)
+        if multiprocess():
+                election.start(start_ingest)
+                if not election.leader:
+                        stream_poller.start()
+        else:
+                start_ingest()
+
+@app.on_event("shutdown")
+def shutdown_event():
+        stream_poller.stop()
+        tag_index.stop_sync()
+        excursion_aggregator.stop_catch_up()
+        shutdown_mqtt()
+        stop_retention_worker()
+        # Only once readings still queued are written, so the next ingest process starts after them
+        election.stop()
+        shutdown_executors()
+        close_pool()
+        
+def user_exists(conn, user: UserCreate):
         cursor = conn.cursor()
-        
         cursor.execute("SELECT id FROM users WHERE username = ? OR email = ?",
                        (user.username, user.email))
-        if cursor.fetchone():
-                conn.close()
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username or email already registered")
+        return cursor.fetchone() is not None
+
+def insert_user(conn, user: UserCreate, hashed_password: str):
+        cursor = conn.cursor()
         
-        hashed_password = get_hashed_password(user.password)
-        cursor.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)", 
-                       (user.username, user.email, hashed_password, user.role))
+        try:
+                cursor.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)", 
+                               (user.username, user.email, hashed_password, user.role))
+        except sqlite3.IntegrityError:
+                # Registered by a concurrent request since user_exists ran
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username or email already registered")
         conn.commit()
         
         cursor.execute("SELECT id, username, email, role, created_at FROM users WHERE id = last_insert_rowid()")
         new_user = cursor.fetchone()
-        conn.close()
         
         return dict(new_user)
 
-@app.post("/api/login", response_model=Token)
-def login(form_data: OAuth2PasswordRequestForm = Depends()):
-        conn = get_db()
-        cursor = conn.cursor()
+@app.post("/api/register", response_model=UserResponse)
+async def register(user: UserCreate):
+        if await run_db(user_exists, user):
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username or email already registered")
         
-        cursor.execute("SELECT * FROM users WHERE username = ?", (form_data.username,))
-        user = cursor.fetchone()
-        conn.close()
+        hashed_password = await run_hash(get_hashed_password, user.password)
+        return await run_db(insert_user, user, hashed_password)
+
+def find_user(conn, username: str):
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
+        return cursor.fetchone()
+
+@app.post("/api/login", response_model=Token)
+async def login(form_data: OAuth2PasswordRequestForm = Depends()):
+        user = await run_db(find_user, form_data.username)
         
-        if not user or not verify_password(form_data.password, user["password"]):
+        if not user or not await run_hash(verify_password, form_data.password, user["password"]):
                 raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrent username or password")
         
         access_token_expires = timedelta(seconds=60 * 60 * 24)
@@ -73,10 +142,13 @@ def login(form_data: OAuth2PasswordRequestForm = Depends()):
         
         return {"access_token": access_token, "token_type": "bearer"}
 
+@app.post("/api/logout")
+async def logout(token: str = Depends(oauth2_scheme), current_user = Depends(get_current_user)):
+        await run_db(revoke_token, token)
+        return {"detail": "Logged out"}
+
 # For manufacturers only
-@app.post("/api/products", response_model=ProductResponse)
-def create_product(product: ProductCreate, current_user = Depends(get_current_manufacturer)):
-        conn = get_db()
+def insert_product(conn, product: ProductCreate, current_user):
         cursor = conn.cursor()
         
         product_code = f"PROD-{uuid.uuid4().hex[:8].upper()}"
@@ -91,27 +163,36 @@ def create_product(product: ProductCreate, current_user = Depends(get_current_ma
                 product.max_humidity, product.min_humidity
         ))
         conn.commit()
+        versions.bump("products", current_user.user_id)
         
         cursor.execute("SELECT * FROM products WHERE id = last_insert_rowid()")
         new_product = cursor.fetchone()
-        conn.close()
         
         return dict(new_product)
 
-@app.get("/api/products", response_model=list[ProductResponse])
-def get_products(current_user = Depends(get_current_manufacturer)):
-        conn = get_db()
+@app.post("/api/products", response_model=ProductResponse)
+async def create_product(product: ProductCreate, current_user = Depends(get_current_manufacturer)):
+        return await run_db(insert_product, product, current_user)
+
+def select_products(conn, manufacturer_id: int):
         cursor = conn.cursor()
         
-        cursor.execute("SELECT * FROM products WHERE manufacturer_id = ?", (current_user.user_id,))
+        cursor.execute("""
+                SELECT name, description, max_temperature, min_temperature, max_humidity, min_humidity,
+                        id, product_code, manufacturer_id, created_at
+                FROM products WHERE manufacturer_id = ?
+        """, (manufacturer_id,))
         products = cursor.fetchall()
-        conn.close()
         
-        return [dict(product) for product in products]
+        # Shaped like ProductResponse serializes it
+        return [{**product, "created_at": iso_datetime(product["created_at"])} for product in map(dict, products)]
 
-@app.post("/api/shipments", response_model=ShipmentResponse)
-def create_shipment(shipment: ShipmentCreate, current_user = Depends(get_current_manufacturer)):
-        conn = get_db()
+@app.get("/api/products", response_model=list[ProductResponse])
+async def get_products(request: Request, response: Response, current_user = Depends(get_current_manufacturer)):
+        return await cached_read(request, response, current_user.user_id, ("products",),
+                                 lambda: run_db(select_products, current_user.user_id))
+
+def insert_shipment(conn, shipment: ShipmentCreate, current_user):
         cursor = conn.cursor()
         
         shipment_code = f"SHIP-{uuid.uuid4().hex[:8].upper()}"
@@ -138,7 +219,6 @@ def create_shipment(shipment: ShipmentCreate, current_user = Depends(get_current
                 product_row = cursor.fetchone()
                 if not product_row:
                         conn.rollback()
-                        conn.close()
                         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Product with code {item.product_code} not found")
                 
                 product_id = product_row['id']
@@ -146,133 +226,222 @@ def create_shipment(shipment: ShipmentCreate, current_user = Depends(get_current
                 cursor.execute("INSERT INTO shipment_items (shipment_id, product_id, quantity) VALUES (?, ?, ?)", (shipment_id, product_id, item.quantity))
         
         conn.commit()
+        versions.bump_shipments(conn, [shipment_id])
+        constraint_cache.build(conn, shipment_id)
+        latest_readings.register(shipment_id, shipment_code)
         publish_mqqt_data("/REKSTI/shipment_code", {"shipment_id": shipment_id})
         result = get_shipment_by_code(shipment_code, conn)
-        conn.close()
         
         return result
 
+@app.post("/api/shipments", response_model=ShipmentResponse)
+async def create_shipment(shipment: ShipmentCreate, current_user = Depends(get_current_manufacturer)):
+        return await run_db(insert_shipment, shipment, current_user)
+
+def insert_shipments(conn, shipments: list, current_user):
+        results, ids = create_shipments(conn, shipments, current_user.user_id)
+        
+        created = {}
+        versions.bump_shipments(conn, ids.values())
+        for shipment_code, shipment_id in ids.items():
+                constraint_cache.invalidate(shipment_id)
+                latest_readings.register(shipment_id, shipment_code)
+        if ids:
+                publish_mqqt_batch("/REKSTI/shipment_code", [{"shipment_id": shipment_id} for shipment_id in ids.values()])
+                created, _ = fetch_shipments(conn, f"id IN ({','.join('?' * len(ids))})", tuple(ids.values()))
+                created = {shipment["shipment_code"]: shipment for shipment in created}
+        
+        for result in results:
+                shipment_code = result.pop("shipment_code")
+                result["shipment"] = created[shipment_code] if shipment_code else None
+        
+        return {"created": len(ids), "failed": len(results) - len(ids), "results": results}
+
+@app.post("/api/shipments/bulk", response_model=BulkShipmentResponse)
+async def create_shipments_bulk(shipments: list[ShipmentCreate], current_user = Depends(get_current_manufacturer)):
+        if len(shipments) > MAX_BULK_SHIPMENTS:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                    detail=f"At most {MAX_BULK_SHIPMENTS} shipments per request")
+        return await run_db(insert_shipments, shipments, current_user)
+
 def get_shipment_by_code(shipment_code, conn=None):
         close_conn = False
         if conn is None:
                 conn = get_db()
                 close_conn = True
         
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM shipments WHERE shipment_code = ?", (shipment_code,))
-        shipment = cursor.fetchone()
+        shipments, _ = fetch_shipments(conn, "shipment_code = ?", (shipment_code,))
         
-        if not shipment:
-                if close_conn:
-                        conn.close()
+        if close_conn:
+                conn.close()
+        
+        if not shipments:
                 raise HTTPException(
                         status_code=status.HTTP_404_NOT_FOUND,
                         detail=f"Shipment with code {shipment_code} not found"
                         )
         
-        cursor.execute("""
-                SELECT si.id, si.product_id, p.name as product_name, si.quantity, si.constraints_violated
-                FROM shipment_items si
-                JOIN products p ON si.product_id = p.id
-                WHERE si.shipment_id = ?
-        """, (shipment['id'],))
-        
-        items = []
-        for item in cursor.fetchall():
-                items.append({
-                "product_id": item["product_id"],
-                "product_name": item["product_name"],
-                "quantity": item["quantity"],
-                "constraints_violated": bool(item["constraints_violated"])
-                })
-        
-        result = dict(shipment)
-        result["items"] = items
-        
-        if close_conn:
-                conn.close()
-        
-        return result
+        return shipments[0]
 
-@app.get("/api/shipments/recent", response_model=list[ShipmentResponse])
-def get_recent_shipments(current_user = Depends(get_current_manufacturer)):
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-                SELECT shipment_code FROM shipments 
-                WHERE manufacturer_id = ? AND (status != 'delivered' OR created_at >= datetime('now', '-30 day'))
-                ORDER BY created_at DESC LIMIT 10
-        """, (current_user.user_id,))
-        
-        shipment_codes = [row['shipment_code'] for row in cursor.fetchall()]
-        shipments = []
-        
-        for code in shipment_codes:
-                shipments.append(get_shipment_by_code(code, conn))
-        
-        conn.close()
+def list_shipments_page(conn, response: Response, where, params, order_by="created_at", limit=None, cursor=None):
+        try:
+                shipments, next_cursor = fetch_shipments(conn, where, params, order_by=order_by, limit=limit, cursor=cursor)
+        except InvalidCursor:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+        
+        if next_cursor:
+                response.headers["X-Next-Cursor"] = next_cursor
         return shipments
 
+@app.get("/api/shipments/recent", response_model=list[ShipmentResponse])
+async def get_recent_shipments(request: Request, response: Response, current_user = Depends(get_current_manufacturer)):
+        # The 30 day window moves without any write, so the ETag changes daily too
+        return await cached_read(request, response, current_user.user_id, ("shipments",), lambda: run_db(
+                list_shipments_page,
+                response,
+                "manufacturer_id = ? AND (status != 'delivered' OR created_at >= datetime('now', '-30 day'))",
+                (current_user.user_id,),
+                limit=10
+        ), variant=datetime.utcnow().strftime("-%Y%m%d"))
+
 @app.get("/api/shipments", response_model=list[ShipmentResponse])
-def get_all_shipments(current_user = Depends(get_current_manufacturer)):
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-                SELECT shipment_code FROM shipments 
-                WHERE manufacturer_id = ?
-                ORDER BY created_at DESC
-        """, (current_user.user_id,))
-        
-        shipment_codes = [row['shipment_code'] for row in cursor.fetchall()]
-        shipments = []
-        
-        for code in shipment_codes:
-                try:
-                        shipments.append(get_shipment_by_code(code, conn))
-                except HTTPException:
-                        continue
-        
-        conn.close()
-        return shipments
+async def get_all_shipments(request: Request, response: Response,
+                            limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                            cursor: Optional[str] = None,
+                            current_user = Depends(get_current_manufacturer)):
+        if cursor is not None and limit is None:
+                limit = DEFAULT_PAGE_SIZE
+        return await cached_read(request, response, current_user.user_id, ("shipments",), lambda: run_db(
+                list_shipments_page, response, "manufacturer_id = ?", (current_user.user_id,), limit=limit, cursor=cursor))
+
+def shipment_filters(status: Optional[List[Literal["prepared", "shipped", "delivered"]]] = Query(None),
+                     shipped_from: Optional[date] = None,
+                     shipped_to: Optional[date] = None,
+                     violated: Optional[bool] = None,
+                     product_code: Optional[str] = None,
+                     recipient: Optional[str] = None,
+                     q: Optional[str] = Query(None, max_length=200)):
+        return {"status": status, "shipped_from": shipped_from, "shipped_to": shipped_to, "violated": violated,
+                "product_code": product_code, "recipient": recipient, "search": q}
+
+def user_filter(current_user, filters: dict):
+        user_column = "manufacturer_id" if current_user.role == "manufacturer" else "recipient_id"
+        return shipment_filter(user_column, current_user.user_id, **filters)
+
+# Filtered the same way for both roles, manufacturers see what they send and recipients what they receive
+@app.get("/api/shipments/search", response_model=list[ShipmentResponse])
+async def search_shipments(request: Request, response: Response,
+                           limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                           cursor: Optional[str] = None,
+                           order_by: Optional[Literal["created_at", "shipping_date"]] = None,
+                           filters: dict = Depends(shipment_filters),
+                           current_user = Depends(get_current_user)):
+        where, params = user_filter(current_user, filters)
+        order_by = order_by or ("created_at" if current_user.role == "manufacturer" else "shipping_date")
+        return await cached_read(request, response, current_user.user_id, ("shipments",), lambda: run_db(
+                list_shipments_page, response, where, params, order_by=order_by, limit=limit, cursor=cursor))
+
+@app.get("/api/shipments/summary", response_model=ShipmentSummary)
+async def summarize_shipments(request: Request, response: Response,
+                              filters: dict = Depends(shipment_filters),
+                              current_user = Depends(get_current_user)):
+        where, params = user_filter(current_user, filters)
+        return await cached_read(request, response, current_user.user_id, ("shipments",),
+                                 lambda: run_db(shipment_summary, where, params))
 
 # For both usrers
-@app.get("/api/shipments/{shipment_code}", response_model=ShipmentResponse)
-def get_shipment(shipment_code: str, current_user = Depends(get_current_user)):
-        conn = get_db()
+def authorize_shipment(conn, shipment_code: str, current_user):
         cursor = conn.cursor()
         
         cursor.execute("SELECT id FROM shipments WHERE shipment_code = ? AND (manufacturer_id = ? OR recipient_id = ?)", 
                        (shipment_code, current_user.user_id, current_user.user_id))
         
         if not cursor.fetchone():
-                conn.close()
                 raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
-        
-        result = get_shipment_by_code(shipment_code, conn)
-        conn.close()
-        return result
 
-@app.post("/api/verify-nfc", response_model=NFCTagResponse)
-def verify_nfc_tag(tag_data: NFCTagVerification, current_user = Depends(get_current_user)):
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-                SELECT nt.*, p.name as product_name, u.username as manufacturer_name, s.shipment_code
-                FROM nfc_tags nt
-                JOIN products p ON nt.product_id = p.id
-                JOIN users u ON p.manufacturer_id = u.id
-                JOIN shipment_items si ON nt.shipment_item_id = si.id
-                JOIN shipments s ON si.shipment_id = s.id
-                WHERE nt.tag_id = ?
-        """, (tag_data.tag_id,))
-        
-        tag_info = cursor.fetchone()
-        conn.close()
-        
-        if not tag_info:
+def select_shipment(conn, shipment_code: str):
+        return get_shipment_by_code(shipment_code, conn)
+
+@app.get("/api/shipments/{shipment_code}", response_model=ShipmentResponse)
+async def get_shipment(shipment_code: str, request: Request, response: Response, current_user = Depends(get_current_user)):
+        # Checked before the ETag, which says nothing about which shipment it was issued for
+        return await cached_read(request, response, current_user.user_id, ("shipments",),
+                                 lambda: run_db(select_shipment, shipment_code),
+                                 authorize=lambda: run_db(authorize_shipment, shipment_code, current_user))
+
+def change_shipment_status(conn, shipment_codes: list, update: ShipmentStatusUpdate, current_user):
+        if current_user.role != "manufacturer" and update.status not in RECIPIENT_STATUSES:
+                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Recipients can only mark shipments delivered")
+        
+        results, ids = transition_shipments(conn, shipment_codes, update.status, current_user.user_id,
+                                            current_user.role, update.delivery_date)
+        versions.bump_shipments(conn, ids.values())
+        if update.status == "delivered":
+                for shipment_id in ids.values():
+                        latest_readings.evict(shipment_id)
+        return results
+
+def update_shipment_status(conn, shipment_code: str, update: ShipmentStatusUpdate, current_user):
+        result = change_shipment_status(conn, [shipment_code], update, current_user)[0]
+        if result["status"] is None:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=result["error"])
+        if result["error"]:
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=result["error"])
+        return get_shipment_by_code(shipment_code, conn)
+
+@app.post("/api/shipments/{shipment_code}/status", response_model=ShipmentResponse)
+async def set_shipment_status(shipment_code: str, update: ShipmentStatusUpdate, current_user = Depends(get_current_user)):
+        return await run_db(update_shipment_status, shipment_code, update, current_user)
+
+def update_shipment_statuses(conn, update: BulkShipmentStatusUpdate, current_user):
+        results = change_shipment_status(conn, update.shipment_codes, update, current_user)
+        failed = sum(1 for result in results if result["error"])
+        return {"updated": len(results) - failed, "failed": failed, "results": results}
+
+@app.post("/api/shipments/status/bulk", response_model=BulkShipmentStatusResponse)
+async def set_shipment_statuses(update: BulkShipmentStatusUpdate, current_user = Depends(get_current_user)):
+        if len(update.shipment_codes) > MAX_TRANSITIONS:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                    detail=f"At most {MAX_TRANSITIONS} shipments per request")
+        return await run_db(update_shipment_statuses, update, current_user)
+
+def select_excursions(conn, shipment_code: str, current_user):
+        row = conn.execute("SELECT id FROM shipments WHERE shipment_code = ? AND (manufacturer_id = ? OR recipient_id = ?)",
+                           (shipment_code, current_user.user_id, current_user.user_id)).fetchone()
+        if row is None:
+                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
+        return excursion_report(conn, row["id"], shipment_code)
+
+@app.get("/api/shipments/{shipment_code}/excursions", response_model=ShipmentExcursions)
+async def get_shipment_excursions(shipment_code: str, current_user = Depends(get_current_user)):
+        return await run_db(select_excursions, shipment_code, current_user)
+
+def list_excursions_page(conn, response: Response, current_user, limit, cursor=None, shipment_codes=None):
+        user_column = "manufacturer_id" if current_user.role == "manufacturer" else "recipient_id"
+        try:
+                summaries, next_cursor = fetch_summaries(conn, user_column, current_user.user_id, limit, cursor,
+                                                         shipment_codes)
+        except InvalidCursor:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+        if next_cursor:
+                response.headers["X-Next-Cursor"] = next_cursor
+        return summaries
+
+# A listing screen passes the shipment codes of the page it shows
+@app.get("/api/excursions", response_model=list[ExcursionSummary])
+async def get_excursions(response: Response,
+                         limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                         cursor: Optional[str] = None,
+                         shipment_code: Optional[List[str]] = Query(None),
+                         current_user = Depends(get_current_user)):
+        if shipment_code and len(shipment_code) > MAX_PAGE_SIZE:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                    detail=f"At most {MAX_PAGE_SIZE} shipment codes per request")
+        return await run_db(list_excursions_page, response, current_user, limit, cursor, shipment_code)
+
+def tag_response(details) -> dict:
+        if details is None:
                 return {
                         "is_authentic": False,
                         "product_name": None,
@@ -280,63 +449,106 @@ def verify_nfc_tag(tag_data: NFCTagVerification, current_user = Depends(get_curr
                         "shipment_code": None
                 }
         
+        product_name, manufacturer, shipment_code = details
         return {
                 "is_authentic": True,
-                "product_name": tag_info["product_name"],
-                "manufacturer": tag_info["manufacturer_name"],
-                "shipment_code": tag_info["shipment_code"]
+                "product_name": product_name,
+                "manufacturer": manufacturer,
+                "shipment_code": shipment_code
         }
+
+def lookup_nfc_tag(conn, tag_data: NFCTagVerification):
+        details = tag_index.verify(conn, [tag_data.tag_id])[tag_data.tag_id]
+        return tag_response(details)
+
+@app.post("/api/verify-nfc", response_model=NFCTagResponse)
+async def verify_nfc_tag(tag_data: NFCTagVerification, current_user = Depends(get_current_user)):
+        return await run_db(lookup_nfc_tag, tag_data)
+
+def lookup_nfc_tags(conn, tag_ids: list):
+        found = tag_index.verify(conn, tag_ids)
+        return [dict(tag_response(found[tag_id]), tag_id=tag_id) for tag_id in tag_ids]
+
+@app.post("/api/verify-nfc/batch", response_model=list[NFCTagBatchResult])
+async def verify_nfc_tags(batch: NFCTagBatchVerification, current_user = Depends(get_current_user)):
+        if len(batch.tag_ids) > MAX_BATCH_TAGS:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                    detail=f"At most {MAX_BATCH_TAGS} tags per request")
+        return await run_db(lookup_nfc_tags, batch.tag_ids)
+
+def receive_nfc_tags(conn, tag_ids: list, current_user):
+        tags = lookup_nfc_tags(conn, tag_ids)
+        shipment_codes = list(dict.fromkeys(tag["shipment_code"] for tag in tags if tag["is_authentic"]))
+        shipments = change_shipment_status(conn, shipment_codes, ShipmentStatusUpdate(status="delivered"), current_user)
+        return {"tags": tags, "shipments": shipments}
+
+# Scanning the tags of a delivery marks every shipment they belong to as delivered
+@app.post("/api/verify-nfc/receive", response_model=NFCReceiveResponse)
+async def receive_nfc(batch: NFCTagBatchVerification, current_user = Depends(get_current_recipient)):
+        if len(batch.tag_ids) > MAX_BATCH_TAGS:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                    detail=f"At most {MAX_BATCH_TAGS} tags per request")
+        return await run_db(receive_nfc_tags, batch.tag_ids, current_user)
+
+def insert_nfc_tags(conn, shipment_code: str, registration: NFCTagRegistration, current_user):
+        item = conn.execute("""
+                SELECT si.id FROM shipment_items si
+                JOIN shipments s ON si.shipment_id = s.id
+                WHERE s.shipment_code = ? AND s.manufacturer_id = ? AND si.product_id = ?
+                ORDER BY si.id LIMIT 1
+        """, (shipment_code, current_user.user_id, registration.product_id)).fetchone()
+        if not item:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Shipment item not found")
+        
+        try:
+                registered = tag_index.register(conn, item["id"], registration.product_id, registration.tag_ids)
+        except TagAlreadyRegistered as e:
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Tags already registered: {', '.join(e.args[0])}")
+        except sqlite3.IntegrityError:
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Tags already registered")
+        
+        return {"shipment_code": shipment_code, "product_id": registration.product_id, "registered": registered}
+
+@app.post("/api/shipments/{shipment_code}/tags", response_model=NFCTagRegistrationResponse)
+async def register_nfc_tags(shipment_code: str, registration: NFCTagRegistration, current_user = Depends(get_current_manufacturer)):
+        if len(registration.tag_ids) > MAX_BATCH_TAGS:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                    detail=f"At most {MAX_BATCH_TAGS} tags per request")
+        return await run_db(insert_nfc_tags, shipment_code, registration, current_user)
+
+@app.get("/api/nfc/stats")
+async def get_nfc_stats(current_user = Depends(get_current_manufacturer)):
+        return tag_index.stats()
         
 # For recipients only
 @app.get("/api/orders", response_model=list[ShipmentResponse])
-def get_order_history(current_user = Depends(get_current_recipient)):
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-                SELECT shipment_code FROM shipments 
-                WHERE recipient_id = ?
-                ORDER BY shipping_date DESC
-        """, (current_user.user_id,))
-        
-        shipment_codes = [row['shipment_code'] for row in cursor.fetchall()]
-        orders = []
-        
-        for code in shipment_codes:
-                try:
-                        orders.append(get_shipment_by_code(code, conn))
-                except HTTPException:
-                        continue
-                
-        conn.close()
-        return orders
+async def get_order_history(request: Request, response: Response,
+                            limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                            cursor: Optional[str] = None,
+                            current_user = Depends(get_current_recipient)):
+        if cursor is not None and limit is None:
+                limit = DEFAULT_PAGE_SIZE
+        return await cached_read(request, response, current_user.user_id, ("shipments",), lambda: run_db(
+                list_shipments_page, response, "recipient_id = ?", (current_user.user_id,),
+                order_by="shipping_date", limit=limit, cursor=cursor))
 
 @app.get("/api/orders/{date}", response_model=list[ShipmentResponse])
-def get_orders_by_date(date: str, current_user = Depends(get_current_recipient)):
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-                SELECT shipment_code FROM shipments 
-                WHERE recipient_id = ? AND date(shipping_date) = date(?)
-                ORDER BY shipping_date DESC
-        """, (current_user.user_id, date))
-        
-        shipment_codes = [row['shipment_code'] for row in cursor.fetchall()]
-        orders = []
-        
-        for code in shipment_codes:
-                try:
-                        orders.append(get_shipment_by_code(code, conn))
-                except HTTPException:
-                        continue
-        
-        conn.close()
-        return orders
+async def get_orders_by_date(date: str, request: Request, response: Response,
+                             limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                             cursor: Optional[str] = None,
+                             current_user = Depends(get_current_recipient)):
+        if cursor is not None and limit is None:
+                limit = DEFAULT_PAGE_SIZE
+        try:
+                day = datetime.strptime(date, "%Y-%m-%d").date()
+        except ValueError:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Date must be YYYY-MM-DD")
+        # A range on the stored column rather than date(shipping_date), so the recipient index applies
+        where, params = shipment_filter("recipient_id", current_user.user_id, shipped_from=day, shipped_to=day)
+        return await cached_read(request, response, current_user.user_id, ("shipments",), lambda: run_db(
+                list_shipments_page, response, where, params, order_by="shipping_date", limit=limit, cursor=cursor))
 
-@app.post("/api/notifications", response_model=NotificationResponse)
-def create_notification(notification: NotificationCreate, current_user = Depends(get_current_user)):
-        conn = get_db()
+def insert_notification(conn, notification: NotificationCreate, current_user):
         cursor = conn.cursor()
         
         cursor.execute("SELECT id, manufacturer_id, recipient_id FROM shipments WHERE shipment_code = ?", 
@@ -344,17 +556,14 @@ def create_notification(notification: NotificationCreate, current_user = Depends
         shipment = cursor.fetchone()
         
         if not shipment:
-                conn.close()
                 raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
         
         if current_user.role == 'manufacturer' and shipment['manufacturer_id'] != current_user.user_id:
-                conn.close()
                 raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
         
         if current_user.role == 'manufacturer':
                 user_id = shipment['recipient_id']
                 if not user_id:
-                        conn.close()
                         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
         
         else:
@@ -363,47 +572,180 @@ def create_notification(notification: NotificationCreate, current_user = Depends
         cursor.execute("""
                 INSERT INTO notifications (user_id, shipment_id, message, read)
                 VALUES (?, ?, ?, 0)
+                RETURNING id, user_id, shipment_id, message, read, created_at
         """, (user_id, shipment['id'], notification.message))
+        notification_data = dict(cursor.fetchone())
         
         conn.commit()
+        versions.bump("notifications", user_id)
         
-        cursor.execute("""
-                SELECT n.id, n.user_id, n.shipment_id, n.message, n.read, n.created_at, s.shipment_code
-                FROM notifications n
-                JOIN shipments s ON n.shipment_id = s.id
-                WHERE n.id = last_insert_rowid()
-        """)
-        
-        notification_data = cursor.fetchone()
-        conn.close()
-        
-        return dict(notification_data)  
+        notification_data["read"] = bool(notification_data["read"])
+        notification_data["shipment_code"] = notification.shipment_code
+        return notification_data
 
-@app.get("/api/notifications", response_model=list[NotificationResponse])
-def get_notifications(current_user = Depends(get_current_user)):
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-                SELECT n.id, n.user_id, n.shipment_id, n.message, n.read, n.created_at, s.shipment_code
-                FROM notifications n
-                JOIN shipments s ON n.shipment_id = s.id
-                WHERE n.user_id = ?
-                ORDER BY n.created_at DESC
-        """, (current_user.user_id,))
-        
-        notifications = []
-        for row in cursor.fetchall():
-                notification_dict = dict(row)
-                notification_dict["read"] = bool(notification_dict["read"])
-                notifications.append(notification_dict)
-        conn.close()
-        
+@app.post("/api/notifications", response_model=NotificationResponse)
+async def create_notification(notification: NotificationCreate, current_user = Depends(get_current_user)):
+        return await run_db(insert_notification, notification, current_user)
+
+def list_notifications_page(conn, response: Response, user_id: int, limit=None, cursor=None, unread_only=False):
+        try:
+                notifications, next_cursor = fetch_notifications(conn, user_id, limit, cursor, unread_only)
+        except InvalidCursor:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+        if next_cursor:
+                response.headers["X-Next-Cursor"] = next_cursor
         return notifications
 
+@app.get("/api/notifications", response_model=list[NotificationResponse])
+async def get_notifications(request: Request, response: Response,
+                            limit: Optional[int] = Query(None, ge=1, le=MAX_NOTIFICATION_PAGE_SIZE),
+                            cursor: Optional[str] = None,
+                            unread: bool = False,
+                            current_user = Depends(get_current_user)):
+        if cursor is not None and limit is None:
+                limit = NOTIFICATION_PAGE_SIZE
+        return await cached_read(request, response, current_user.user_id, ("notifications",), lambda: run_db(
+                list_notifications_page, response, current_user.user_id, limit=limit, cursor=cursor, unread_only=unread))
+
+@app.get("/api/notifications/unread-count", response_model=UnreadCountResponse)
+async def get_unread_count(request: Request, response: Response, current_user = Depends(get_current_user)):
+        async def count():
+                return {"unread": await run_db(unread_count, current_user.user_id)}
+        return await cached_read(request, response, current_user.user_id, ("notifications",), count)
+
+def mark_notifications_read(conn, user_id: int, notification_ids):
+        if mark_read(conn, user_id, notification_ids):
+                versions.bump("notifications", user_id)
+        return {"unread": unread_count(conn, user_id)}
+
+@app.post("/api/notifications/read", response_model=UnreadCountResponse)
+async def read_notifications(body: NotificationMarkRead, current_user = Depends(get_current_user)):
+        if body.ids is not None and len(body.ids) > MAX_MARK_READ:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                    detail=f"At most {MAX_MARK_READ} notifications per request")
+        if body.ids == []:
+                return {"unread": await run_db(unread_count, current_user.user_id)}
+        return await run_db(mark_notifications_read, current_user.user_id, body.ids)
+
+@app.get("/api/db/stats")
+async def get_db_stats(current_user = Depends(get_current_manufacturer)):
+        return pool.stats()
+
+@app.get("/api/cache/stats")
+async def get_cache_stats(current_user = Depends(get_current_manufacturer)):
+        return {**latest_readings.stats(), "responses": response_cache.stats()}
+
+@app.get("/api/ingest/stats")
+async def get_ingest_stats(current_user = Depends(get_current_manufacturer)):
+        return {**ingest_writer.stats(), "workers": worker_stats()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+        return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/temperature")
+async def get_fleet_temperature(current_user = Depends(get_current_manufacturer)):
+        return await offload(get_temp, manufacturer_id=current_user.user_id)
+
 @app.get("/api/temperature/{shipment_code}")
-def get_temperature(shipment_code: str):
-    temp = get_temp(shipment_code)
+async def get_temperature(shipment_code: str,
+                          start: Optional[datetime] = Query(None, alias="from"),
+                          end: Optional[datetime] = Query(None, alias="to"),
+                          resolution: Optional[str] = None,
+                          limit: int = Query(1, ge=1, le=10000)):
+    try:
+        resolution_seconds = parse_resolution(resolution)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid resolution {resolution}")
+    if (start or end or resolution) and limit == 1:
+        limit = 1000
+    temp = await offload(get_temp, shipment_code, limit, start, end, resolution_seconds)
     if temp:
         return temp
-    return {"error": "No temperature data received yet"}
\ No newline at end of file
+    return {"error": "No temperature data received yet"}
+
+def authorize_stream(conn, shipment_code: str, user_id: int):
+        shipment = conn.execute("""
+                SELECT id, constraints_violated FROM shipments
+                WHERE shipment_code = ? AND (manufacturer_id = ? OR recipient_id = ?)
+        """, (shipment_code, user_id, user_id)).fetchone()
+        
+        if not shipment:
+                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
+        
+        # Same connection as the check above, a second pooled one could starve the executor
+        snapshot = latest_readings.get(conn, shipment_code)
+        if snapshot:
+                snapshot = dict(snapshot, type="reading")
+        return shipment["id"], bool(shipment["constraints_violated"]), snapshot
+
+async def stream_user(shipment_code: str, ticket: Optional[str], authorization: Optional[str] = None) -> int:
+        if ticket:
+                return decode_stream_ticket(ticket, shipment_code)
+        if authorization and authorization.lower().startswith("bearer "):
+                return (await get_current_user(authorization[7:])).user_id
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate")
+
+# EventSource and WebSocket clients cannot set headers. They first get a ticket with their token,
+# and pass that as ?ticket=, so the token itself never ends up in a URL
+@app.post("/api/stream/temperature/{shipment_code}/ticket")
+async def stream_ticket(shipment_code: str, current_user: TokenData = Depends(get_current_user)):
+        await run_db(authorize_stream, shipment_code, current_user.user_id)
+        return {"ticket": create_stream_ticket(current_user, shipment_code), "expires_in": STREAM_TICKET_EXPIRE}
+
+@app.get("/api/stream/temperature/{shipment_code}")
+async def stream_temperature(shipment_code: str, request: Request, ticket: Optional[str] = None,
+                             authorization: Optional[str] = Header(None)):
+        user_id = await stream_user(shipment_code, ticket, authorization)
+        shipment_id, violated, snapshot = await run_db(authorize_stream, shipment_code, user_id)
+        subscription = stream_hub.subscribe(shipment_id, shipment_code, violated)
+        
+        async def events():
+                try:
+                        if snapshot:
+                                yield f"event: reading\ndata: {json.dumps(snapshot)}\n\n"
+                        while not await request.is_disconnected():
+                                messages = await subscription.next(HEARTBEAT_INTERVAL)
+                                if not messages:
+                                        yield ": keep-alive\n\n"
+                                for message in messages:
+                                        yield f"event: {message['type']}\ndata: {json.dumps(message)}\n\n"
+                finally:
+                        stream_hub.unsubscribe(subscription)
+        
+        return StreamingResponse(events(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.websocket("/api/ws/temperature/{shipment_code}")
+async def temperature_socket(websocket: WebSocket, shipment_code: str, ticket: Optional[str] = None):
+        try:
+                user_id = await stream_user(shipment_code, ticket)
+                shipment_id, violated, snapshot = await run_db(authorize_stream, shipment_code, user_id)
+        except HTTPException:
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                return
+        
+        await websocket.accept()
+        subscription = stream_hub.subscribe(shipment_id, shipment_code, violated)
+        receive = asyncio.ensure_future(websocket.receive())
+        try:
+                if snapshot:
+                        await websocket.send_json(snapshot)
+                while True:
+                        pending = asyncio.ensure_future(subscription.next())
+                        done, _ = await asyncio.wait({receive, pending}, return_when=asyncio.FIRST_COMPLETED)
+                        if pending in done:
+                                for message in pending.result():
+                                        await websocket.send_json(message)
+                        else:
+                                pending.cancel()
+                        if receive in done:
+                                # Clients only ever send to close the socket
+                                if receive.result()["type"] == "websocket.disconnect":
+                                        break
+                                receive = asyncio.ensure_future(websocket.receive())
+        except WebSocketDisconnect:
+                pass
+        finally:
+                receive.cancel()
+                stream_hub.unsubscribe(subscription)
@@ -0,0 +1,43 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from database import get_db, POOL_SIZE
+from metrics import timed
+
+# One worker per pooled connection, so a worker never waits on the pool
+DB_WORKERS = POOL_SIZE
+# bcrypt is CPU bound and deliberately slow, cap how many run at once
+HASH_WORKERS = 2
+
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="bcrypt")
+
+async def offload(fn, *args, **kwargs):
+        """Run a blocking database call on the database executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(db_executor, functools.partial(timed()(fn), *args, **kwargs))
+
+async def run_db(fn, *args, **kwargs):
+        """
+        Run fn(conn, *args, **kwargs) on the database executor with a pooled
+        connection that is returned to the pool afterwards.
+        """
+        @timed(fn.__name__)
+        def call():
+                conn = get_db()
+                try:
+                        return fn(conn, *args, **kwargs)
+                finally:
+                        conn.close()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(db_executor, call)
+
+async def run_hash(fn, *args):
+        """Run a password hash or verification on the bounded hash executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(hash_executor, functools.partial(fn, *args))
+
+def shutdown_executors():
+        db_executor.shutdown(wait=True)
+        hash_executor.shutdown(wait=True)
@@ -1,15 +1,26 @@
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional
+import hashlib
+import threading
+import time
 import jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
+from async_db import run_db
 from database import get_db
 from models import TokenData
 
 SECRET_KEY = "YOUR_SECRET_KEY"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE = 60 * 60 * 24
+# Stream tickets travel in URLs, so they are only good for opening one shipment's stream shortly after
+STREAM_TICKET_EXPIRE = 60
+# Verified tokens kept in memory
+TOKEN_CACHE_SIZE = 4096
+# Shared counter bumped on every revocation when several workers run
+REVOCATIONS = "revocations"
 
 pwd_context = CryptContext(schemes=["bcrypt"])
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/login")
@@ -26,30 +37,162 @@ def create_token(data: dict, expires_delta: Optional[timedelta] = None):
                 expire = datetime.utcnow() + expires_delta
         else:
                 expire = datetime.utcnow() + timedelta(seconds=ACCESS_TOKEN_EXPIRE)
-        to_encode.update({"exp": expire})
+        # Float, so two logins in the same second get different tokens and logging out one keeps the other
+        to_encode.update({"exp": expire, "iat": time.time()})
         encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
         return encoded_jwt
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+class TokenCache:
+        """
+        Verified tokens keyed by their SHA-256, each kept until the token's exp.
+        Revoked tokens are remembered until they would have expired, and stored in
+        revoked_tokens so a restart does not forget them.
+        """
+        def __init__(self, max_entries: int = TOKEN_CACHE_SIZE):
+                self.max_entries = max_entries
+                self._entries = OrderedDict()
+                self._revoked = {}
+                self._shared = None
+                self._generation = None
+                self._lock = threading.Lock()
+                self.hits = 0
+                self.misses = 0
+
+        def share(self, counters):
+                """Learn of revocations by other workers through a workers.SharedCounters."""
+                self._shared = counters
+                self._generation = None
+
+        def stale(self) -> bool:
+                """Whether another worker revoked a token since the last sync."""
+                return self._shared is not None and self._shared.get(REVOCATIONS) != self._generation
+
+        def sync(self, conn):
+                """Load the stored revocations, at startup and whenever another worker revoked a token."""
+                # Read first, a revocation stored meanwhile makes the next request sync again
+                generation = self._shared.get(REVOCATIONS) if self._shared is not None else None
+                rows = conn.execute("SELECT token_hash, expires_at FROM revoked_tokens WHERE expires_at > ?",
+                                    (time.time(),)).fetchall()
+                with self._lock:
+                        for key, expires_at in rows:
+                                self._entries.pop(key, None)
+                                self._revoked[key] = expires_at
+                        self._generation = generation
+
+        def publish(self, conn, key: bytes, expires_at: float):
+                """Store a revocation, so it outlives a restart and the other workers learn of it."""
+                conn.execute("DELETE FROM revoked_tokens WHERE expires_at <= ?", (time.time(),))
+                conn.execute("INSERT OR REPLACE INTO revoked_tokens (token_hash, expires_at) VALUES (?, ?)", (key, expires_at))
+                conn.commit()
+                if self._shared is not None:
+                        self._shared.increment(REVOCATIONS)
+
+        def get(self, key: bytes) -> Optional[TokenData]:
+                with self._lock:
+                        entry = self._entries.get(key)
+                        if entry is not None and entry[1] <= time.time():
+                                del self._entries[key]
+                                entry = None
+                        if entry is None:
+                                self.misses += 1
+                                return None
+                        self.hits += 1
+                        self._entries.move_to_end(key)
+                        return entry[0]
+
+        def put(self, key: bytes, token_data: TokenData, expires_at: float) -> bool:
+                """Cache a freshly verified token, returns False if it has been revoked."""
+                with self._lock:
+                        if key in self._revoked:
+                                return False
+                        self._entries[key] = (token_data, expires_at)
+                        self._entries.move_to_end(key)
+                        while len(self._entries) > self.max_entries:
+                                self._entries.popitem(last=False)
+                        return True
+
+        def revoke(self, key: bytes, expires_at: float):
+                with self._lock:
+                        self._entries.pop(key, None)
+                        self._revoked[key] = expires_at
+                        now = time.time()
+                        for revoked, until in list(self._revoked.items()):
+                                if until <= now:
+                                        del self._revoked[revoked]
+
+        def clear(self):
+                with self._lock:
+                        self._entries.clear()
+
+        def stats(self) -> dict:
+                with self._lock:
+                        return {
+                                "size": len(self._entries),
+                                "capacity": self.max_entries,
+                                "hits": self.hits,
+                                "misses": self.misses,
+                                "revoked_tokens": len(self._revoked)
+                        }
+
+token_cache = TokenCache()
+
+def token_key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+def decode_token(token: str) -> TokenData:
+        key = token_key(token)
+        token_data = token_cache.get(key)
+        if token_data is not None:
+                return token_data
+        
         exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate")
         try:
                 payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
                 username: str = payload.get("sub")
                 user_id: int = payload.get("user_id")
                 role: str = payload.get("role")
-                if username is None or user_id is None:
+                if username is None or user_id is None or "purpose" in payload:
                         raise exception
                 token_data = TokenData(username=username, user_id=user_id, role=role)
         except jwt.PyJWTError:
                 raise exception
+        if not token_cache.put(key, token_data, payload["exp"]):
+                raise exception
         return token_data
 
-def get_current_manufacturer(current_user: TokenData = Depends(get_current_user)):
+def create_stream_ticket(current_user: TokenData, shipment_code: str) -> str:
+        return create_token({"purpose": "stream", "user_id": current_user.user_id, "shipment_code": shipment_code},
+                            timedelta(seconds=STREAM_TICKET_EXPIRE))
+
+def decode_stream_ticket(ticket: str, shipment_code: str) -> int:
+        """The id of the user a ticket for this shipment's stream was issued to."""
+        exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate")
+        try:
+                payload = jwt.decode(ticket, SECRET_KEY, algorithms=[ALGORITHM])
+        except jwt.PyJWTError:
+                raise exception
+        if payload.get("purpose") != "stream" or payload.get("shipment_code") != shipment_code:
+                raise exception
+        return payload["user_id"]
+
+def revoke_token(conn, token: str):
+        """Reject a token from now on, e.g. on logout, in every worker and after a restart."""
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"verify_exp": False})
+        key = token_key(token)
+        token_cache.revoke(key, payload["exp"])
+        token_cache.publish(conn, key, payload["exp"])
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+        if token_cache.stale():
+                await run_db(token_cache.sync)
+        return decode_token(token)
+
+async def get_current_manufacturer(current_user: TokenData = Depends(get_current_user)):
         if current_user.role != "manufacturer":
                 raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Unauthorized")
         return current_user
 
-def get_current_recipient(current_user: TokenData = Depends(get_current_user)):
+async def get_current_recipient(current_user: TokenData = Depends(get_current_user)):
         if current_user.role != "recipient":
                 raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Unauthorized")
         return current_user
\ No newline at end of file
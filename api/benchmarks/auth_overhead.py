@@ -0,0 +1,44 @@
+"""
+Per request cost of resolving the current user from a bearer token, with
+and without the verified token cache:
+
+        python benchmarks/auth_overhead.py --requests 100000
+"""
+import argparse
+import asyncio
+import time
+from datetime import timedelta
+
+import common  # noqa: F401  (puts the api modules on the path)
+
+from auth import create_token, get_current_manufacturer, get_current_user, token_cache
+
+async def resolve(token):
+        return await get_current_manufacturer(await get_current_user(token))
+
+async def run(tokens, requests, cached):
+        started = time.perf_counter()
+        for i in range(requests):
+                if not cached:
+                        token_cache.clear()
+                await resolve(tokens[i % len(tokens)])
+        return (time.perf_counter() - started) / requests
+
+async def main(args):
+        # A handful of polling clients, each reusing its own token
+        tokens = [create_token({"sub": f"user{i}", "user_id": i, "role": "manufacturer"},
+                               expires_delta=timedelta(hours=1))
+                  for i in range(args.clients)]
+
+        uncached = await run(tokens, args.requests, cached=False)
+        cached = await run(tokens, args.requests, cached=True)
+        print(f"{args.requests} requests over {args.clients} tokens")
+        print(f"uncached: {uncached * 1e6:7.2f} us/request")
+        print(f"  cached: {cached * 1e6:7.2f} us/request ({uncached / cached:.1f}x)")
+        print(token_cache.stats())
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--requests", type=int, default=100000)
+        parser.add_argument("--clients", type=int, default=20)
+        asyncio.run(main(parser.parse_args()))
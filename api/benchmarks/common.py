@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+
+# Benchmarks import the api modules the same way app.py does
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if API_DIR not in sys.path:
+        sys.path.insert(0, API_DIR)
+
+def percentile(ordered: list, fraction: float) -> float:
+        if not ordered:
+                return 0.0
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def summarize(latencies: list, elapsed: float, errors: int = 0) -> dict:
+        """Throughput and latency percentiles, latencies in seconds, reported in milliseconds."""
+        ordered = sorted(latencies)
+        return {
+                "requests": len(ordered),
+                "errors": errors,
+                "throughput": len(ordered) / elapsed if elapsed else 0.0,
+                "mean_ms": sum(ordered) / len(ordered) * 1000 if ordered else 0.0,
+                "p50_ms": percentile(ordered, 0.50) * 1000,
+                "p95_ms": percentile(ordered, 0.95) * 1000,
+                "p99_ms": percentile(ordered, 0.99) * 1000
+        }
+
+def format_summary(name: str, summary: dict) -> str:
+        return (f"{name:<36} {summary['throughput']:9.1f}/s  p50 {summary['p50_ms']:8.2f} ms  "
+                f"p95 {summary['p95_ms']:8.2f} ms  p99 {summary['p99_ms']:8.2f} ms  errors {summary['errors']}")
+
+def git_commit() -> str:
+        try:
+                return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=API_DIR, capture_output=True,
+                                      text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+                return "unknown"
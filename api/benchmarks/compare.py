@@ -0,0 +1,55 @@
+"""
+Compare two benchmark results saved by run.py:
+
+        python benchmarks/compare.py results/before.json results/after.json --threshold 10
+
+Exits with status 1 when any throughput dropped, or p95 latency grew, by more
+than the threshold percentage.
+"""
+import argparse
+import json
+import sys
+
+def change(before: float, after: float) -> float:
+        return (after - before) / before * 100 if before else 0.0
+
+def compare(before: dict, after: dict, threshold: float) -> list:
+        rows = []
+        for name, old in before.get("endpoints", {}).items():
+                new = after.get("endpoints", {}).get(name)
+                if new is not None:
+                        rows.append((name, old, new))
+        if "ingest" in before and "ingest" in after:
+                rows.append(("ingest on_message", before["ingest"], after["ingest"]))
+
+        regressions = []
+        for name, old, new in rows:
+                throughput = change(old["throughput"], new["throughput"])
+                p95 = change(old["p95_ms"], new["p95_ms"])
+                regressed = throughput < -threshold or p95 > threshold
+                if regressed:
+                        regressions.append(name)
+                print(f"{'!' if regressed else ' '} {name:<36} {old['throughput']:9.1f} -> {new['throughput']:9.1f}/s "
+                      f"({throughput:+6.1f}%)  p95 {old['p95_ms']:8.2f} -> {new['p95_ms']:8.2f} ms ({p95:+6.1f}%)")
+        if "ingest" in before and "ingest" in after:
+                old, new = before["ingest"]["persisted_per_second"], after["ingest"]["persisted_per_second"]
+                persisted = change(old, new)
+                if persisted < -threshold:
+                        regressions.append("ingest persisted")
+                print(f"{'!' if persisted < -threshold else ' '} {'ingest persisted':<36} {old:9.1f} -> {new:9.1f}/s ({persisted:+6.1f}%)")
+        return regressions
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser()
+        parser.add_argument("before")
+        parser.add_argument("after")
+        parser.add_argument("--threshold", type=float, default=10.0, help="percent change counted as a regression")
+        args = parser.parse_args()
+
+        with open(args.before) as f:
+                before = json.load(f)
+        with open(args.after) as f:
+                after = json.load(f)
+        print(f"{before.get('commit')} -> {after.get('commit')}")
+        regressions = compare(before, after, args.threshold)
+        sys.exit(1 if regressions else 0)
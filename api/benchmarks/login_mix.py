@@ -0,0 +1,88 @@
+"""
+Throughput under a burst of logins mixed with authenticated reads.
+
+Runs the app in process against a throwaway database, so no server, broker
+or existing data is needed:
+
+        python benchmarks/login_mix.py --clients 50 --duration 10 --login-ratio 0.2
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from common import format_summary, summarize
+
+import httpx
+
+import database
+
+async def seed(client, shipments):
+        for username, role in (("bench_manufacturer", "manufacturer"), ("bench_recipient", "recipient")):
+                await client.post("/api/register", json={
+                        "username": username, "email": f"{username}@example.com",
+                        "password": "bench", "role": role
+                })
+        token = await login(client, "bench_manufacturer")
+        headers = {"Authorization": f"Bearer {token}"}
+        product = (await client.post("/api/products", headers=headers, json={
+                "name": "bench", "max_temperature": 8, "min_temperature": 2,
+                "max_humidity": 60, "min_humidity": 30
+        })).json()
+        for _ in range(shipments):
+                await client.post("/api/shipments", headers=headers, json={
+                        "shipping_date": "2025-01-01", "recipient_name": "bench_recipient",
+                        "recipient_address": "bench", "recipient_phone": "0",
+                        "items": [{"product_code": product["product_code"], "quantity": 1}]
+                })
+        return headers
+
+async def login(client, username):
+        response = await client.post("/api/login", data={"username": username, "password": "bench"})
+        return response.json()["access_token"]
+
+async def worker(client, headers, deadline, login_ratio, results):
+        while time.perf_counter() < deadline:
+                is_login = random.random() < login_ratio
+                started = time.perf_counter()
+                if is_login:
+                        response = await client.post("/api/login", data={"username": "bench_recipient", "password": "bench"})
+                else:
+                        response = await client.get("/api/shipments", headers=headers, params={"limit": 20})
+                elapsed = time.perf_counter() - started
+                results["login" if is_login else "read"].append(elapsed)
+                if response.status_code != 200:
+                        results["errors"] += 1
+
+async def main(args):
+        from app import app
+
+        database.init_db()
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                headers = await seed(client, args.shipments)
+                results = {"login": [], "read": [], "errors": 0}
+                started = time.perf_counter()
+                deadline = started + args.duration
+                await asyncio.gather(*(worker(client, headers, deadline, args.login_ratio, results)
+                                       for _ in range(args.clients)))
+                elapsed = time.perf_counter() - started
+
+        print(f"{args.clients} clients, {args.duration}s, {args.login_ratio:.0%} logins")
+        print(format_summary("login", summarize(results["login"], elapsed)))
+        print(format_summary("read", summarize(results["read"], elapsed)))
+        print(f"errors: {results['errors']}")
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--clients", type=int, default=50)
+        parser.add_argument("--duration", type=float, default=10)
+        parser.add_argument("--login-ratio", type=float, default=0.2)
+        parser.add_argument("--shipments", type=int, default=200)
+        args = parser.parse_args()
+
+        with tempfile.TemporaryDirectory() as directory:
+                database.DATABASE = os.path.join(directory, "bench.db")
+                asyncio.run(main(args))
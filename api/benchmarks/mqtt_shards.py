@@ -0,0 +1,86 @@
+"""
+How readings published to per shipment topics are split between API workers,
+through the in process broker, so no network or external broker is needed:
+
+        python benchmarks/mqtt_shards.py --workers 4 --messages 20000
+
+"shared" subscribes every worker under one $share group, the broker hands each
+message to one of them. "sharded" delivers everything to every worker and each
+one keeps the shipments mqtt_handler.shard_of assigns to it.
+"""
+import argparse
+import threading
+import time
+
+import common  # noqa: F401  (puts the api modules on the path)
+
+import paho.mqtt.client as mqqt
+
+from mqtt_broker import LocalBroker
+from mqtt_handler import DATA_TOPIC, shard_of
+
+def connect(port: int, client_id: str, on_message=None):
+        connected = threading.Event()
+        client = mqqt.Client(client_id=client_id, callback_api_version=mqqt.CallbackAPIVersion.VERSION2)
+        client.on_connect = lambda *args: connected.set()
+        client.on_message = on_message
+        client.connect("127.0.0.1", port)
+        client.loop_start()
+        connected.wait(5)
+        return client
+
+def run(mode: str, port: int, workers: int, messages: int, shipments: int) -> dict:
+        received = [0] * workers
+        owned = [0] * workers
+        lock = threading.Lock()
+
+        def handler(index):
+                def on_message(client, userdata, msg):
+                        shipment_id = int(msg.topic.rsplit("/", 1)[1])
+                        with lock:
+                                received[index] += 1
+                                if mode == "shared" or shard_of(shipment_id, workers) == index:
+                                        owned[index] += 1
+                return on_message
+
+        topic = f"{DATA_TOPIC}/+"
+        if mode == "shared":
+                topic = f"$share/bench/{topic}"
+        clients = []
+        for index in range(workers):
+                client = connect(port, f"{mode}-worker-{index}", handler(index))
+                subscribed = threading.Event()
+                client.on_subscribe = lambda *args, done=subscribed: done.set()
+                client.subscribe(topic)
+                subscribed.wait(5)
+                clients.append(client)
+
+        publisher = connect(port, f"{mode}-publisher")
+        started = time.perf_counter()
+        for i in range(messages):
+                publisher.publish(f"{DATA_TOPIC}/{i % shipments + 1}", b'{"temperature": 5.0, "humidity": 50.0}')
+        while sum(owned) < messages and time.perf_counter() - started < 60:
+                time.sleep(0.01)
+        elapsed = time.perf_counter() - started
+
+        for client in clients + [publisher]:
+                client.loop_stop()
+                client.disconnect()
+        return {"elapsed": elapsed, "received": received, "owned": owned}
+
+def main(args):
+        broker = LocalBroker(port=0)
+        broker.start()
+        for mode in ("shared", "sharded"):
+                result = run(mode, broker.port, args.workers, args.messages, args.shipments)
+                print(f"{mode:<8} {sum(result['owned']) / result['elapsed']:9.1f} readings/s  "
+                      f"persisted per worker {result['owned']}  delivered per worker {result['received']}")
+        print(broker.stats())
+        broker.stop()
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--messages", type=int, default=20000)
+        parser.add_argument("--shipments", type=int, default=500)
+        main(parser.parse_args())
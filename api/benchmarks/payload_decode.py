@@ -0,0 +1,65 @@
+"""
+Decode throughput of binary frames against the JSON payloads devices send today:
+
+        python benchmarks/payload_decode.py --payloads 100000 --batch 60
+
+"decode" is the parsing on_message does before a reading is queued: json.loads,
+picking out the fields and formatting the timestamp, or frames.decode_frame. A
+batch of JSON readings is a list of the single reading objects.
+"""
+import argparse
+import json
+import random
+import time
+
+import common  # noqa: F401  (puts the api modules on the path)
+
+from frames import decode_frame, encode_frame, format_epoch
+
+def json_single(payload: bytes):
+        data = json.loads(payload.decode("utf-8"))
+        return data["shipment_id"], [(data.get("temperature", 0), data.get("humidity", 0), format_epoch(data["timestamp"]))]
+
+def json_batch(payload: bytes):
+        data = json.loads(payload.decode("utf-8"))
+        return data[0]["shipment_id"], [(item.get("temperature", 0), item.get("humidity", 0), format_epoch(item["timestamp"]))
+                                        for item in data]
+
+def measure(decode, payloads: list, readings_per_payload: int) -> dict:
+        started = time.perf_counter()
+        for payload in payloads:
+                decode(payload)
+        elapsed = time.perf_counter() - started
+        return {"payloads_per_second": len(payloads) / elapsed,
+                "readings_per_second": len(payloads) * readings_per_payload / elapsed,
+                "bytes_per_reading": sum(map(len, payloads)) / (len(payloads) * readings_per_payload)}
+
+def main(args):
+        rng = random.Random(0)
+        now = int(time.time())
+
+        def readings(count):
+                return [(round(rng.uniform(-20, 30), 2), round(rng.uniform(20, 90), 2), now - i * 60) for i in range(count)]
+
+        def as_json(shipment_id, batch):
+                items = [{"shipment_id": shipment_id, "temperature": t, "humidity": h, "timestamp": ts} for t, h, ts in batch]
+                return json.dumps(items if len(items) > 1 else items[0]).encode("utf-8")
+
+        singles = [(rng.randrange(1, 10 ** 6), readings(1)) for _ in range(args.payloads)]
+        batches = [(rng.randrange(1, 10 ** 6), readings(args.batch)) for _ in range(max(1, args.payloads // args.batch))]
+        cases = [
+                ("json single", json_single, [as_json(s, r) for s, r in singles], 1),
+                ("frame single", decode_frame, [encode_frame(s, r) for s, r in singles], 1),
+                (f"json batch of {args.batch}", json_batch, [as_json(s, r) for s, r in batches], args.batch),
+                (f"frame batch of {args.batch}", decode_frame, [encode_frame(s, r) for s, r in batches], args.batch),
+        ]
+        for name, decode, payloads, per_payload in cases:
+                result = measure(decode, payloads, per_payload)
+                print(f"{name:<20} {result['payloads_per_second']:11.1f} payloads/s  "
+                      f"{result['readings_per_second']:11.1f} readings/s  {result['bytes_per_reading']:6.1f} bytes/reading")
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--payloads", type=int, default=100000)
+        parser.add_argument("--batch", type=int, default=60, help="readings per batched payload")
+        main(parser.parse_args())
@@ -0,0 +1,257 @@
+"""
+Throughput and latency of every endpoint and of MQTT ingest, against a seeded
+database (see seed.py). The app runs in process, no server or broker is used.
+
+        python benchmarks/run.py --database benchmarks/bench.db --requests 500 --concurrency 20
+
+The seeded database is copied first, so writes made by one run never leak into
+the next. Results are printed and saved as JSON, compare two runs with compare.py.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from common import API_DIR, format_summary, git_commit, summarize
+
+import httpx
+
+import database
+
+RESULTS_DIR = os.path.join(API_DIR, "benchmarks", "results")
+
+class Fixtures:
+        """Ids sampled from the seeded database that requests are built from."""
+        def __init__(self, conn, rng: random.Random, sample: int = 1000):
+                from auth import create_token
+
+                self.rng = rng
+                self.shipments = conn.execute("""
+                        SELECT shipment_code, manufacturer_id, recipient_id FROM shipments
+                        ORDER BY random() LIMIT ?
+                """, (sample,)).fetchall()
+                self.active = conn.execute("""
+                        SELECT s.id, s.shipment_code, s.manufacturer_id FROM latest_temperature lt
+                        JOIN shipments s ON s.id = lt.shipment_id
+                        ORDER BY random() LIMIT ?
+                """, (sample,)).fetchall()
+                self.products = conn.execute("SELECT product_code, manufacturer_id FROM products ORDER BY random() LIMIT ?",
+                                             (sample,)).fetchall()
+                self.tags = [row[0] for row in conn.execute("SELECT tag_id FROM nfc_tags ORDER BY random() LIMIT ?", (sample,))]
+                self.recipients = conn.execute("SELECT id, username FROM users WHERE role = 'recipient' ORDER BY random() LIMIT ?",
+                                               (sample,)).fetchall()
+                users = conn.execute("SELECT id, username, role FROM users").fetchall()
+                self.tokens = {row[0]: create_token({"sub": row[1], "user_id": row[0], "role": row[2]},
+                                                    expires_delta=timedelta(hours=1)) for row in users}
+
+        def headers(self, user_id) -> dict:
+                return {"Authorization": f"Bearer {self.tokens[user_id]}"}
+
+        def pick(self, rows):
+                return self.rng.choice(rows)
+
+def scenarios(f: Fixtures) -> dict:
+        """Endpoint name to a function returning (method, url, request kwargs)."""
+        def shipment_owner():
+                code, manufacturer_id, _ = f.pick(f.shipments)
+                return code, f.headers(manufacturer_id)
+
+        def recipient():
+                recipient_id = f.pick([row for row in f.shipments if row[2] is not None])[2]
+                return f.headers(recipient_id)
+
+        def history():
+                _, code, manufacturer_id = f.pick(f.active)
+                end = datetime.utcnow()
+                return ("GET", f"/api/temperature/{code}", {"headers": f.headers(manufacturer_id), "params": {
+                        "from": (end - timedelta(hours=6)).isoformat(), "to": end.isoformat(), "resolution": "5m"}})
+
+        def revalidate():
+                # What a dashboard refresh sends once it holds the current page
+                from http_cache import versions
+                _, manufacturer_id, _ = f.pick(f.shipments)
+                headers = {**f.headers(manufacturer_id), "If-None-Match": versions.etag(manufacturer_id, ("shipments",))}
+                return ("GET", "/api/shipments", {"headers": headers, "params": {"limit": 50}})
+
+        def new_shipment():
+                product_code, manufacturer_id = f.pick(f.products)
+                _, recipient_name = f.pick(f.recipients)
+                return ("POST", "/api/shipments", {"headers": f.headers(manufacturer_id), "json": {
+                        "shipping_date": "2025-01-01", "recipient_name": recipient_name, "recipient_address": "bench",
+                        "recipient_phone": "0", "items": [{"product_code": product_code, "quantity": 1}]}})
+
+        return {
+                "GET /api/shipments?limit=50": lambda: (
+                        "GET", "/api/shipments", {"headers": shipment_owner()[1], "params": {"limit": 50}}),
+                "GET /api/shipments?limit=50 If-None-Match": revalidate,
+                "GET /api/shipments/recent": lambda: (
+                        "GET", "/api/shipments/recent", {"headers": shipment_owner()[1]}),
+                "GET /api/shipments/{code}": lambda: (
+                        lambda code, headers: ("GET", f"/api/shipments/{code}", {"headers": headers}))(*shipment_owner()),
+                "GET /api/products": lambda: (
+                        "GET", "/api/products", {"headers": shipment_owner()[1]}),
+                "GET /api/orders?limit=50": lambda: (
+                        "GET", "/api/orders", {"headers": recipient(), "params": {"limit": 50}}),
+                "GET /api/temperature/{code}": lambda: (
+                        lambda row: ("GET", f"/api/temperature/{row[1]}", {"headers": f.headers(row[2])}))(f.pick(f.active)),
+                "GET /api/temperature/{code} history": history,
+                "GET /api/temperature": lambda: (
+                        "GET", "/api/temperature", {"headers": f.headers(f.pick(f.active)[2])}),
+                "GET /api/notifications?limit=50": lambda: (
+                        "GET", "/api/notifications", {"headers": recipient(), "params": {"limit": 50}}),
+                "GET /api/notifications/unread-count": lambda: (
+                        "GET", "/api/notifications/unread-count", {"headers": recipient()}),
+                "POST /api/verify-nfc": lambda: (
+                        "POST", "/api/verify-nfc", {"headers": recipient(), "json": {
+                                "tag_id": f.pick(f.tags) if f.rng.random() < 0.8 else f"FAKE-{f.rng.randrange(10 ** 9)}"}}),
+                "POST /api/verify-nfc/batch": lambda: (
+                        "POST", "/api/verify-nfc/batch", {"headers": recipient(), "json": {
+                                "tag_ids": f.rng.sample(f.tags, min(100, len(f.tags)))}}),
+                "POST /api/shipments": new_shipment,
+                "POST /api/login": lambda: (
+                        "POST", "/api/login", {"data": {"username": f.pick(f.recipients)[1], "password": "bench"}}),
+        }
+
+async def run_endpoint(client, build, requests: int, concurrency: int) -> dict:
+        latencies = []
+        errors = 0
+        remaining = requests
+
+        async def worker():
+                nonlocal remaining, errors
+                while remaining > 0:
+                        remaining -= 1
+                        method, url, kwargs = build()
+                        started = time.perf_counter()
+                        response = await client.request(method, url, **kwargs)
+                        latencies.append(time.perf_counter() - started)
+                        if response.status_code >= 400:
+                                errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return summarize(latencies, time.perf_counter() - started, errors)
+
+async def run_endpoints(fixtures: Fixtures, requests: int, concurrency: int, only=None) -> dict:
+        from app import app
+
+        results = {}
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+                for name, build in scenarios(fixtures).items():
+                        if only and not any(term in name for term in only):
+                                continue
+                        # bcrypt is deliberately slow, a handful of logins is enough for a stable number
+                        count = max(concurrency, requests // 10) if name == "POST /api/login" else requests
+                        results[name] = await run_endpoint(client, build, count, concurrency)
+                        print(format_summary(name, results[name]))
+        return results
+
+def run_ingest(fixtures: Fixtures, messages: int, publishers: int) -> dict:
+        """Feed synthetic MQTT payloads to on_message and wait for the writer to persist them."""
+        import mqtt_handler
+
+        class Message:
+                def __init__(self, payload: bytes):
+                        self.topic = mqtt_handler.DATA_TOPIC
+                        self.payload = payload
+
+        shipment_ids = [row[0] for row in fixtures.active]
+        writer = mqtt_handler.ingest_writer
+        writer.start()
+        baseline = writer.written + writer.unknown + writer.duplicates + writer.failed + writer.queue.dropped + writer.queue.coalesced
+        latencies = [[] for _ in range(publishers)]
+
+        def publish(index: int):
+                rng = random.Random(index)
+                for _ in range(messages // publishers):
+                        payload = json.dumps({"shipment_id": rng.choice(shipment_ids),
+                                              "temperature": round(rng.uniform(0, 10), 2),
+                                              "humidity": round(rng.uniform(30, 60), 1)}).encode("utf-8")
+                        started = time.perf_counter()
+                        mqtt_handler.on_message(None, None, Message(payload))
+                        latencies[index].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=publish, args=(i,)) for i in range(publishers)]
+        for thread in threads:
+                thread.start()
+        for thread in threads:
+                thread.join()
+        published = time.perf_counter() - started
+
+        total = (messages // publishers) * publishers
+        while writer.written + writer.unknown + writer.duplicates + writer.failed + writer.queue.dropped + writer.queue.coalesced - baseline < total:
+                time.sleep(0.01)
+        persisted = time.perf_counter() - started
+        writer.stop()
+
+        result = summarize([value for values in latencies for value in values], published)
+        result["persisted_per_second"] = total / persisted
+        result["writer"] = writer.stats()
+        print(format_summary("on_message", result))
+        print(f"{'ingest persisted':<36} {result['persisted_per_second']:9.1f}/s")
+        return result
+
+def main(args):
+        rng = random.Random(args.seed)
+        with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "bench.db")
+                shutil.copy(args.database, path)
+                database.DATABASE = path
+                database.init_db()
+
+                conn = database.connect()
+                fixtures = Fixtures(conn, rng)
+                from excursions import excursion_aggregator
+                from nfc import tag_index
+                from readings_cache import latest_readings
+                latest_readings.warm(conn)
+                tag_index.load(conn)
+                excursion_aggregator.catch_up(conn)
+                counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                          for table in ("users", "products", "shipments", "temperature_logs", "notifications", "nfc_tags")}
+                conn.close()
+
+                report = {
+                        "commit": git_commit(),
+                        "started_at": datetime.utcnow().isoformat(timespec="seconds"),
+                        "python": platform.python_version(),
+                        "sqlite": sqlite3.sqlite_version,
+                        "config": {"requests": args.requests, "concurrency": args.concurrency,
+                                   "ingest_messages": args.ingest_messages, "publishers": args.publishers},
+                        "dataset": counts,
+                        "endpoints": asyncio.run(run_endpoints(fixtures, args.requests, args.concurrency, args.only)),
+                }
+                if args.ingest_messages:
+                        report["ingest"] = run_ingest(fixtures, args.ingest_messages, args.publishers)
+                database.close_pool()
+
+        output = args.output or os.path.join(RESULTS_DIR, f"{report['started_at'].replace(':', '')}-{report['commit']}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w") as f:
+                json.dump(report, f, indent=2)
+        print(f"Saved {output}")
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--database", default=os.path.join(API_DIR, "benchmarks", "bench.db"))
+        parser.add_argument("--requests", type=int, default=500, help="requests per endpoint")
+        parser.add_argument("--concurrency", type=int, default=20)
+        parser.add_argument("--ingest-messages", type=int, default=50000, help="0 skips the ingest benchmark")
+        parser.add_argument("--publishers", type=int, default=4, help="threads calling on_message")
+        parser.add_argument("--only", nargs="*", help="run endpoints whose name contains any of these")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output")
+        args = parser.parse_args()
+        if not os.path.exists(args.database):
+                parser.error(f"{args.database} does not exist, create it with benchmarks/seed.py")
+        main(args)
@@ -0,0 +1,161 @@
+"""
+Fill a fresh database with realistic volumes for the benchmarks:
+
+        python benchmarks/seed.py --database benchmarks/bench.db --shipments 100000 --readings 2000000
+
+Every user's password is "bench". The same --seed always produces the same data.
+"""
+import argparse
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+import common  # noqa: F401  (puts the api modules on the path)
+
+import database
+from auth import get_hashed_password
+
+PASSWORD = "bench"
+STATUSES = ("prepared", "shipped", "delivered")
+# Readings are spaced this far apart, newest ending now, all inside the raw retention window
+READING_INTERVAL = timedelta(minutes=5)
+
+def _timestamp(value: datetime) -> str:
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+
+def seed(path: str, manufacturers: int = 200, recipients: int = 2000, products: int = 5000,
+         shipments: int = 100000, active: int = 5000, readings: int = 2000000, tags: int = 50000,
+         notifications: int = 100000, random_seed: int = 0) -> dict:
+        rng = random.Random(random_seed)
+        now = datetime.utcnow().replace(microsecond=0)
+        database.DATABASE = path
+        database.init_db()
+        conn = database.connect()
+        counts = {}
+
+        password = get_hashed_password(PASSWORD)
+        conn.executemany("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)", [
+                (f"manufacturer{i}", f"manufacturer{i}@example.com", password, "manufacturer") for i in range(manufacturers)
+        ] + [
+                (f"recipient{i}", f"recipient{i}@example.com", password, "recipient") for i in range(recipients)
+        ])
+        manufacturer_ids = [row[0] for row in conn.execute("SELECT id FROM users WHERE role = 'manufacturer'")]
+        recipient_ids = [(row[0], row[1]) for row in conn.execute("SELECT id, username FROM users WHERE role = 'recipient'")]
+        counts["users"] = manufacturers + recipients
+
+        product_rows = []
+        for i in range(products):
+                low = rng.choice((-20, 2, 15))
+                product_rows.append((f"PROD-{i:08X}", rng.choice(manufacturer_ids), f"Product {i}", None,
+                                     low + rng.choice((6, 10)), low, rng.choice((60, 80)), rng.choice((20, 30))))
+        conn.executemany("""
+                INSERT INTO products (product_code, manufacturer_id, name, description,
+                max_temperature, min_temperature, max_humidity, min_humidity)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, product_rows)
+        products_by_manufacturer = {}
+        for product_id, manufacturer_id in conn.execute("SELECT id, manufacturer_id FROM products"):
+                products_by_manufacturer.setdefault(manufacturer_id, []).append(product_id)
+        counts["products"] = products
+
+        owners = list(products_by_manufacturer)
+        shipment_rows = []
+        for i in range(shipments):
+                created = now - timedelta(seconds=rng.randrange(365 * 24 * 3600))
+                # The first `active` shipments are in transit, the rest mostly delivered
+                status = "shipped" if i < active else rng.choices(STATUSES, (1, 1, 18))[0]
+                recipient_id, recipient_name = rng.choice(recipient_ids)
+                shipment_rows.append((
+                        f"SHIP-{i:08X}", rng.choice(owners), recipient_id, recipient_name,
+                        f"{rng.randrange(1, 999)} Bench Street", f"08{rng.randrange(10 ** 9):09d}",
+                        (created + timedelta(days=1)).date().isoformat(), status, _timestamp(created)
+                ))
+        conn.executemany("""
+                INSERT INTO shipments (shipment_code, manufacturer_id, recipient_id, recipient_name, recipient_address,
+                recipient_phone, shipping_date, status, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, shipment_rows)
+        shipment_ids = conn.execute("SELECT id, manufacturer_id, recipient_id FROM shipments ORDER BY id").fetchall()
+        counts["shipments"] = shipments
+
+        item_rows = []
+        for shipment_id, manufacturer_id, _ in shipment_ids:
+                for product_id in rng.sample(products_by_manufacturer[manufacturer_id],
+                                             min(rng.randint(1, 3), len(products_by_manufacturer[manufacturer_id]))):
+                        item_rows.append((shipment_id, product_id, rng.randint(1, 100)))
+        conn.executemany("INSERT INTO shipment_items (shipment_id, product_id, quantity) VALUES (?, ?, ?)", item_rows)
+        counts["shipment_items"] = len(item_rows)
+
+        conn.execute("""
+                INSERT INTO nfc_tags (tag_id, product_id, shipment_item_id)
+                SELECT printf('TAG-%08X', id), product_id, id FROM shipment_items ORDER BY id LIMIT ?
+        """, (tags,))
+        counts["nfc_tags"] = min(tags, len(item_rows))
+
+        active_ids = [row[0] for row in shipment_ids[:active]]
+        per_shipment = max(1, readings // max(1, len(active_ids)))
+
+        def reading_rows():
+                for shipment_id in active_ids:
+                        base = rng.uniform(2, 8)
+                        for step in range(per_shipment):
+                                yield (shipment_id, round(base + rng.gauss(0, 1.5), 2), round(rng.uniform(30, 60), 1),
+                                       _timestamp(now - READING_INTERVAL * step))
+
+        conn.executemany("INSERT INTO temperature_logs (shipment_id, temperature, humidity, timestamp) VALUES (?, ?, ?, ?)",
+                         reading_rows())
+        conn.execute("""
+                INSERT OR REPLACE INTO latest_temperature (shipment_id, temperature, humidity, timestamp)
+                SELECT shipment_id, temperature, humidity, MAX(timestamp) FROM temperature_logs GROUP BY shipment_id
+        """)
+        counts["temperature_logs"] = per_shipment * len(active_ids)
+
+        violated = rng.sample(active_ids, len(active_ids) // 20)
+        conn.executemany("UPDATE shipments SET constraints_violated = 1 WHERE id = ?", [(sid,) for sid in violated])
+
+        notification_rows = []
+        for _ in range(notifications):
+                shipment_id, manufacturer_id, recipient_id = rng.choice(shipment_ids)
+                notification_rows.append((rng.choice((manufacturer_id, recipient_id)), shipment_id,
+                                          "Benchmark notification", int(rng.random() < 0.7),
+                                          _timestamp(now - timedelta(seconds=rng.randrange(30 * 24 * 3600)))))
+        conn.executemany("""
+                INSERT INTO notifications (user_id, shipment_id, message, read, created_at) VALUES (?, ?, ?, ?, ?)
+        """, notification_rows)
+        counts["notifications"] = notifications
+
+        conn.commit()
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.close()
+        return counts
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--database", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench.db"))
+        parser.add_argument("--manufacturers", type=int, default=200)
+        parser.add_argument("--recipients", type=int, default=2000)
+        parser.add_argument("--products", type=int, default=5000)
+        parser.add_argument("--shipments", type=int, default=100000)
+        parser.add_argument("--active", type=int, default=5000, help="shipments in transit, these get the readings")
+        parser.add_argument("--readings", type=int, default=2000000)
+        parser.add_argument("--tags", type=int, default=50000)
+        parser.add_argument("--notifications", type=int, default=100000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--force", action="store_true", help="replace an existing database")
+        args = parser.parse_args()
+
+        if os.path.exists(args.database):
+                if not args.force:
+                        parser.error(f"{args.database} exists, pass --force to replace it")
+                for suffix in ("", "-wal", "-shm"):
+                        if os.path.exists(args.database + suffix):
+                                os.remove(args.database + suffix)
+
+        started = time.perf_counter()
+        counts = seed(args.database, args.manufacturers, args.recipients, args.products, args.shipments,
+                      args.active, args.readings, args.tags, args.notifications, args.seed)
+        for table, count in counts.items():
+                print(f"{table:>18}: {count}")
+        print(f"Seeded {args.database} in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,96 @@
+"""
+Cost of turning a large shipment listing into a response body:
+
+        python benchmarks/serialization.py --shipments 10000
+
+Seeds a throwaway database with one manufacturer owning every shipment, then
+times the query, the response_model validation FastAPI does for routes that
+return plain data, the stdlib and orjson encoders, and GET /api/shipments end
+to end, which returns the rows unvalidated through responses.trusted. The
+response cache is cleared before every request, so each one is encoded afresh.
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+import common  # noqa: F401  (puts the api modules on the path)
+
+import httpx
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+
+import database
+from auth import create_token
+from http_cache import response_cache
+from responses import FastJSONResponse, trusted
+from seed import seed
+from shipments import fetch_shipments
+
+def best_of(repeat: int, function) -> float:
+        """Fastest of `repeat` runs in milliseconds, the least disturbed by the rest of the machine."""
+        timings = []
+        for _ in range(repeat):
+                started = time.perf_counter()
+                function()
+                timings.append((time.perf_counter() - started) * 1000)
+        return min(timings)
+
+def main(args):
+        with tempfile.TemporaryDirectory() as directory:
+                seed(os.path.join(directory, "serialization.db"), manufacturers=1, recipients=50, products=50,
+                     shipments=args.shipments, active=10, readings=100, tags=0, notifications=0)
+                import app
+
+                conn = database.connect()
+                user_id, username = conn.execute("SELECT id, username FROM users WHERE role = 'manufacturer'").fetchone()
+                shipments, _ = fetch_shipments(conn, "manufacturer_id = ?", (user_id,))
+                route = next(route for route in app.app.routes
+                             if getattr(route, "path", None) == "/api/shipments" and "GET" in route.methods)
+
+                def validate():
+                        return asyncio.run(serialize_response(field=route.response_field, response_content=shipments))
+
+                validated = validate()
+                timings = {
+                        "query": best_of(args.repeat, lambda: fetch_shipments(conn, "manufacturer_id = ?", (user_id,))),
+                        "response_model validation": best_of(args.repeat, validate),
+                        "stdlib json encode": best_of(args.repeat, lambda: JSONResponse(validated)),
+                        "orjson encode": best_of(args.repeat, lambda: FastJSONResponse(validated)),
+                        "trusted orjson encode": best_of(args.repeat, lambda: trusted(shipments)),
+                }
+                conn.close()
+                # The fast path must produce what validation would have
+                if json.loads(trusted(shipments).body) != validated:
+                        raise SystemExit("trusted output differs from the validated response")
+
+                token = create_token({"sub": username, "user_id": user_id, "role": "manufacturer"})
+
+                async def request():
+                        transport = httpx.ASGITransport(app=app.app)
+                        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                                timings_ms = []
+                                for _ in range(args.repeat):
+                                        response_cache.clear()
+                                        started = time.perf_counter()
+                                        response = await client.get("/api/shipments", headers={"Authorization": f"Bearer {token}"})
+                                        response.raise_for_status()
+                                        timings_ms.append((time.perf_counter() - started) * 1000)
+                                return min(timings_ms), len(response.content)
+
+                timings["GET /api/shipments"], size = asyncio.run(request())
+                database.close_pool()
+
+        print(f"{len(shipments)} shipments, {size / 1024:.0f} KiB of JSON")
+        for name, elapsed in timings.items():
+                print(f"{name:<28} {elapsed:9.2f} ms")
+        before = timings["response_model validation"] + timings["stdlib json encode"]
+        print(f"{'validate + stdlib json':<28} {before:9.2f} ms, {before / timings['trusted orjson encode']:.1f}x the trusted path")
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--shipments", type=int, default=10000)
+        parser.add_argument("--repeat", type=int, default=5)
+        main(parser.parse_args())
@@ -0,0 +1,134 @@
+"""
+Read throughput of the API served by 1, 2 and 4 uvicorn workers on one seeded
+database (see seed.py), load coming from several client processes so the
+clients are not the bottleneck:
+
+        python benchmarks/worker_scaling.py --database benchmarks/bench.db --workers 1 2 4 --duration 10
+
+Each run copies the database and starts its own server and in process broker.
+Workers only scale as far as the host has idle cores for them and the clients.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+from common import API_DIR, format_summary, summarize
+
+import httpx
+
+def free_port() -> int:
+        with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                return s.getsockname()[1]
+
+def fixtures(path: str, sample: int = 1000) -> list:
+        """(shipment code, bearer token of its manufacturer) pairs to build requests from."""
+        from auth import create_token
+
+        conn = sqlite3.connect(path)
+        rows = conn.execute("""
+                SELECT s.shipment_code, u.id, u.username FROM shipments s
+                JOIN users u ON u.id = s.manufacturer_id
+                ORDER BY random() LIMIT ?
+        """, (sample,)).fetchall()
+        conn.close()
+        return [(code, create_token({"sub": username, "user_id": user_id, "role": "manufacturer"},
+                                    expires_delta=timedelta(hours=1))) for code, user_id, username in rows]
+
+def requests_for(code: str) -> list:
+        return ["/api/shipments?limit=20", f"/api/shipments/{code}", f"/api/temperature/{code}?limit=50",
+                "/api/shipments/summary", "/api/excursions?limit=20"]
+
+async def drive(base_url: str, pairs: list, concurrency: int, duration: float, seed: int) -> tuple:
+        rng = random.Random(seed)
+        latencies = []
+        errors = 0
+        deadline = time.perf_counter() + duration
+
+        async def worker(client):
+                nonlocal errors
+                while time.perf_counter() < deadline:
+                        code, token = rng.choice(pairs)
+                        started = time.perf_counter()
+                        response = await client.get(rng.choice(requests_for(code)),
+                                                    headers={"Authorization": f"Bearer {token}"})
+                        latencies.append(time.perf_counter() - started)
+                        if response.status_code >= 400:
+                                errors += 1
+
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(base_url=base_url, timeout=30, limits=limits) as client:
+                await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        return latencies, errors
+
+def client_process(args) -> tuple:
+        return asyncio.run(drive(*args))
+
+def wait_ready(base_url: str, server: subprocess.Popen, timeout: float = 60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+                if server.poll() is not None:
+                        raise RuntimeError(f"Server exited with {server.returncode}")
+                try:
+                        if httpx.get(f"{base_url}/metrics", timeout=1).status_code == 200:
+                                return
+                except httpx.TransportError:
+                        pass
+                time.sleep(0.2)
+        raise RuntimeError("Server did not start")
+
+def run(source: str, workers: int, clients: int, concurrency: int, duration: float) -> dict:
+        with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "bench.db")
+                shutil.copy(source, path)
+                pairs = fixtures(path)
+                port = free_port()
+                env = dict(os.environ, REKSTI_WORKERS=str(workers), REKSTI_DATABASE=path, REKSTI_MQTT_EMBEDDED="1",
+                           REKSTI_MQTT_HOST="127.0.0.1", REKSTI_MQTT_PORT=str(free_port()), REKSTI_LOG_LEVEL="WARNING")
+                server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app:app", "--port", str(port),
+                                           "--workers", str(workers), "--log-level", "warning", "--no-access-log"],
+                                          cwd=API_DIR, env=env)
+                base_url = f"http://127.0.0.1:{port}"
+                try:
+                        wait_ready(base_url, server)
+                        # Warms every worker's caches before measuring
+                        with multiprocessing.Pool(clients) as pool:
+                                pool.map(client_process, [(base_url, pairs, concurrency, 1.0, i) for i in range(clients)])
+                                started = time.perf_counter()
+                                results = pool.map(client_process, [(base_url, pairs, concurrency, duration, i)
+                                                                    for i in range(clients)])
+                                elapsed = time.perf_counter() - started
+                finally:
+                        server.terminate()
+                        server.wait(30)
+        latencies = [latency for result in results for latency in result[0]]
+        return summarize(latencies, elapsed, sum(result[1] for result in results))
+
+def main(args):
+        print(f"{os.cpu_count()} CPUs, {args.clients} client processes x {args.concurrency} connections, "
+              f"{args.duration:g}s per run")
+        baseline = None
+        for workers in args.workers:
+                summary = run(args.database, workers, args.clients, args.concurrency, args.duration)
+                baseline = baseline or summary["throughput"]
+                print(f"{format_summary(f'{workers} workers', summary)}  "
+                      f"({summary['throughput'] / baseline:.2f}x)")
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--database", default=os.path.join(API_DIR, "benchmarks", "bench.db"))
+        parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+        parser.add_argument("--clients", type=int, default=4, help="client processes")
+        parser.add_argument("--concurrency", type=int, default=16, help="connections per client process")
+        parser.add_argument("--duration", type=float, default=10)
+        main(parser.parse_args())
@@ -0,0 +1,195 @@
+import threading
+import time
+from collections import OrderedDict
+from sqlite3 import Connection
+from typing import Optional
+
+# Seconds an unknown shipment is remembered, it may be created by another worker meanwhile
+MISSING_TTL = 5.0
+# Envelopes of existing shipments kept, least recently used evicted first
+MAX_ENVELOPES = 10000
+# Unknown shipment ids remembered, kept apart so ids nobody ships cannot evict real envelopes
+MAX_MISSING = 1000
+
+def _tightest(values, pick):
+        values = [v for v in values if v is not None]
+        return pick(values) if values else None
+
+def _outside(value, low, high) -> bool:
+        # A missing bound never fails, same as comparing against NULL in SQL
+        return (high is not None and value > high) or (low is not None and value < low)
+
+class ItemBounds:
+        __slots__ = ("item_id", "product_id", "min_temperature", "max_temperature",
+                     "min_humidity", "max_humidity", "violated")
+
+        def __init__(self, row):
+                self.item_id = row["item_id"]
+                self.product_id = row["product_id"]
+                self.min_temperature = row["min_temperature"]
+                self.max_temperature = row["max_temperature"]
+                self.min_humidity = row["min_humidity"]
+                self.max_humidity = row["max_humidity"]
+                self.violated = bool(row["item_violated"])
+
+        def fails(self, temperature, humidity) -> bool:
+                return (_outside(temperature, self.min_temperature, self.max_temperature) or
+                        _outside(humidity, self.min_humidity, self.max_humidity))
+
+class Envelope:
+        """
+        Tightest temperature and humidity bounds across every product of a shipment,
+        plus the violation flags currently stored for the shipment and its items.
+        """
+        def __init__(self, shipment_id: int, violated: bool, items, exists: bool = True):
+                self.shipment_id = shipment_id
+                self.exists = exists
+                self.violated = violated
+                self.items = items
+                self.loaded_at = time.monotonic()
+                self.product_ids = {item.product_id for item in items}
+                self.min_temperature = _tightest([i.min_temperature for i in items], max)
+                self.max_temperature = _tightest([i.max_temperature for i in items], min)
+                self.min_humidity = _tightest([i.min_humidity for i in items], max)
+                self.max_humidity = _tightest([i.max_humidity for i in items], min)
+
+        def fails(self, temperature, humidity) -> bool:
+                return (_outside(temperature, self.min_temperature, self.max_temperature) or
+                        _outside(humidity, self.min_humidity, self.max_humidity))
+
+        def check(self, temperature, humidity):
+                """
+                Evaluate one reading and record any flags it flips.
+
+                Returns:
+                        Tuple of (True if the shipment flag flipped, list of item ids whose flag flipped)
+                """
+                if not self.fails(temperature, humidity):
+                        return False, []
+
+                # Only an out-of-envelope reading needs the per-item comparison
+                flipped_items = []
+                for item in self.items:
+                        if not item.violated and item.fails(temperature, humidity):
+                                item.violated = True
+                                flipped_items.append(item.item_id)
+
+                shipment_flipped = not self.violated
+                self.violated = True
+                return shipment_flipped, flipped_items
+
+class ConstraintCache:
+        """Per-shipment envelopes, loaded on first sight and rebuilt when items change."""
+        def __init__(self, max_entries: int = MAX_ENVELOPES, max_missing: int = MAX_MISSING):
+                self.max_entries = max_entries
+                self.max_missing = max_missing
+                self._envelopes = OrderedDict()
+                self._missing = OrderedDict()
+                self._lock = threading.Lock()
+
+        def __len__(self):
+                return len(self._envelopes) + len(self._missing)
+
+        def _load(self, conn: Connection, shipment_id: int) -> Envelope:
+                cursor = conn.cursor()
+                cursor.execute("""
+                        SELECT s.constraints_violated AS shipment_violated, si.id AS item_id,
+                                si.constraints_violated AS item_violated, p.id AS product_id,
+                                p.min_temperature, p.max_temperature, p.min_humidity, p.max_humidity
+                        FROM shipments s
+                        LEFT JOIN shipment_items si ON si.shipment_id = s.id
+                        LEFT JOIN products p ON si.product_id = p.id
+                        WHERE s.id = ? AND s.archived_at IS NULL
+                """, (shipment_id,))
+                rows = cursor.fetchall()
+                items = [ItemBounds(row) for row in rows if row["item_id"] is not None and row["product_id"] is not None]
+                violated = bool(rows[0]["shipment_violated"]) if rows else False
+                return Envelope(shipment_id, violated, items, exists=bool(rows))
+
+        def peek(self, shipment_id: int) -> Optional[Envelope]:
+                """The cached envelope, None when it would have to be loaded."""
+                with self._lock:
+                        envelope = self._envelopes.get(shipment_id)
+                        if envelope is not None:
+                                self._envelopes.move_to_end(shipment_id)
+                                return envelope
+                        envelope = self._missing.get(shipment_id)
+                        if envelope is not None and time.monotonic() - envelope.loaded_at > MISSING_TTL:
+                                return None
+                        return envelope
+
+        def get(self, conn: Connection, shipment_id: int) -> Envelope:
+                envelope = self.peek(shipment_id)
+                if envelope is None:
+                        envelope = self.build(conn, shipment_id)
+                return envelope
+
+        def build(self, conn: Connection, shipment_id: int) -> Envelope:
+                envelope = self._load(conn, shipment_id)
+                with self._lock:
+                        self._envelopes.pop(shipment_id, None)
+                        self._missing.pop(shipment_id, None)
+                        entries, limit = (self._envelopes, self.max_entries) if envelope.exists else (self._missing, self.max_missing)
+                        entries[shipment_id] = envelope
+                        while len(entries) > limit:
+                                entries.popitem(last=False)
+                return envelope
+
+        def invalidate(self, shipment_id: Optional[int] = None):
+                """Drop one shipment's envelope, or every envelope when no id is given."""
+                with self._lock:
+                        if shipment_id is None:
+                                self._envelopes.clear()
+                                self._missing.clear()
+                        else:
+                                self._envelopes.pop(shipment_id, None)
+                                self._missing.pop(shipment_id, None)
+
+constraint_cache = ConstraintCache()
+
+def known_readings(conn: Connection, readings, cache: ConstraintCache = constraint_cache) -> list:
+        """
+        Readings whose shipment exists and is not archived. Anything else would
+        fail the foreign key or land in the hot tables after the shipment left them.
+        Call it holding the write lock. Archiving invalidates envelopes only after it
+        commits, so the archived flag is read from the database, not from the cache.
+        """
+        known = [reading for reading in readings if cache.get(conn, reading[0]).exists]
+        shipment_ids = list({reading[0] for reading in known})
+        if not shipment_ids:
+                return known
+        archived = {row[0] for row in conn.execute(f"""
+                SELECT id FROM shipments WHERE archived_at IS NOT NULL AND id IN ({','.join('?' * len(shipment_ids))})
+        """, shipment_ids)}
+        for shipment_id in archived:
+                cache.invalidate(shipment_id)
+        return [reading for reading in known if reading[0] not in archived]
+
+def evaluate_readings(conn: Connection, readings, cache: ConstraintCache = constraint_cache):
+        """
+        Check readings against cached envelopes and write only the flags that flip.
+        The caller commits; on rollback the affected shipments must be invalidated.
+
+        Returns:
+                Tuple of (dictionary of shipment id to the reading that flipped its
+                shipment flag, set of ids of shipments with any shipment or item flag flipped)
+        """
+        flipped_shipments = {}
+        flipped_items = []
+        changed = set()
+        for reading in readings:
+                shipment_id, temperature, humidity = reading[:3]
+                shipment_flipped, items = cache.get(conn, shipment_id).check(temperature, humidity)
+                if shipment_flipped:
+                        flipped_shipments[shipment_id] = reading
+                if shipment_flipped or items:
+                        changed.add(shipment_id)
+                flipped_items.extend(items)
+
+        if flipped_shipments:
+                conn.executemany("UPDATE shipments SET constraints_violated = 1 WHERE id = ?",
+                                 [(shipment_id,) for shipment_id in flipped_shipments])
+        if flipped_items:
+                conn.executemany("UPDATE shipment_items SET constraints_violated = 1 WHERE id = ?",
+                                 [(item_id,) for item_id in flipped_items])
+        return flipped_shipments, changed
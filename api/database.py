@@ -1,25 +1,165 @@
 import sqlite3
 import os
+import threading
+import time
 from sqlite3 import Connection
-import uuid
-from datetime import datetime
 
-DATABASE = "reksti.db"
+from logs import get_logger
+from metrics import Gauge
+from migrations import migrate
 
-def get_db() -> Connection:
-        conn = sqlite3.connect(DATABASE)
+logger = get_logger(__name__)
+
+DATABASE = os.environ.get("REKSTI_DATABASE", "reksti.db")
+
+# Connections kept open by the pool
+POOL_SIZE = 8
+# Seconds to wait for a free connection before giving up
+POOL_TIMEOUT = 10.0
+# Prepared statements kept per connection by the sqlite3 module
+STATEMENT_CACHE_SIZE = 256
+
+PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=5000",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA foreign_keys=ON",
+)
+
+def connect() -> Connection:
+        """Open a dedicated connection with the tuned pragmas, outside the pool."""
+        conn = sqlite3.connect(DATABASE, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
         conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+                conn.execute(pragma)
         return conn
 
+class PooledConnection:
+        """
+        Wraps a pooled sqlite3 connection. close() hands it back to the pool
+        instead of closing it, so existing get_db()/close() callers keep working.
+        """
+        def __init__(self, pool, conn: Connection):
+                self._pool = pool
+                self._conn = conn
+
+        def __getattr__(self, name):
+                return getattr(self._conn, name)
+
+        def __enter__(self):
+                self._conn.__enter__()
+                return self
+
+        def __exit__(self, *exc):
+                return self._conn.__exit__(*exc)
+
+        def close(self):
+                conn, self._conn = self._conn, None
+                if conn is not None:
+                        self._pool.release(conn)
+
+        def __del__(self):
+                # Returns connections leaked by callers that never closed them
+                if getattr(self, "_conn", None) is not None:
+                        try:
+                                self.close()
+                        except Exception:
+                                pass
+
+class ConnectionPool:
+        def __init__(self, size: int = POOL_SIZE, timeout: float = POOL_TIMEOUT):
+                self.size = size
+                self.timeout = timeout
+                self._idle = []
+                self._created = 0
+                self._cond = threading.Condition()
+                self.acquired = 0
+                self.waits = 0
+                self.timeouts = 0
+                self.total_wait_ms = 0.0
+
+        def acquire(self) -> PooledConnection:
+                started = time.perf_counter()
+                with self._cond:
+                        self.acquired += 1
+                        if not self._idle and self._created >= self.size:
+                                self.waits += 1
+                                if not self._cond.wait_for(lambda: self._idle or self._created < self.size, self.timeout):
+                                        self.timeouts += 1
+                                        raise sqlite3.OperationalError("Timed out waiting for a database connection")
+                        self.total_wait_ms += (time.perf_counter() - started) * 1000
+                        if self._idle:
+                                return PooledConnection(self, self._idle.pop())
+                        self._created += 1
+                try:
+                        return PooledConnection(self, connect())
+                except Exception:
+                        with self._cond:
+                                self._created -= 1
+                                self._cond.notify()
+                        raise
+
+        def release(self, conn: Connection):
+                try:
+                        if conn.in_transaction:
+                                conn.rollback()
+                except sqlite3.Error:
+                        conn.close()
+                        with self._cond:
+                                self._created -= 1
+                                self._cond.notify()
+                        return
+                with self._cond:
+                        self._idle.append(conn)
+                        self._cond.notify()
+
+        def close_all(self):
+                with self._cond:
+                        for conn in self._idle:
+                                conn.close()
+                        self._created -= len(self._idle)
+                        self._idle.clear()
+
+        def stats(self) -> dict:
+                with self._cond:
+                        return {
+                                "size": self.size,
+                                "open": self._created,
+                                "idle": len(self._idle),
+                                "in_use": self._created - len(self._idle),
+                                "acquired": self.acquired,
+                                "waits": self.waits,
+                                "timeouts": self.timeouts,
+                                "avg_wait_ms": self.total_wait_ms / self.acquired if self.acquired else 0
+                        }
+
+pool = ConnectionPool()
+
+Gauge("reksti_db_connections", "Pooled SQLite connections by state", ("state",),
+      function=lambda: {state: value for state, value in pool.stats().items() if state in ("open", "idle", "in_use")})
+Gauge("reksti_db_pool_waits", "Times a request waited for a free pooled connection", function=lambda: pool.waits)
+
+def get_db() -> PooledConnection:
+        return pool.acquire()
+
+def close_pool():
+        pool.close_all()
+
 def init_db():
-        conn = sqlite3.connect(DATABASE)
-        conn.execute("PRAGMA journal_mode=WAL")
+        conn = connect()
         cursor = conn.cursor()
-        
+
         # Check if table exists
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users';")
         if cursor.fetchone() is None:
                 with open("schema.sql", "r") as f:
                         conn.executescript(f.read())
                 conn.commit()
-        conn.close()
\ No newline at end of file
+
+        # Brings new and existing databases up to the latest schema version
+        for migration in migrate(conn):
+                logger.info("Applied migration %s", migration)
+        conn.close()
@@ -0,0 +1,413 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from sqlite3 import Connection
+from typing import Optional
+
+from constraints import ConstraintCache, constraint_cache
+from database import connect
+from logs import get_logger
+from shipments import decode_cursor, encode_cursor
+
+logger = get_logger(__name__)
+
+# Activation energy over the gas constant in kelvin, 83.144 kJ/mol as in USP <1079>
+ACTIVATION_OVER_R = 83144 / 8.314
+KELVIN = 273.15
+# Longest gap between two readings counted as continuous time, in seconds
+MAX_READING_GAP = 5 * 60
+# Changed statistics are written at most this often, in seconds
+SAVE_INTERVAL = 5.0
+# Shipments whose trackers are kept in memory
+MAX_CACHED_SHIPMENTS = 10000
+# Shipments caught up per transaction at startup, and the pause between two, so ingest is not held up
+CATCH_UP_CHUNK = 50
+CATCH_UP_PAUSE = 0.05
+# shipment_item_id of the row tracking the whole shipment against its tightest limits
+SHIPMENT = 0
+
+_COLUMNS = ("shipment_id", "shipment_item_id", "readings", "first_at", "last_at", "last_out_of_range",
+            "out_of_range_seconds", "excursions", "peak_temperature_deviation", "peak_humidity_deviation",
+            "min_temperature", "max_temperature", "kinetic_sum")
+
+def _seconds(timestamp: str) -> float:
+        return (datetime.fromisoformat(timestamp) - datetime(1970, 1, 1)).total_seconds()
+
+def kinetic_term(temperature: float) -> float:
+        return math.exp(-ACTIVATION_OVER_R / (temperature + KELVIN))
+
+def _deviation(value, low, high) -> float:
+        if high is not None and value > high:
+                return value - high
+        if low is not None and value < low:
+                return low - value
+        return 0.0
+
+class Tracker:
+        """
+        Excursion statistics of one shipment or shipment item, updated in O(1) per reading.
+
+        Time out of range is sample and hold: the gap up to the next reading, capped
+        at MAX_READING_GAP, counts as out of range when the earlier reading was. A late
+        reading, older than the newest one seen, counts for the average reading interval.
+        """
+        __slots__ = _COLUMNS + ("_last_seconds", "_first_seconds")
+
+        def __init__(self, shipment_id: int, shipment_item_id: int, row=None):
+                for column in _COLUMNS:
+                        setattr(self, column, row[column] if row is not None else None)
+                self.shipment_id = shipment_id
+                self.shipment_item_id = shipment_item_id
+                if row is None:
+                        self.readings = 0
+                        self.out_of_range_seconds = 0.0
+                        self.excursions = 0
+                        self.peak_temperature_deviation = 0.0
+                        self.peak_humidity_deviation = 0.0
+                        self.kinetic_sum = 0.0
+                        self._first_seconds = self._last_seconds = None
+                else:
+                        self.last_out_of_range = bool(self.last_out_of_range)
+                        self._first_seconds = _seconds(self.first_at)
+                        self._last_seconds = _seconds(self.last_at)
+
+        def add(self, temperature, humidity, timestamp: str, seconds: float, kinetic: float, bounds):
+                """`seconds` is `timestamp` as unix time and `kinetic` is kinetic_term(temperature)."""
+                temperature_deviation = _deviation(temperature, bounds.min_temperature, bounds.max_temperature)
+                humidity_deviation = _deviation(humidity, bounds.min_humidity, bounds.max_humidity)
+                outside = temperature_deviation > 0 or humidity_deviation > 0
+                if not self.readings:
+                        self.first_at = self.last_at = timestamp
+                        self._first_seconds = self._last_seconds = seconds
+                        self.min_temperature = self.max_temperature = temperature
+                        self.excursions = int(outside)
+                        self.last_out_of_range = outside
+                elif seconds >= self._last_seconds:
+                        if self.last_out_of_range:
+                                self.out_of_range_seconds += min(seconds - self._last_seconds, MAX_READING_GAP)
+                        elif outside:
+                                self.excursions += 1
+                        self.last_at = timestamp
+                        self._last_seconds = seconds
+                        self.last_out_of_range = outside
+                else:
+                        if outside:
+                                interval = (self._last_seconds - self._first_seconds) / max(self.readings - 1, 1)
+                                self.out_of_range_seconds += min(interval, MAX_READING_GAP)
+                        if seconds < self._first_seconds:
+                                self.first_at = timestamp
+                                self._first_seconds = seconds
+
+                self.readings += 1
+                if temperature < self.min_temperature:
+                        self.min_temperature = temperature
+                elif temperature > self.max_temperature:
+                        self.max_temperature = temperature
+                if temperature_deviation > self.peak_temperature_deviation:
+                        self.peak_temperature_deviation = temperature_deviation
+                if humidity_deviation > self.peak_humidity_deviation:
+                        self.peak_humidity_deviation = humidity_deviation
+                self.kinetic_sum += kinetic
+
+        def mean_kinetic_temperature(self) -> Optional[float]:
+                if not self.readings or self.kinetic_sum <= 0:
+                        return None
+                return ACTIVATION_OVER_R / -math.log(self.kinetic_sum / self.readings) - KELVIN
+
+        def row(self) -> tuple:
+                return tuple(getattr(self, column) for column in _COLUMNS)
+
+        def as_dict(self) -> dict:
+                return {
+                        "readings": self.readings,
+                        "first_reading_at": self.first_at,
+                        "last_reading_at": self.last_at,
+                        "minutes_out_of_range": round(self.out_of_range_seconds / 60, 2),
+                        "excursions": self.excursions,
+                        "out_of_range": bool(self.last_out_of_range),
+                        "peak_temperature_deviation": self.peak_temperature_deviation,
+                        "peak_humidity_deviation": self.peak_humidity_deviation,
+                        "min_temperature": self.min_temperature,
+                        "max_temperature": self.max_temperature,
+                        "mean_kinetic_temperature": self.mean_kinetic_temperature()
+                }
+
+def load_trackers(conn: Connection, shipment_ids) -> dict:
+        """Stored trackers of the given shipments, keyed by (shipment_id, shipment_item_id)."""
+        shipment_ids = list(shipment_ids)
+        trackers = {}
+        for start in range(0, len(shipment_ids), 500):
+                chunk = shipment_ids[start:start + 500]
+                for row in conn.execute(f"""
+                        SELECT * FROM excursion_stats WHERE shipment_id IN ({','.join('?' * len(chunk))})
+                """, chunk):
+                        trackers[(row["shipment_id"], row["shipment_item_id"])] = Tracker(
+                                row["shipment_id"], row["shipment_item_id"], row)
+        return trackers
+
+def save_trackers(conn: Connection, trackers):
+        conn.executemany(f"""
+                INSERT OR REPLACE INTO excursion_stats ({', '.join(_COLUMNS)})
+                VALUES ({', '.join('?' * len(_COLUMNS))})
+        """, [tracker.row() for tracker in trackers])
+
+def _stored_readings(conn: Connection, shipment_id: int, after: Optional[str]) -> list:
+        """Readings newer than `after` in time order, or every reading including rollups when it is None."""
+        if after is not None:
+                return conn.execute("""
+                        SELECT temperature, humidity, timestamp FROM temperature_logs
+                        WHERE shipment_id = ? AND timestamp > ?
+                        ORDER BY timestamp
+                """, (shipment_id, after)).fetchall()
+        # Rolled up history counts once per bucket at its average, so it is approximate
+        return conn.execute("""
+                SELECT avg_temperature, avg_humidity, bucket_start FROM temperature_rollups WHERE shipment_id = ?
+                UNION ALL
+                SELECT temperature, humidity, timestamp FROM temperature_logs WHERE shipment_id = ?
+                ORDER BY 3
+        """, (shipment_id, shipment_id)).fetchall()
+
+class ExcursionAggregator:
+        """
+        Keeps the trackers of recently active shipments in memory and writes the
+        changed ones to excursion_stats at most every `save_interval`, inside an
+        ingest transaction, so the stored statistics may lag by that long.
+
+        A shipment's trackers are loaded from excursion_stats and caught up with any
+        stored reading newer than their last one, which also repairs statistics left
+        behind by a crash or a rolled back batch. Assumes each shipment is ingested by
+        one writer, as with a single worker or REKSTI_INGEST_SHARDS.
+        """
+        def __init__(self, cache: ConstraintCache = constraint_cache, save_interval: float = SAVE_INTERVAL,
+                     max_shipments: int = MAX_CACHED_SHIPMENTS):
+                self.cache = cache
+                self.save_interval = save_interval
+                self.max_shipments = max_shipments
+                # shipment id to {shipment_item_id: Tracker}, least recently used first
+                self._shipments = OrderedDict()
+                self._dirty = set()
+                self._last_save = time.monotonic()
+                self._lock = threading.Lock()
+                self._catch_up_stop = threading.Event()
+                self._catch_up_thread = None
+                self.saves = 0
+                self.caught_up = 0
+
+        def _apply(self, conn: Connection, trackers: dict, shipment_id: int, readings):
+                """Add (temperature, humidity, timestamp, ...) readings of one shipment to its trackers."""
+                envelope = self.cache.get(conn, shipment_id)
+                targets = []
+                for item_id, bounds in [(SHIPMENT, envelope)] + [(item.item_id, item) for item in envelope.items]:
+                        tracker = trackers.get(item_id)
+                        if tracker is None:
+                                tracker = trackers[item_id] = Tracker(shipment_id, item_id)
+                        targets.append((tracker.add, bounds))
+                        self._dirty.add((shipment_id, item_id))
+                for temperature, humidity, timestamp, *_ in readings:
+                        # Shared by the shipment and every item, so worked out once
+                        seconds = _seconds(timestamp)
+                        kinetic = kinetic_term(temperature)
+                        for add, bounds in targets:
+                                add(temperature, humidity, timestamp, seconds, kinetic, bounds)
+
+        def _load(self, conn: Connection, shipment_ids):
+                # Caller holds the lock
+                stored = load_trackers(conn, shipment_ids)
+                for shipment_id in shipment_ids:
+                        trackers = {item_id: tracker for (sid, item_id), tracker in stored.items() if sid == shipment_id}
+                        shipment = trackers.get(SHIPMENT)
+                        missed = _stored_readings(conn, shipment_id, shipment.last_at if shipment else None)
+                        if missed:
+                                self._apply(conn, trackers, shipment_id, missed)
+                        self.caught_up += len(missed)
+                        self._shipments[shipment_id] = trackers
+
+        def _save(self, conn: Connection, keys):
+                # Caller holds the lock
+                save_trackers(conn, [self._shipments[shipment_id][item_id] for shipment_id, item_id in keys])
+                self._dirty.difference_update(keys)
+                self.saves += 1
+
+        def record(self, conn: Connection, readings):
+                """
+                Fold readings that are about to be stored into the statistics. Called inside
+                the ingest transaction before the readings are written, so catching up a
+                shipment from the database cannot count them twice.
+                """
+                readings = [reading for reading in readings if reading[3] is not None]
+                if not readings:
+                        return
+                by_shipment = {}
+                for reading in readings:
+                        by_shipment.setdefault(reading[0], []).append(reading[1:])
+                with self._lock:
+                        missing = [shipment_id for shipment_id in by_shipment if shipment_id not in self._shipments]
+                        if missing:
+                                self._load(conn, missing)
+                        for shipment_id, shipment_readings in by_shipment.items():
+                                self._shipments.move_to_end(shipment_id)
+                                self._apply(conn, self._shipments[shipment_id], shipment_id, shipment_readings)
+
+                        # Evicted shipments are saved first so nothing is lost with them
+                        evicted = []
+                        while len(self._shipments) > self.max_shipments:
+                                shipment_id, trackers = self._shipments.popitem(last=False)
+                                evicted += [tracker for item_id, tracker in trackers.items()
+                                            if (shipment_id, item_id) in self._dirty]
+                        if evicted:
+                                save_trackers(conn, evicted)
+                                self._dirty.difference_update((t.shipment_id, t.shipment_item_id) for t in evicted)
+                        if time.monotonic() - self._last_save >= self.save_interval:
+                                self._save(conn, list(self._dirty))
+                                self._last_save = time.monotonic()
+
+        def save_due(self, conn: Connection):
+                """Write changed trackers if the last save is `save_interval` old, for a writer with no batch to record."""
+                with self._lock:
+                        if not self._dirty or time.monotonic() - self._last_save < self.save_interval:
+                                return
+                        self._save(conn, list(self._dirty))
+                        self._last_save = time.monotonic()
+                conn.commit()
+
+        def flush(self, conn: Connection):
+                """Write every changed tracker now and commit."""
+                with self._lock:
+                        if self._dirty:
+                                self._save(conn, list(self._dirty))
+                        self._last_save = time.monotonic()
+                conn.commit()
+
+        def invalidate(self, shipment_ids):
+                """Forget shipments whose batch was rolled back, they are caught up again on next use."""
+                with self._lock:
+                        for shipment_id in shipment_ids:
+                                self._shipments.pop(shipment_id, None)
+                        self._dirty = {key for key in self._dirty if key[0] not in shipment_ids}
+
+        def catch_up(self, conn: Connection) -> int:
+                """
+                Bring stored statistics up to date with every shipment's stored readings,
+                CATCH_UP_CHUNK shipments per transaction. Shipments ingested meanwhile are
+                caught up by record and skipped. Returns the number of shipments caught up.
+                """
+                behind = [row[0] for row in conn.execute("""
+                        SELECT lt.shipment_id FROM latest_temperature lt
+                        LEFT JOIN excursion_stats es ON es.shipment_id = lt.shipment_id AND es.shipment_item_id = 0
+                        WHERE es.last_at IS NULL OR es.last_at < lt.timestamp
+                """)]
+                caught_up = 0
+                for start in range(0, len(behind), CATCH_UP_CHUNK):
+                        with self._lock:
+                                chunk = [shipment_id for shipment_id in behind[start:start + CATCH_UP_CHUNK]
+                                         if shipment_id not in self._shipments]
+                                self._load(conn, chunk)
+                                # Only these, the other dirty trackers belong to uncommitted ingest batches
+                                self._save(conn, [key for key in self._dirty if key[0] in chunk])
+                                conn.commit()
+                                # Saved, and record reloads them cheaply, so they take no cache space from active ones
+                                for shipment_id in chunk:
+                                        self._shipments.pop(shipment_id, None)
+                        caught_up += len(chunk)
+                        if self._catch_up_stop.wait(CATCH_UP_PAUSE):
+                                break
+                if caught_up:
+                        logger.info("Caught up excursion statistics of %d shipments", caught_up)
+                return caught_up
+
+        def _run_catch_up(self):
+                # Its own connection, so the catch up never waits for or holds a pooled one
+                conn = connect()
+                try:
+                        self.catch_up(conn)
+                except Exception:
+                        logger.exception("Catching up excursion statistics failed")
+                finally:
+                        conn.close()
+
+        def start_catch_up(self):
+                """catch_up in the background, so startup and an ingest takeover do not wait for it."""
+                self._catch_up_stop.clear()
+                self._catch_up_thread = threading.Thread(target=self._run_catch_up, name="excursion-catch-up", daemon=True)
+                self._catch_up_thread.start()
+
+        def stop_catch_up(self, timeout: float = 5.0):
+                self._catch_up_stop.set()
+                if self._catch_up_thread is not None:
+                        self._catch_up_thread.join(timeout)
+                        self._catch_up_thread = None
+
+        def stats(self) -> dict:
+                with self._lock:
+                        return {"shipments": len(self._shipments), "dirty": len(self._dirty), "saves": self.saves,
+                                "caught_up_readings": self.caught_up}
+
+excursion_aggregator = ExcursionAggregator()
+
+def fetch_summaries(conn: Connection, user_column: str, user_id: int, limit: Optional[int] = None,
+                    cursor: Optional[str] = None, shipment_codes: Optional[list] = None):
+        """
+        Shipment level statistics of a user's shipments, newest first on (created_at, id).
+        `user_column` is manufacturer_id or recipient_id. With `shipment_codes`, only
+        those shipments are included.
+
+        Returns:
+                Tuple of (list of summary dicts, next cursor or None)
+        """
+        if user_column not in ("manufacturer_id", "recipient_id"):
+                raise ValueError(f"Cannot list summaries by {user_column}")
+        clauses = [f"s.{user_column} = ?"]
+        args = [user_id]
+        if cursor is not None:
+                created_at, last_id = decode_cursor(cursor)
+                clauses.append("(s.created_at < ? OR (s.created_at = ? AND s.id < ?))")
+                args.extend([created_at, created_at, last_id])
+        if shipment_codes:
+                clauses.append(f"s.shipment_code IN ({','.join('?' * len(shipment_codes))})")
+                args.extend(shipment_codes)
+        sql = f"""
+                SELECT s.id AS shipment_id, s.shipment_code, s.status, s.constraints_violated, s.created_at,
+                        {', '.join(f"es.{column}" for column in _COLUMNS[1:])}
+                FROM shipments s
+                LEFT JOIN excursion_stats es ON es.shipment_id = s.id AND es.shipment_item_id = {SHIPMENT}
+                WHERE {' AND '.join(clauses)}
+                ORDER BY s.created_at DESC, s.id DESC
+        """
+        if limit is not None:
+                sql += " LIMIT ?"
+                args.append(limit + 1)
+        rows = conn.execute(sql, args).fetchall()
+
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["shipment_id"])
+        summaries = []
+        for row in rows:
+                tracker = Tracker(row["shipment_id"], SHIPMENT, row if row["readings"] is not None else None)
+                summaries.append({"shipment_code": row["shipment_code"], "status": row["status"],
+                                  "constraints_violated": bool(row["constraints_violated"]), **tracker.as_dict()})
+        return summaries, next_cursor
+
+def excursion_report(conn: Connection, shipment_id: int, shipment_code: str) -> dict:
+        """The shipment's statistics and one entry per item, with the limits they were measured against."""
+        trackers = load_trackers(conn, [shipment_id])
+        shipment = trackers.get((shipment_id, SHIPMENT)) or Tracker(shipment_id, SHIPMENT)
+        items = []
+        for row in conn.execute("""
+                SELECT si.id, si.product_id, p.name AS product_name, si.quantity,
+                        p.min_temperature, p.max_temperature, p.min_humidity, p.max_humidity
+                FROM shipment_items si
+                JOIN products p ON si.product_id = p.id
+                WHERE si.shipment_id = ?
+                ORDER BY si.id
+        """, (shipment_id,)):
+                tracker = trackers.get((shipment_id, row["id"])) or Tracker(shipment_id, row["id"])
+                item = {"product_id": row["product_id"], "product_name": row["product_name"], "quantity": row["quantity"]}
+                item.update({f"{limit}_limit": row[limit] for limit in (
+                        "min_temperature", "max_temperature", "min_humidity", "max_humidity")})
+                item.update(tracker.as_dict())
+                items.append(item)
+        return {"shipment_code": shipment_code, **shipment.as_dict(), "items": items}
@@ -0,0 +1,116 @@
+"""
+Compact binary sensor frames, accepted on the data topic next to JSON.
+
+A frame is a header followed by `count` 8 byte readings, little endian:
+
+        header   B magic (0xA5)  B version  H count  I shipment_id
+                 version 2 adds  I device sequence number of the first reading
+        reading  I unix seconds, 0 for "when received"
+                 h temperature in hundredths of a degree C
+                 H humidity in hundredths of a percent
+
+One reading is 16 bytes against roughly 60 for the JSON equivalent, and a
+logger can flush up to MAX_FRAME_READINGS buffered readings in one frame.
+Readings of a version 2 frame are numbered consecutively from the header's
+sequence number. JSON never starts with the magic byte, so the two are told
+apart by it.
+"""
+import struct
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from telemetry import TIMESTAMP_FORMAT
+
+MAGIC = 0xA5
+HEADERS = {1: struct.Struct("<BBHI"), 2: struct.Struct("<BBHII")}
+READING = struct.Struct("<IhH")
+MAX_FRAME_READINGS = 0xFFFF
+# Device timestamps further ahead of the receive time than this, in seconds, are replaced by it
+MAX_CLOCK_SKEW = 5 * 60
+# Formatted "YYYY-MM-DD HH:MM:" prefixes kept, readings seconds apart share one
+MINUTE_CACHE_SIZE = 4096
+
+_minutes = {}
+_SECONDS = [f"{second:02d}" for second in range(60)]
+
+class FrameError(ValueError):
+        pass
+
+def format_epoch(seconds: int) -> str:
+        """Unix seconds as a stored timestamp, strftime only runs once per minute."""
+        minute, second = divmod(seconds, 60)
+        prefix = _minutes.get(minute)
+        if prefix is None:
+                if len(_minutes) >= MINUTE_CACHE_SIZE:
+                        _minutes.clear()
+                prefix = _minutes[minute] = time.strftime(TIMESTAMP_FORMAT[:-2], time.gmtime(seconds))
+        return prefix + _SECONDS[second]
+
+def device_timestamp(value, received_at: Optional[float] = None) -> str:
+        """
+        A reading time sent by a device, unix seconds or an ISO 8601 string, as a
+        stored timestamp. Missing or implausibly future times become the receive time.
+        """
+        received_at = received_at if received_at is not None else time.time()
+        if isinstance(value, str):
+                moment = datetime.fromisoformat(value)
+                if moment.tzinfo is None:
+                        # Naive times are UTC, like the stored ones
+                        moment = moment.replace(tzinfo=timezone.utc)
+                value = moment.timestamp()
+        if isinstance(value, bool) or not isinstance(value, (int, float, type(None))):
+                raise TypeError("timestamp must be unix seconds or an ISO 8601 string")
+        if not value or value > received_at + MAX_CLOCK_SKEW:
+                value = received_at
+        return format_epoch(int(value))
+
+def is_frame(payload: bytes) -> bool:
+        return len(payload) > 0 and payload[0] == MAGIC
+
+def decode_frame(payload: bytes, received_at: Optional[float] = None) -> tuple:
+        """
+        Parse a frame without copying the readings out of `payload`.
+
+        Returns:
+                Tuple of (shipment id, list of (temperature, humidity, timestamp, device_seq)),
+                timestamps formatted like the stored ones, device_seq None for version 1
+        """
+        view = memoryview(payload)
+        if len(view) < 2 or view[0] != MAGIC or view[1] not in HEADERS:
+                raise FrameError(f"unsupported frame version {view[1] if len(view) > 1 else None}")
+        header = HEADERS[view[1]]
+        if len(view) < header.size:
+                raise FrameError("frame shorter than its header")
+        _, version, count, shipment_id, *first_seq = header.unpack_from(view)
+        if len(view) != header.size + count * READING.size:
+                raise FrameError(f"frame of {len(view)} bytes does not hold {count} readings")
+
+        now = int(received_at if received_at is not None else time.time())
+        latest = now + MAX_CLOCK_SKEW
+        seq = first_seq[0] if first_seq else None
+        readings = []
+        for seconds, temperature, humidity in READING.iter_unpack(view[header.size:]):
+                readings.append((temperature / 100, humidity / 100,
+                                 format_epoch(seconds if 0 < seconds <= latest else now), seq))
+                if seq is not None:
+                        seq += 1
+        return shipment_id, readings
+
+def encode_frame(shipment_id: int, readings, first_seq: Optional[int] = None) -> bytes:
+        """
+        Build a frame from (temperature, humidity, timestamp) readings, timestamp a
+        datetime, unix seconds or None. A `first_seq` makes it a version 2 frame.
+        """
+        if len(readings) > MAX_FRAME_READINGS:
+                raise FrameError(f"at most {MAX_FRAME_READINGS} readings fit in one frame")
+        header = HEADERS[1 if first_seq is None else 2]
+        frame = bytearray(header.size + len(readings) * READING.size)
+        fields = (MAGIC, 1, len(readings), shipment_id) if first_seq is None else (MAGIC, 2, len(readings), shipment_id, first_seq)
+        header.pack_into(frame, 0, *fields)
+        for index, (temperature, humidity, timestamp) in enumerate(readings):
+                if isinstance(timestamp, datetime):
+                        timestamp = timestamp.timestamp() if timestamp.tzinfo else (timestamp - datetime(1970, 1, 1)).total_seconds()
+                READING.pack_into(frame, header.size + index * READING.size, int(timestamp or 0),
+                                  round(temperature * 100), round(humidity * 100))
+        return bytes(frame)
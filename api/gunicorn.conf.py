@@ -0,0 +1,25 @@
+"""
+Launch profile for several workers on one database:
+
+        gunicorn app:app
+
+REKSTI_WORKERS sets the number of workers, one per CPU by default, and every
+worker reads it to know it shares the database, see workers.py. Plain uvicorn
+works too: REKSTI_WORKERS=4 uvicorn app:app --workers 4
+"""
+import multiprocessing
+import os
+
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.environ.setdefault("REKSTI_WORKERS", str(multiprocessing.cpu_count())))
+bind = os.environ.get("REKSTI_BIND", "0.0.0.0:8000")
+# Readings are flushed and the ingest lock handed over within this
+graceful_timeout = 30
+
+def on_starting(server):
+        import database
+        from workers import SharedCounters, state_path
+
+        database.init_db()
+        # A new epoch, so no ETag of the previous run matches
+        SharedCounters.reset(state_path("versions"))
@@ -0,0 +1,161 @@
+"""
+Conditional GETs and a response cache for the dashboard's reads.
+
+Every user has a version counter per resource, bumped by each write that can
+change what that user reads. A read's weak ETag is made of the counters it
+depends on, so `If-None-Match` is answered with 304 from memory alone, and a
+full response is stored under its ETag until a newer version makes it unreachable.
+
+Counters live in this process, so every write has to go through it. They start
+from a per process epoch, so ETags handed out before a restart never match.
+With several workers they live in a file all of them map instead, see workers.
+"""
+import threading
+import time
+from collections import OrderedDict
+from sqlite3 import Connection
+from typing import Optional
+
+from fastapi import Request, Response
+
+from metrics import Counter
+from responses import trusted
+
+MAX_CACHED_RESPONSES = 1024
+MAX_CACHED_BYTES = 64 * 1024 * 1024
+# Skipped by the cache rather than evicting everything else
+MAX_CACHED_RESPONSE_BYTES = 8 * 1024 * 1024
+
+cache_requests = Counter("reksti_http_cache_requests_total", "Conditional reads by outcome", ("outcome",))
+
+class VersionCounters:
+        """Per user counters of "products", "shipments" and "notifications"."""
+        def __init__(self):
+                self.epoch = format(time.time_ns() // 1000, "x")
+                self._versions = {}
+                self._shared = None
+                self._lock = threading.Lock()
+
+        def share(self, counters):
+                """Keep the counters in a workers.SharedCounters from now on, so every worker sees every bump."""
+                self._shared = counters
+                self.epoch = format(counters.epoch, "x")
+
+        def bump(self, resource: str, *user_ids):
+                if self._shared is not None:
+                        self._shared.increment(*(f"{resource}:{user_id}" for user_id in user_ids if user_id is not None))
+                        return
+                with self._lock:
+                        for user_id in user_ids:
+                                if user_id is not None:
+                                        key = (resource, user_id)
+                                        self._versions[key] = self._versions.get(key, 0) + 1
+
+        def bump_shipments(self, conn: Connection, shipment_ids):
+                """Bump the shipments of everyone who can read the given shipments."""
+                shipment_ids = list(shipment_ids)
+                if not shipment_ids:
+                        return
+                owners = set()
+                for start in range(0, len(shipment_ids), 500):
+                        chunk = shipment_ids[start:start + 500]
+                        for manufacturer_id, recipient_id in conn.execute(f"""
+                                SELECT manufacturer_id, recipient_id FROM shipments
+                                WHERE id IN ({','.join('?' * len(chunk))})
+                        """, chunk):
+                                owners.update((manufacturer_id, recipient_id))
+                self.bump("shipments", *owners)
+
+        def get(self, resource: str, user_id: int) -> int:
+                if self._shared is not None:
+                        return self._shared.get(f"{resource}:{user_id}")
+                return self._versions.get((resource, user_id), 0)
+
+        def etag(self, user_id: int, resources, variant: str = "") -> str:
+                counters = "-".join(f"{resource[0]}{self.get(resource, user_id)}" for resource in resources)
+                return f'W/"{self.epoch}-{user_id}-{counters}{variant}"'
+
+class ResponseCache:
+        """Response bodies and headers by (path, query, ETag), least recently used evicted first."""
+        def __init__(self, max_entries: int = MAX_CACHED_RESPONSES, max_bytes: int = MAX_CACHED_BYTES):
+                self.max_entries = max_entries
+                self.max_bytes = max_bytes
+                self._entries = OrderedDict()
+                self._bytes = 0
+                self._lock = threading.Lock()
+
+        def get(self, key) -> Optional[tuple]:
+                with self._lock:
+                        entry = self._entries.get(key)
+                        if entry is not None:
+                                self._entries.move_to_end(key)
+                        return entry
+
+        def put(self, key, body: bytes, headers: list):
+                if len(body) > MAX_CACHED_RESPONSE_BYTES:
+                        return
+                with self._lock:
+                        previous = self._entries.pop(key, None)
+                        if previous is not None:
+                                self._bytes -= len(previous[0])
+                        self._entries[key] = (body, headers)
+                        self._bytes += len(body)
+                        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                                _, (evicted, _) = self._entries.popitem(last=False)
+                                self._bytes -= len(evicted)
+
+        def clear(self):
+                with self._lock:
+                        self._entries.clear()
+                        self._bytes = 0
+
+        def stats(self) -> dict:
+                with self._lock:
+                        return {"entries": len(self._entries), "bytes": self._bytes}
+
+versions = VersionCounters()
+response_cache = ResponseCache()
+
+def _matches(if_none_match: Optional[str], etag: str) -> bool:
+        if not if_none_match:
+                return False
+        # Weak comparison, as If-None-Match requires
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag.removeprefix("W/") in tags
+
+async def cached_read(request: Request, response: Response, user_id: int, resources, fetch,
+                      variant: str = "", authorize=None) -> Response:
+        """
+        Answer a read whose content only depends on `resources` of `user_id`, and on
+        `variant` for anything else it changes with. `fetch` is called without
+        arguments and returns an awaitable of content already shaped like the
+        route's response_model. A route reading one resource by id passes
+        `authorize`, called like `fetch` and raising when the user may not read
+        it; it runs before anything is answered from the ETag or the cache.
+        """
+        if authorize is not None:
+                await authorize()
+        # Taken before reading, a write racing the read can only make the ETag older than the content
+        etag = versions.etag(user_id, resources, variant)
+        headers = [(b"etag", etag.encode("latin-1")), (b"cache-control", b"private, no-cache")]
+        if _matches(request.headers.get("if-none-match"), etag):
+                cache_requests.labels("not_modified").inc()
+                not_modified = Response(status_code=304)
+                not_modified.raw_headers.extend(headers)
+                return not_modified
+
+        key = (request.url.path, request.url.query, etag)
+        entry = response_cache.get(key)
+        if entry is not None:
+                cache_requests.labels("hit").inc()
+                body, stored_headers = entry
+                hit = Response(body, media_type="application/json")
+                hit.raw_headers.extend(stored_headers)
+                return hit
+
+        cache_requests.labels("miss").inc()
+        fresh = trusted(await fetch(), response)
+        fresh.raw_headers.extend(headers)
+        response_cache.put(key, fresh.body, [header for header in fresh.raw_headers
+                                             if header[0] not in (b"content-length", b"content-type")])
+        return fresh
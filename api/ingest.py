@@ -0,0 +1,303 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from sqlite3 import Connection
+
+from constraints import constraint_cache, evaluate_readings, known_readings
+from database import connect
+from excursions import excursion_aggregator
+from http_cache import versions
+from logs import get_logger
+from metrics import Gauge, timed
+from notifications import violation_notifier
+from readings_cache import latest_readings
+from streaming import stream_hub
+from telemetry import append_readings, fresh_readings, update_latest
+
+logger = get_logger(__name__)
+
+ingest_lag = Gauge("reksti_ingest_lag_seconds", "Age of the oldest reading in the last committed batch")
+
+# Readings held in memory before the overload policy kicks in
+QUEUE_SIZE = 10000
+# Largest number of readings written in one transaction
+BATCH_SIZE = 500
+# Longest a reading waits for a batch to fill, in seconds
+FLUSH_INTERVAL = 0.5
+# What to do with a reading when the queue is full:
+#   coalesce    - keep only the newest pending reading per shipment
+#   drop_oldest - discard the oldest queued reading
+#   drop_newest - discard the incoming reading
+#   block       - wait up to BLOCK_TIMEOUT for space, then coalesce
+OVERLOAD_POLICY = "coalesce"
+BLOCK_TIMEOUT = 1.0
+
+POLICIES = ("coalesce", "drop_oldest", "drop_newest", "block")
+
+class IngestQueue:
+        """
+        Bounded hand-off between the MQTT network thread and the writer.
+
+        Readings are (shipment_id, temperature, humidity, timestamp, device_seq) tuples.
+        A backlog queued with put_many is handed to the writer whole, never split
+        across batches.
+        """
+        def __init__(self, maxsize: int = QUEUE_SIZE, policy: str = OVERLOAD_POLICY,
+                     block_timeout: float = BLOCK_TIMEOUT):
+                if policy not in POLICIES:
+                        raise ValueError(f"Unknown overload policy {policy}")
+                self.maxsize = maxsize
+                self.policy = policy
+                self.block_timeout = block_timeout
+                # Readings, and lists of readings for backlogs
+                self._items = deque()
+                self._size = 0
+                # Overflow readings, newest per shipment, used by the coalesce policy
+                self._coalesced = {}
+                self._cond = threading.Condition()
+                self.enqueued = 0
+                self.dropped = 0
+                self.coalesced = 0
+
+        def __len__(self):
+                with self._cond:
+                        return self._size + len(self._coalesced)
+
+        def _pop(self):
+                # Caller holds the lock
+                item = self._items.popleft()
+                self._size -= len(item) if isinstance(item, list) else 1
+                return item
+
+        def _admit(self, count: int) -> bool:
+                """
+                Make room for `count` readings under the overload policy, caller holds the lock.
+                Returns False when the policy says to drop them or to coalesce them instead.
+                """
+                if self._size < self.maxsize:
+                        return True
+                if self.policy == "block":
+                        self._cond.wait_for(lambda: self._size < self.maxsize, self.block_timeout)
+                if self.policy == "drop_oldest":
+                        while self._items and self._size >= self.maxsize:
+                                item = self._pop()
+                                self.dropped += len(item) if isinstance(item, list) else 1
+                        return True
+                return self._size < self.maxsize
+
+        def _coalesce(self, reading):
+                if reading[0] in self._coalesced:
+                        self.coalesced += 1
+                self._coalesced[reading[0]] = reading
+
+        def put(self, reading) -> bool:
+                """Queue a reading, returns False if it was dropped."""
+                with self._cond:
+                        self.enqueued += 1
+                        if not self._admit(1):
+                                if self.policy == "drop_newest":
+                                        self.dropped += 1
+                                        return False
+                                self._coalesce(reading)
+                                self._cond.notify_all()
+                                return True
+                        self._items.append(reading)
+                        self._size += 1
+                        self._cond.notify_all()
+                        return True
+
+        def put_many(self, readings) -> bool:
+                """
+                Queue readings to be written in one transaction, such as a device's backlog.
+                A full queue applies the overload policy to them as a unit: drop_newest drops
+                them all, coalesce keeps only the newest. Returns False if they were dropped.
+                """
+                readings = list(readings)
+                if len(readings) <= 1:
+                        return all(self.put(reading) for reading in readings)
+                with self._cond:
+                        self.enqueued += len(readings)
+                        if not self._admit(len(readings)):
+                                if self.policy == "drop_newest":
+                                        self.dropped += len(readings)
+                                        return False
+                                self.coalesced += len(readings) - 1
+                                self._coalesce(max(readings, key=lambda reading: reading[3] or ""))
+                                self._cond.notify_all()
+                                return True
+                        self._items.append(readings)
+                        self._size += len(readings)
+                        self._cond.notify_all()
+                        return True
+
+        def get_batch(self, max_items: int = BATCH_SIZE, timeout: float = FLUSH_INTERVAL) -> list:
+                """
+                Wait up to `timeout` for readings and return at most `max_items` of them,
+                oldest first, or more when a backlog would otherwise be split. Returns an
+                empty list on timeout.
+                """
+                with self._cond:
+                        self._cond.wait_for(lambda: self._items or self._coalesced, timeout)
+                        batch = []
+                        while self._items and len(batch) < max_items:
+                                item = self._pop()
+                                if isinstance(item, list):
+                                        batch.extend(item)
+                                else:
+                                        batch.append(item)
+                        # Coalesced readings arrived after everything still in the queue
+                        if not self._items:
+                                while self._coalesced and len(batch) < max_items:
+                                        shipment_id = next(iter(self._coalesced))
+                                        batch.append(self._coalesced.pop(shipment_id))
+                        if batch:
+                                self._cond.notify_all()
+                        return batch
+
+@timed()
+def write_batch(conn: Connection, readings):
+        """
+        Store a batch of readings and flag violated shipments in one transaction.
+        Readings for unknown shipments and readings already stored are skipped.
+
+        Returns:
+                Tuple of (readings stored, number of duplicates skipped,
+                dictionary of shipment id to the reading that violated it,
+                set of ids of shipments with a shipment or item flag flipped)
+        """
+        # Take the write lock first, so no shipment is archived between checking it and storing its readings
+        if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+        known = known_readings(conn, readings)
+        readings = fresh_readings(conn, known)
+        # Device time order, so a late backlog flags the earliest reading that broke the limits
+        readings.sort(key=lambda reading: (reading[3] is None, reading[3] or ""))
+        # Before appending, a shipment loaded from the database must not see this batch yet
+        excursion_aggregator.record(conn, readings)
+        append_readings(conn, readings)
+        update_latest(conn, readings)
+        flipped, changed = evaluate_readings(conn, readings)
+        conn.commit()
+        return readings, len(known) - len(readings), flipped, changed
+
+class IngestWriter:
+        """Dedicated thread draining an IngestQueue into SQLite."""
+        def __init__(self, queue: IngestQueue, batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL):
+                self.queue = queue
+                self.batch_size = batch_size
+                self.flush_interval = flush_interval
+                self._stop = threading.Event()
+                self._thread = None
+                self.batches = 0
+                self.written = 0
+                self.failed = 0
+                self.unknown = 0
+                self.duplicates = 0
+                self.last_batch_size = 0
+                self.max_batch_size = 0
+                self.last_commit_ms = 0.0
+                self.max_commit_ms = 0.0
+                self.total_commit_ms = 0.0
+
+        def start(self):
+                if self._thread is not None and self._thread.is_alive():
+                        return
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+                self._thread.start()
+
+        def stop(self, timeout: float = 5.0):
+                """Stop after flushing whatever is still queued."""
+                self._stop.set()
+                if self._thread is not None:
+                        self._thread.join(timeout)
+                        self._thread = None
+
+        def _run(self):
+                # Holds its own connection rather than occupying a pool slot for its lifetime
+                conn = connect()
+                try:
+                        while True:
+                                batch = self.queue.get_batch(self.batch_size, self.flush_interval)
+                                if batch:
+                                        self.flush(conn, batch)
+                                        continue
+                                if self._stop.is_set():
+                                        break
+                                # Otherwise the statistics of the last readings wait for the next batch
+                                try:
+                                        excursion_aggregator.save_due(conn)
+                                except Exception as e:
+                                        conn.rollback()
+                                        logger.error("Failed to save excursion statistics: %s", e)
+                        excursion_aggregator.flush(conn)
+                finally:
+                        conn.close()
+
+        def flush(self, conn: Connection, batch):
+                started = time.perf_counter()
+                try:
+                        stored, duplicates, flipped, changed = write_batch(conn, batch)
+                except Exception as e:
+                        conn.rollback()
+                        # Envelopes may hold flags that were never committed
+                        shipment_ids = {reading[0] for reading in batch}
+                        for shipment_id in shipment_ids:
+                                constraint_cache.invalidate(shipment_id)
+                        excursion_aggregator.invalidate(shipment_ids)
+                        if len(batch) == 1:
+                                self.failed += 1
+                                logger.error("Failed to write reading %r: %s", batch[0], e)
+                                return
+                        # One at a time, so a bad reading only costs itself
+                        logger.warning("Failed to write %d readings, retrying one at a time: %s", len(batch), e)
+                        for reading in batch:
+                                self.flush(conn, [reading])
+                        return
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                self.batches += 1
+                self.written += len(stored)
+                self.duplicates += duplicates
+                self.unknown += len(batch) - len(stored) - duplicates
+                self.last_batch_size = len(batch)
+                self.max_batch_size = max(self.max_batch_size, len(batch))
+                self.last_commit_ms = elapsed_ms
+                self.max_commit_ms = max(self.max_commit_ms, elapsed_ms)
+                self.total_commit_ms += elapsed_ms
+                timestamps = [reading[3] for reading in batch if reading[3]]
+                if timestamps:
+                        ingest_lag.set(max(0.0, (datetime.utcnow() - datetime.fromisoformat(min(timestamps))).total_seconds()))
+                for shipment_id, (_, temperature, humidity, timestamp, _) in flipped.items():
+                        latest_readings.mark_violated(shipment_id)
+                        stream_hub.publish_violation(shipment_id, temperature, humidity, timestamp)
+                # An item flag can flip on a shipment already flagged, its reads change all the same
+                if changed:
+                        versions.bump_shipments(conn, changed)
+                try:
+                        violation_notifier.notify(conn, stored)
+                except Exception as e:
+                        logger.error("Failed to store violation notifications: %s", e)
+
+        def stats(self) -> dict:
+                return {
+                        "queue_depth": len(self.queue),
+                        "queue_capacity": self.queue.maxsize,
+                        "overload_policy": self.queue.policy,
+                        "enqueued": self.queue.enqueued,
+                        "dropped": self.queue.dropped,
+                        "coalesced": self.queue.coalesced,
+                        "batches": self.batches,
+                        "written": self.written,
+                        "failed": self.failed,
+                        "unknown_shipment": self.unknown,
+                        "duplicates": self.duplicates,
+                        "last_batch_size": self.last_batch_size,
+                        "max_batch_size": self.max_batch_size,
+                        "avg_batch_size": (self.written + self.unknown + self.duplicates) / self.batches if self.batches else 0,
+                        "last_commit_ms": self.last_commit_ms,
+                        "max_commit_ms": self.max_commit_ms,
+                        "avg_commit_ms": self.total_commit_ms / self.batches if self.batches else 0,
+                        "violation_notifications": violation_notifier.stats(),
+                        "excursions": excursion_aggregator.stats()
+                }
@@ -0,0 +1,142 @@
+"""
+Shipment status transitions and archiving of delivered shipments.
+
+A shipment moves from prepared to shipped to delivered, shipped may be skipped.
+Delivered shipments older than ARCHIVE_AFTER have their raw readings and
+rollups moved to the *_archive tables of the same database, so the hot tables
+and their indexes only grow with shipments still in use. Shipment rows stay
+where they are, items, tags and notifications reference them; reads find the
+telemetry through shipments.archived_at.
+"""
+import os
+from datetime import date, datetime, timedelta
+from sqlite3 import Connection
+from typing import Optional
+
+from constraints import constraint_cache
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+# Statuses a shipment may move to from each status
+TRANSITIONS = {
+        "prepared": {"shipped", "delivered"},
+        "shipped": {"delivered"},
+        "delivered": set(),
+}
+# A recipient only confirms receipt, every other transition is the manufacturer's
+RECIPIENT_STATUSES = {"delivered"}
+MAX_TRANSITIONS = 1000
+# Delivered shipments are archived this long after their delivery date
+ARCHIVE_AFTER = timedelta(days=int(os.environ.get("REKSTI_ARCHIVE_AFTER_DAYS", "30")))
+# Shipments archived per transaction, keeps each write lock short for the ingest writer
+ARCHIVE_CHUNK = 100
+LOOKUP_CHUNK = 500
+
+def transition_shipments(conn: Connection, shipment_codes, new_status: str, user_id: int, role: str,
+                         delivery_date: Optional[date] = None):
+        """
+        Move many shipments of one user to `new_status` in a single transaction.
+
+        Shipments the user cannot see or that cannot make the transition are
+        reported and skipped. A shipment already in `new_status` is left as it
+        is and reported without an error, so a repeated scan is harmless.
+        Delivering sets the delivery date, today when none is given; any other
+        status leaves it alone.
+
+        Returns:
+                Tuple of (per code results in input order, dict of changed shipment code to id)
+        """
+        user_column = "manufacturer_id" if role == "manufacturer" else "recipient_id"
+        codes = list(dict.fromkeys(shipment_codes))
+        shipments = {}
+        for start in range(0, len(codes), LOOKUP_CHUNK):
+                chunk = codes[start:start + LOOKUP_CHUNK]
+                for row in conn.execute(f"""
+                        SELECT shipment_code, id, status FROM shipments
+                        WHERE shipment_code IN ({','.join('?' * len(chunk))}) AND {user_column} = ?
+                """, chunk + [user_id]):
+                        shipments[row["shipment_code"]] = (row["id"], row["status"])
+
+        results = []
+        changed = {}
+        for shipment_code in shipment_codes:
+                found = shipments.get(shipment_code)
+                if found is None:
+                        results.append({"shipment_code": shipment_code, "status": None,
+                                        "error": f"Shipment with code {shipment_code} not found"})
+                elif found[1] == new_status or shipment_code in changed:
+                        results.append({"shipment_code": shipment_code, "status": new_status, "error": None})
+                elif new_status not in TRANSITIONS[found[1]]:
+                        results.append({"shipment_code": shipment_code, "status": found[1],
+                                        "error": f"Cannot change status from {found[1]} to {new_status}"})
+                else:
+                        results.append({"shipment_code": shipment_code, "status": new_status, "error": None})
+                        changed[shipment_code] = found[0]
+
+        if not changed:
+                return results, {}
+
+        if new_status == "delivered":
+                delivery_date = (delivery_date or datetime.utcnow().date()).isoformat()
+        else:
+                delivery_date = None
+        try:
+                conn.executemany(
+                        "UPDATE shipments SET status = ?, delivery_date = COALESCE(?, delivery_date) WHERE id = ?",
+                        [(new_status, delivery_date, shipment_id) for shipment_id in changed.values()])
+                conn.commit()
+        except Exception:
+                conn.rollback()
+                raise
+        return results, changed
+
+def archive_delivered(conn: Connection, now: Optional[datetime] = None, after: timedelta = ARCHIVE_AFTER) -> int:
+        """
+        Move the readings and rollups of shipments delivered more than `after`
+        ago to the archive tables, ARCHIVE_CHUNK shipments per transaction.
+        Returns the number of shipments archived.
+        """
+        cutoff = ((now or datetime.utcnow()) - after).date().isoformat()
+        archived = 0
+        while True:
+                shipment_ids = [row[0] for row in conn.execute("""
+                        SELECT id FROM shipments
+                        WHERE status = 'delivered' AND archived_at IS NULL AND delivery_date < ?
+                        LIMIT ?
+                """, (cutoff, ARCHIVE_CHUNK))]
+                if not shipment_ids:
+                        break
+
+                ids = f"({','.join('?' * len(shipment_ids))})"
+                try:
+                        conn.execute(f"""
+                                INSERT INTO temperature_logs_archive (id, shipment_id, temperature, humidity, timestamp, device_seq)
+                                SELECT id, shipment_id, temperature, humidity, timestamp, device_seq
+                                FROM temperature_logs WHERE shipment_id IN {ids}
+                        """, shipment_ids)
+                        conn.execute(f"DELETE FROM temperature_logs WHERE shipment_id IN {ids}", shipment_ids)
+                        conn.execute(f"""
+                                INSERT INTO temperature_rollups_archive (shipment_id, bucket_start, sample_count,
+                                min_temperature, max_temperature, avg_temperature,
+                                min_humidity, max_humidity, avg_humidity)
+                                SELECT shipment_id, bucket_start, sample_count,
+                                        min_temperature, max_temperature, avg_temperature,
+                                        min_humidity, max_humidity, avg_humidity
+                                FROM temperature_rollups WHERE shipment_id IN {ids}
+                        """, shipment_ids)
+                        conn.execute(f"DELETE FROM temperature_rollups WHERE shipment_id IN {ids}", shipment_ids)
+                        conn.execute(f"UPDATE shipments SET archived_at = CURRENT_TIMESTAMP WHERE id IN {ids}", shipment_ids)
+                        conn.commit()
+                except Exception:
+                        conn.rollback()
+                        raise
+
+                # Reloaded envelopes no longer exist. Until then write_batch finds archived_at itself
+                for shipment_id in shipment_ids:
+                        constraint_cache.invalidate(shipment_id)
+                archived += len(shipment_ids)
+
+        if archived:
+                logger.info("Archived telemetry of %d delivered shipments", archived)
+        return archived
@@ -0,0 +1,107 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+LOG_LEVEL = os.environ.get("REKSTI_LOG_LEVEL", "INFO").upper()
+# Records with the same logger and message template allowed per interval, the rest are counted
+RATE_LIMIT_BURST = 5
+RATE_LIMIT_INTERVAL = 60.0
+# Loggers that can fire per message, only these are rate limited
+RATE_LIMITED = ("mqtt_handler", "ingest")
+
+_configured = False
+_configure_lock = threading.Lock()
+_rate_limit = None
+
+class RateLimitFilter(logging.Filter):
+        """
+        Lets `burst` records per message template through each `interval`. How
+        many were suppressed is logged every `interval` by a background thread.
+        """
+        def __init__(self, burst: int = RATE_LIMIT_BURST, interval: float = RATE_LIMIT_INTERVAL):
+                super().__init__()
+                self.burst = burst
+                self.interval = interval
+                self._windows = {}
+                self._lock = threading.Lock()
+                self._stop = threading.Event()
+                self._thread = None
+                self.suppressed = 0
+
+        def filter(self, record: logging.LogRecord) -> bool:
+                if getattr(record, "suppressed_report", False):
+                        return True
+                key = (record.name, record.msg)
+                now = time.monotonic()
+                with self._lock:
+                        window = self._windows.get(key)
+                        if window is None or now - window[0] >= self.interval:
+                                if len(self._windows) > 1000:
+                                        self._windows = {k: w for k, w in self._windows.items()
+                                                         if now - w[0] < self.interval or w[2]}
+                                # Suppressed records of the last window wait for the next report
+                                self._windows[key] = [now, 1, window[2] if window is not None else 0]
+                                return True
+                        if window[1] < self.burst:
+                                window[1] += 1
+                                return True
+                        window[2] += 1
+                        self.suppressed += 1
+                        return False
+
+        def report(self):
+                """Log how many records of each template were suppressed since the last report."""
+                with self._lock:
+                        pending = [(key, window[2]) for key, window in self._windows.items() if window[2]]
+                        for key, _ in pending:
+                                self._windows[key][2] = 0
+                for (name, msg), count in pending:
+                        logging.getLogger(name).warning("%d more messages like %r suppressed", count, msg,
+                                                        extra={"suppressed_report": True})
+
+        def _run(self):
+                while not self._stop.wait(self.interval):
+                        self.report()
+
+        def start(self):
+                self._thread = threading.Thread(target=self._run, name="log-rate-limit", daemon=True)
+                self._thread.start()
+
+        def stop(self):
+                self._stop.set()
+                self.report()
+
+def _configure():
+        global _configured, _rate_limit
+        with _configure_lock:
+                if _configured:
+                        return
+                _configured = True
+                # Callers only enqueue, formatting and writing happen on the listener thread
+                records = queue.SimpleQueue()
+                handler = logging.handlers.QueueHandler(records)
+                output = logging.StreamHandler()
+                output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+                listener = logging.handlers.QueueListener(records, output)
+                listener.start()
+                atexit.register(listener.stop)
+                _rate_limit = RateLimitFilter()
+                _rate_limit.start()
+                # Registered after the listener, so it runs before the listener stops
+                atexit.register(_rate_limit.stop)
+
+                root = logging.getLogger("reksti")
+                root.setLevel(LOG_LEVEL)
+                root.addHandler(handler)
+                root.propagate = False
+
+def get_logger(name: str) -> logging.Logger:
+        _configure()
+        logger = logging.getLogger(f"reksti.{name}")
+        if name in RATE_LIMITED and _rate_limit not in logger.filters:
+                logger.addFilter(_rate_limit)
+        return logger
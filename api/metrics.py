@@ -0,0 +1,248 @@
+import bisect
+import functools
+import os
+import threading
+import time
+from typing import Optional
+
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+# Seconds, matching the Prometheus client defaults
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Slow query log, off unless a threshold in milliseconds is set
+SLOW_QUERY_MS = float(os.environ["REKSTI_SLOW_QUERY_MS"]) if os.environ.get("REKSTI_SLOW_QUERY_MS") else None
+
+def _escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+        if extra:
+                pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+        if value == float("inf"):
+                return "+Inf"
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+        kind = ""
+
+        def __init__(self, name: str, documentation: str, labelnames=(), registry=None):
+                self.name = name
+                self.documentation = documentation
+                self.labelnames = tuple(labelnames)
+                self._children = {}
+                self._lock = threading.Lock()
+                (registry if registry is not None else REGISTRY).register(self)
+
+        def labels(self, *values):
+                values = tuple(str(value) for value in values)
+                with self._lock:
+                        child = self._children.get(values)
+                        if child is None:
+                                child = self._children[values] = self._new_child()
+                        return child
+
+        def remove(self, *values):
+                with self._lock:
+                        self._children.pop(tuple(str(value) for value in values), None)
+
+        def _samples(self):
+                with self._lock:
+                        return list(self._children.items())
+
+        def render(self) -> list:
+                lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+                for values, child in self._samples():
+                        lines.extend(self._render_child(values, child))
+                return lines
+
+class _Value:
+        __slots__ = ("value", "_lock")
+
+        def __init__(self):
+                self.value = 0
+                self._lock = threading.Lock()
+
+        def inc(self, amount: float = 1):
+                with self._lock:
+                        self.value += amount
+
+        def set(self, value: float):
+                self.value = value
+
+class Counter(_Metric):
+        kind = "counter"
+
+        def _new_child(self):
+                return _Value()
+
+        def inc(self, amount: float = 1):
+                self.labels().inc(amount)
+
+        def _render_child(self, values, child):
+                return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"]
+
+class Gauge(_Metric):
+        """A value that is set directly, or read from `function` at scrape time."""
+        kind = "gauge"
+
+        def __init__(self, name: str, documentation: str, labelnames=(), function=None, registry=None):
+                self.function = function
+                super().__init__(name, documentation, labelnames, registry)
+
+        def _new_child(self):
+                return _Value()
+
+        def set(self, value: float):
+                self.labels().set(value)
+
+        def _samples(self):
+                if self.function is None:
+                        return super()._samples()
+                # function returns a number, or a dict of label values to numbers
+                result = self.function()
+                if not isinstance(result, dict):
+                        result = {(): result}
+                samples = []
+                for values, value in result.items():
+                        child = _Value()
+                        child.value = value
+                        samples.append((values if isinstance(values, tuple) else (values,), child))
+                return samples
+
+        def _render_child(self, values, child):
+                return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"]
+
+class _HistogramValue:
+        __slots__ = ("buckets", "counts", "sum", "_lock")
+
+        def __init__(self, buckets):
+                self.buckets = buckets
+                self.counts = [0] * (len(buckets) + 1)
+                self.sum = 0.0
+                self._lock = threading.Lock()
+
+        def observe(self, value: float):
+                index = bisect.bisect_left(self.buckets, value)
+                with self._lock:
+                        self.counts[index] += 1
+                        self.sum += value
+
+class Histogram(_Metric):
+        kind = "histogram"
+
+        def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+                self.buckets = tuple(buckets)
+                super().__init__(name, documentation, labelnames, registry)
+
+        def _new_child(self):
+                return _HistogramValue(self.buckets)
+
+        def observe(self, value: float):
+                self.labels().observe(value)
+
+        def _render_child(self, values, child):
+                with child._lock:
+                        counts = list(child.counts)
+                        total = child.sum
+                lines = []
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                        cumulative += count
+                        le = f'le="{_format_value(bound)}"'
+                        lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, values)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, values)} {cumulative}")
+                return lines
+
+class Registry:
+        def __init__(self):
+                self._metrics = []
+                self._lock = threading.Lock()
+
+        def register(self, metric: _Metric):
+                with self._lock:
+                        self._metrics.append(metric)
+
+        def render(self) -> str:
+                """Every metric in the Prometheus text exposition format."""
+                with self._lock:
+                        metrics = list(self._metrics)
+                lines = []
+                for metric in metrics:
+                        try:
+                                lines.extend(metric.render())
+                        except Exception:
+                                logger.exception("Failed to collect %s", metric.name)
+                return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+request_latency = Histogram("reksti_http_request_duration_seconds", "Time to first response byte per route",
+                            ("method", "route", "status"))
+query_latency = Histogram("reksti_db_query_seconds", "SQLite time per named statement", ("statement",))
+slow_queries = Counter("reksti_db_slow_queries_total", "Statements slower than the slow query threshold", ("statement",))
+
+def observe_query(statement: str, seconds: float):
+        query_latency.labels(statement).observe(seconds)
+        if SLOW_QUERY_MS is not None and seconds * 1000 >= SLOW_QUERY_MS:
+                slow_queries.labels(statement).inc()
+                logger.warning("Slow query %s took %.1f ms", statement, seconds * 1000)
+
+def timed(statement: Optional[str] = None):
+        """Decorator recording a function's duration under `statement`, its name by default."""
+        def decorate(fn):
+                name = statement or fn.__name__
+
+                @functools.wraps(fn)
+                def wrapper(*args, **kwargs):
+                        started = time.perf_counter()
+                        try:
+                                return fn(*args, **kwargs)
+                        finally:
+                                observe_query(name, time.perf_counter() - started)
+                return wrapper
+        return decorate
+
+class MetricsMiddleware:
+        """ASGI middleware timing every HTTP request, labelled with the route template."""
+        def __init__(self, app):
+                self.app = app
+
+        async def __call__(self, scope, receive, send):
+                if scope["type"] != "http":
+                        return await self.app(scope, receive, send)
+
+                started = time.perf_counter()
+                status_code = 500
+                recorded = False
+
+                def record():
+                        nonlocal recorded
+                        if recorded:
+                                return
+                        recorded = True
+                        route = scope.get("route")
+                        # Unmatched paths share one label so scanners cannot blow up the series count
+                        path = route.path if route is not None else "unmatched"
+                        request_latency.labels(scope["method"], path, status_code).observe(time.perf_counter() - started)
+
+                async def send_wrapper(message):
+                        nonlocal status_code
+                        if message["type"] == "http.response.start":
+                                status_code = message["status"]
+                                record()
+                        await send(message)
+
+                try:
+                        await self.app(scope, receive, send_wrapper)
+                finally:
+                        record()
+
+def render() -> str:
+        return REGISTRY.render()
@@ -0,0 +1,187 @@
+import os
+import re
+import sys
+from sqlite3 import Connection
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Queries on the request and ingest paths that must be answered through an index.
+# Parameters are only bound for EXPLAIN QUERY PLAN, their values do not matter.
+HOT_QUERIES = {
+        "products_by_manufacturer": ("SELECT * FROM products WHERE manufacturer_id = ?", (1,)),
+        "shipments_by_manufacturer": ("""
+                SELECT * FROM shipments WHERE manufacturer_id = ?
+                ORDER BY created_at DESC, id DESC LIMIT ?
+        """, (1, 50)),
+        "shipments_by_recipient": ("""
+                SELECT * FROM shipments WHERE recipient_id = ?
+                ORDER BY shipping_date DESC, id DESC LIMIT ?
+        """, (1, 50)),
+        "shipments_by_shipping_range": ("""
+                SELECT status, COUNT(*), SUM(constraints_violated) FROM shipments
+                WHERE manufacturer_id = ? AND shipping_date >= ? AND shipping_date < ?
+                GROUP BY status
+        """, (1, "", "")),
+        "shipments_by_product": ("""
+                SELECT id FROM shipments WHERE manufacturer_id = ? AND id IN (
+                        SELECT si.shipment_id FROM shipment_items si
+                        JOIN products p ON si.product_id = p.id
+                        WHERE p.product_code = ?
+                )
+        """, (1, "")),
+        "shipments_search": ("""
+                SELECT id FROM shipments WHERE manufacturer_id = ? AND id IN (
+                        SELECT rowid FROM shipments_fts WHERE shipments_fts MATCH ?
+                )
+        """, (1, '"a"*')),
+        "shipment_items_for_listing": ("""
+                SELECT si.shipment_id, si.product_id, p.name as product_name, si.quantity, si.constraints_violated
+                FROM shipment_items si
+                JOIN products p ON si.product_id = p.id
+                WHERE si.shipment_id IN (SELECT id FROM shipments WHERE manufacturer_id = ?)
+        """, (1,)),
+        "shipment_envelope": ("""
+                SELECT s.constraints_violated, si.id, p.min_temperature, p.max_temperature
+                FROM shipments s
+                LEFT JOIN shipment_items si ON si.shipment_id = s.id
+                LEFT JOIN products p ON si.product_id = p.id
+                WHERE s.id = ? AND s.archived_at IS NULL
+        """, (1,)),
+        "temperature_history": ("""
+                SELECT * FROM temperature_logs
+                WHERE shipment_id = ? AND timestamp >= ? AND timestamp <= ?
+                ORDER BY timestamp DESC LIMIT ?
+        """, (1, "", "", 1)),
+        "archived_history": ("""
+                SELECT * FROM temperature_logs_archive
+                WHERE shipment_id = ? AND timestamp >= ? AND timestamp <= ?
+                ORDER BY timestamp DESC LIMIT ?
+        """, (1, "", "", 1)),
+        "archivable_shipments": ("""
+                SELECT id FROM shipments
+                WHERE status = 'delivered' AND archived_at IS NULL AND delivery_date < ?
+                LIMIT ?
+        """, ("", 100)),
+        "fleet_snapshot": ("""
+                SELECT s.shipment_code, s.status, s.constraints_violated,
+                        lt.temperature, lt.humidity, lt.timestamp
+                FROM shipments s
+                LEFT JOIN latest_temperature lt ON lt.shipment_id = s.id
+                WHERE s.status != 'delivered' AND s.manufacturer_id = ?
+        """, (1,)),
+        "notifications_by_user": ("""
+                SELECT n.id, s.shipment_code
+                FROM notifications n
+                JOIN shipments s ON n.shipment_id = s.id
+                WHERE n.user_id = ?
+                ORDER BY n.created_at DESC
+        """, (1,)),
+        "notifications_page": ("""
+                SELECT n.id, s.shipment_code
+                FROM notifications n
+                JOIN shipments s ON n.shipment_id = s.id
+                WHERE n.user_id = ? AND (n.created_at < ? OR (n.created_at = ? AND n.id < ?))
+                ORDER BY n.created_at DESC, n.id DESC LIMIT ?
+        """, (1, "", "", 1, 50)),
+        "unread_notifications": ("""
+                SELECT n.id FROM notifications n
+                WHERE n.user_id = ? AND n.read = 0
+                ORDER BY n.created_at DESC, n.id DESC LIMIT ?
+        """, (1, 50)),
+        "unread_count": ("SELECT unread FROM unread_counts WHERE user_id = ?", (1,)),
+        "nfc_tags_by_item": ("SELECT * FROM nfc_tags WHERE shipment_item_id = ?", (1,)),
+        "nfc_tag_verification": ("""
+                SELECT nt.*, p.name as product_name, u.username as manufacturer_name, s.shipment_code
+                FROM nfc_tags nt
+                JOIN products p ON nt.product_id = p.id
+                JOIN users u ON p.manufacturer_id = u.id
+                JOIN shipment_items si ON nt.shipment_item_id = si.id
+                JOIN shipments s ON si.shipment_id = s.id
+                WHERE nt.tag_id = ?
+        """, ("",)),
+        "stored_device_seqs": ("""
+                SELECT device_seq FROM temperature_logs
+                WHERE shipment_id = ? AND device_seq IN (?, ?) AND device_seq IS NOT NULL
+        """, (1, 1, 2)),
+        "device_seq_watermarks": ("""
+                SELECT shipment_id, device_seq, compacted_before FROM device_seq_watermarks
+                WHERE shipment_id IN (?, ?)
+        """, (1, 2)),
+        "excursion_summaries": ("""
+                SELECT s.shipment_code, es.readings, es.out_of_range_seconds
+                FROM shipments s
+                LEFT JOIN excursion_stats es ON es.shipment_id = s.id AND es.shipment_item_id = 0
+                WHERE s.manufacturer_id = ?
+                ORDER BY s.created_at DESC, s.id DESC LIMIT ?
+        """, (1, 50)),
+        "nfc_tag_item": ("""
+                SELECT si.id FROM shipment_items si
+                JOIN shipments s ON si.shipment_id = s.id
+                WHERE s.shipment_code = ? AND s.manufacturer_id = ? AND si.product_id = ?
+                ORDER BY si.id LIMIT 1
+        """, ("", 1, 1)),
+}
+
+def available_migrations():
+        """(version, name, path) for every NNN_name.sql file, in version order."""
+        migrations = []
+        for filename in os.listdir(MIGRATIONS_DIR):
+                match = re.match(r"^(\d+)_(\w+)\.sql$", filename)
+                if match:
+                        migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+        return sorted(migrations)
+
+def current_version(conn: Connection) -> int:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn: Connection) -> list:
+        """
+        Apply every migration newer than the database's user_version, each in its
+        own transaction. Returns the names of the migrations applied.
+        """
+        applied = []
+        version = current_version(conn)
+        for number, name, path in available_migrations():
+                if number <= version:
+                        continue
+                with open(path, "r") as f:
+                        sql = f.read()
+                try:
+                        conn.executescript(f"BEGIN;\n{sql}\nPRAGMA user_version = {number};\nCOMMIT;")
+                except Exception:
+                        if conn.in_transaction:
+                                conn.rollback()
+                        raise
+                applied.append(f"{number:03d}_{name}")
+        return applied
+
+def check_query_plans(conn: Connection, queries: dict = HOT_QUERIES) -> dict:
+        """
+        Run EXPLAIN QUERY PLAN on each hot query.
+
+        Returns:
+                Dictionary of query name to the plan steps that scan a whole table or index
+        """
+        failures = {}
+        for name, (sql, params) in queries.items():
+                plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+                # A full text MATCH shows as a scan of the virtual table but is answered by its index
+                scans = [row[3] for row in plan if row[3].startswith("SCAN ") and not row[3].startswith("SCAN CONSTANT ROW")
+                         and "VIRTUAL TABLE INDEX" not in row[3]]
+                if scans:
+                        failures[name] = scans
+        return failures
+
+if __name__ == "__main__":
+        from database import connect
+
+        conn = connect()
+        for migration in migrate(conn):
+                print(f"Applied {migration}")
+        print(f"Schema version {current_version(conn)}")
+
+        failures = check_query_plans(conn)
+        conn.close()
+        for name, scans in failures.items():
+                print(f"{name}: {'; '.join(scans)}")
+        sys.exit(1 if failures else 0)
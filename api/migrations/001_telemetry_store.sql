@@ -0,0 +1,17 @@
+-- Append-only temperature history and its downsampled rollups
+CREATE INDEX IF NOT EXISTS idx_temperature_logs_shipment_time ON temperature_logs (shipment_id, timestamp);
+
+-- Downsampled readings for data older than the raw retention window
+CREATE TABLE IF NOT EXISTS temperature_rollups (
+        shipment_id INTEGER NOT NULL,
+        bucket_start TIMESTAMP NOT NULL,
+        sample_count INTEGER NOT NULL,
+        min_temperature REAL NOT NULL,
+        max_temperature REAL NOT NULL,
+        avg_temperature REAL NOT NULL,
+        min_humidity REAL NOT NULL,
+        max_humidity REAL NOT NULL,
+        avg_humidity REAL NOT NULL,
+        PRIMARY KEY (shipment_id, bucket_start),
+        FOREIGN KEY (shipment_id) REFERENCES shipments(id)
+);
@@ -0,0 +1,7 @@
+-- Foreign key lookups used by the listing, ingest and NFC queries
+CREATE INDEX IF NOT EXISTS idx_products_manufacturer ON products (manufacturer_id);
+CREATE INDEX IF NOT EXISTS idx_shipments_manufacturer ON shipments (manufacturer_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_shipments_recipient ON shipments (recipient_id, shipping_date);
+CREATE INDEX IF NOT EXISTS idx_shipment_items_shipment ON shipment_items (shipment_id);
+CREATE INDEX IF NOT EXISTS idx_notifications_user ON notifications (user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_nfc_tags_shipment_item ON nfc_tags (shipment_item_id);
@@ -0,0 +1,21 @@
+-- Newest reading per shipment, maintained by the ingest writer
+CREATE TABLE IF NOT EXISTS latest_temperature (
+        shipment_id INTEGER PRIMARY KEY,
+        temperature REAL NOT NULL,
+        humidity REAL NOT NULL,
+        timestamp TIMESTAMP NOT NULL,
+        FOREIGN KEY (shipment_id) REFERENCES shipments(id)
+);
+
+INSERT OR REPLACE INTO latest_temperature (shipment_id, temperature, humidity, timestamp)
+SELECT tl.shipment_id, tl.temperature, tl.humidity, tl.timestamp
+FROM temperature_logs tl
+WHERE tl.id = (
+        SELECT id FROM temperature_logs
+        WHERE shipment_id = tl.shipment_id
+        ORDER BY timestamp DESC, id DESC
+        LIMIT 1
+);
+
+-- Lets the fleet snapshot touch only shipments still in transit
+CREATE INDEX IF NOT EXISTS idx_shipments_active ON shipments (manufacturer_id) WHERE status != 'delivered';
@@ -0,0 +1,36 @@
+-- Unread notifications per user, kept in step with notifications by the triggers below
+CREATE TABLE IF NOT EXISTS unread_counts (
+        user_id INTEGER PRIMARY KEY,
+        unread INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+);
+
+INSERT OR REPLACE INTO unread_counts (user_id, unread)
+SELECT user_id, COUNT(*) FROM notifications WHERE read = 0 GROUP BY user_id;
+
+CREATE TRIGGER IF NOT EXISTS notifications_unread_insert AFTER INSERT ON notifications
+WHEN NEW.read = 0
+BEGIN
+        INSERT INTO unread_counts (user_id, unread) VALUES (NEW.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET unread = unread + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS notifications_unread_update AFTER UPDATE OF read ON notifications
+WHEN OLD.read != NEW.read
+BEGIN
+        INSERT INTO unread_counts (user_id, unread) VALUES (NEW.user_id, CASE WHEN NEW.read = 0 THEN 1 ELSE 0 END)
+        ON CONFLICT(user_id) DO UPDATE SET unread = unread + CASE WHEN NEW.read = 0 THEN 1 ELSE -1 END;
+END;
+
+CREATE TRIGGER IF NOT EXISTS notifications_unread_delete AFTER DELETE ON notifications
+WHEN OLD.read = 0
+BEGIN
+        UPDATE unread_counts SET unread = unread - 1 WHERE user_id = OLD.user_id;
+END;
+
+-- Automatic notifications carry a key so the same event is only stored once per user
+ALTER TABLE notifications ADD COLUMN dedup_key TEXT;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_notifications_dedup ON notifications (user_id, shipment_id, dedup_key)
+WHERE dedup_key IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_notifications_unread ON notifications (user_id, created_at) WHERE read = 0;
@@ -0,0 +1,4 @@
+-- Sequence number assigned by the device, a resent reading is stored only once
+ALTER TABLE temperature_logs ADD COLUMN device_seq INTEGER;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_temperature_logs_device_seq ON temperature_logs (shipment_id, device_seq)
+WHERE device_seq IS NOT NULL;
@@ -0,0 +1,19 @@
+-- Running excursion statistics, one row for the whole shipment (shipment_item_id 0) and one per item
+CREATE TABLE IF NOT EXISTS excursion_stats (
+        shipment_id INTEGER NOT NULL,
+        shipment_item_id INTEGER NOT NULL,
+        readings INTEGER NOT NULL,
+        first_at TIMESTAMP NOT NULL,
+        last_at TIMESTAMP NOT NULL,
+        last_out_of_range BOOLEAN NOT NULL,
+        out_of_range_seconds REAL NOT NULL,
+        excursions INTEGER NOT NULL,
+        peak_temperature_deviation REAL NOT NULL,
+        peak_humidity_deviation REAL NOT NULL,
+        min_temperature REAL NOT NULL,
+        max_temperature REAL NOT NULL,
+        -- Sum of exp(-dH/RT) over the readings, for mean kinetic temperature
+        kinetic_sum REAL NOT NULL,
+        PRIMARY KEY (shipment_id, shipment_item_id),
+        FOREIGN KEY (shipment_id) REFERENCES shipments(id)
+);
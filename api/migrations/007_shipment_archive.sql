@@ -0,0 +1,32 @@
+-- Set once a delivered shipment's telemetry has moved to the archive tables
+ALTER TABLE shipments ADD COLUMN archived_at TIMESTAMP;
+
+-- Lets the archiver find delivered shipments without scanning the others
+CREATE INDEX IF NOT EXISTS idx_shipments_archivable ON shipments (delivery_date)
+WHERE status = 'delivered' AND archived_at IS NULL;
+
+-- Telemetry of archived shipments, rows keep the ids they had in the hot tables
+CREATE TABLE IF NOT EXISTS temperature_logs_archive (
+        id INTEGER PRIMARY KEY,
+        shipment_id INTEGER NOT NULL,
+        temperature REAL NOT NULL,
+        humidity REAL NOT NULL,
+        timestamp TIMESTAMP,
+        device_seq INTEGER,
+        FOREIGN KEY (shipment_id) REFERENCES shipments(id)
+);
+CREATE INDEX IF NOT EXISTS idx_temperature_logs_archive_shipment_time ON temperature_logs_archive (shipment_id, timestamp);
+
+CREATE TABLE IF NOT EXISTS temperature_rollups_archive (
+        shipment_id INTEGER NOT NULL,
+        bucket_start TIMESTAMP NOT NULL,
+        sample_count INTEGER NOT NULL,
+        min_temperature REAL NOT NULL,
+        max_temperature REAL NOT NULL,
+        avg_temperature REAL NOT NULL,
+        min_humidity REAL NOT NULL,
+        max_humidity REAL NOT NULL,
+        avg_humidity REAL NOT NULL,
+        PRIMARY KEY (shipment_id, bucket_start),
+        FOREIGN KEY (shipment_id) REFERENCES shipments(id)
+);
@@ -0,0 +1,32 @@
+-- Full text index over the free text of shipments, kept in step by the triggers below
+CREATE VIRTUAL TABLE IF NOT EXISTS shipments_fts USING fts5(
+        recipient_name, recipient_address, additional_info,
+        content = 'shipments', content_rowid = 'id', tokenize = 'unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS shipments_fts_insert AFTER INSERT ON shipments BEGIN
+        INSERT INTO shipments_fts (rowid, recipient_name, recipient_address, additional_info)
+        VALUES (new.id, new.recipient_name, new.recipient_address, new.additional_info);
+END;
+
+CREATE TRIGGER IF NOT EXISTS shipments_fts_delete AFTER DELETE ON shipments BEGIN
+        INSERT INTO shipments_fts (shipments_fts, rowid, recipient_name, recipient_address, additional_info)
+        VALUES ('delete', old.id, old.recipient_name, old.recipient_address, old.additional_info);
+END;
+
+-- Status and violation updates leave the indexed text alone
+CREATE TRIGGER IF NOT EXISTS shipments_fts_update AFTER UPDATE OF recipient_name, recipient_address, additional_info
+ON shipments BEGIN
+        INSERT INTO shipments_fts (shipments_fts, rowid, recipient_name, recipient_address, additional_info)
+        VALUES ('delete', old.id, old.recipient_name, old.recipient_address, old.additional_info);
+        INSERT INTO shipments_fts (rowid, recipient_name, recipient_address, additional_info)
+        VALUES (new.id, new.recipient_name, new.recipient_address, new.additional_info);
+END;
+
+INSERT INTO shipments_fts (shipments_fts) VALUES ('rebuild');
+
+-- Shipping date ranges of a manufacturer, covering the per status and per day counts
+CREATE INDEX IF NOT EXISTS idx_shipments_manufacturer_shipping
+ON shipments (manufacturer_id, shipping_date, status, constraints_violated);
+-- Shipments containing a product
+CREATE INDEX IF NOT EXISTS idx_shipment_items_product ON shipment_items (product_id);
@@ -0,0 +1,5 @@
+-- Tokens revoked before they expire, so every worker rejects a token logged out on any of them
+CREATE TABLE IF NOT EXISTS revoked_tokens (
+        token_hash BLOB PRIMARY KEY,
+        expires_at REAL NOT NULL
+);
@@ -0,0 +1,8 @@
+-- Highest device sequence number compaction removed per shipment, and the
+-- cutoff it removed readings before, so a resent backlog is still recognized
+CREATE TABLE IF NOT EXISTS device_seq_watermarks (
+        shipment_id INTEGER PRIMARY KEY,
+        device_seq INTEGER NOT NULL,
+        compacted_before TIMESTAMP NOT NULL,
+        FOREIGN KEY (shipment_id) REFERENCES shipments(id)
+);
@@ -1,5 +1,5 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from pydantic import BaseModel, EmailStr, model_validator
+from typing import Dict, Literal, Optional, List
 from datetime import date, datetime
 
 class UserBase(BaseModel):
@@ -71,6 +71,84 @@ class ShipmentResponse(BaseModel):
         items: List[ShipmentItem]
         additional_info: Optional[str] = None
 
+class DailyShipments(BaseModel):
+        date: date
+        shipments: int
+        violated: int
+
+class ShipmentSummary(BaseModel):
+        total: int
+        violated: int
+        violation_rate: float
+        by_status: Dict[str, int]
+        # Newest day first
+        by_day: List[DailyShipments]
+
+class ExcursionStats(BaseModel):
+        readings: int
+        first_reading_at: Optional[datetime] = None
+        last_reading_at: Optional[datetime] = None
+        minutes_out_of_range: float
+        excursions: int
+        out_of_range: bool
+        peak_temperature_deviation: float
+        peak_humidity_deviation: float
+        min_temperature: Optional[float] = None
+        max_temperature: Optional[float] = None
+        mean_kinetic_temperature: Optional[float] = None
+
+class ItemExcursions(ExcursionStats):
+        product_id: int
+        product_name: str
+        quantity: int
+        min_temperature_limit: Optional[float] = None
+        max_temperature_limit: Optional[float] = None
+        min_humidity_limit: Optional[float] = None
+        max_humidity_limit: Optional[float] = None
+
+class ShipmentExcursions(ExcursionStats):
+        shipment_code: str
+        items: List[ItemExcursions]
+
+class ExcursionSummary(ExcursionStats):
+        shipment_code: str
+        status: str
+        constraints_violated: bool
+
+class BulkShipmentResult(BaseModel):
+        index: int
+        shipment: Optional[ShipmentResponse] = None
+        error: Optional[str] = None
+
+class BulkShipmentResponse(BaseModel):
+        created: int
+        failed: int
+        results: List[BulkShipmentResult]
+
+class ShipmentStatusUpdate(BaseModel):
+        status: Literal["shipped", "delivered"]
+        # Today when delivering without one
+        delivery_date: Optional[date] = None
+
+        @model_validator(mode="after")
+        def delivery_date_when_delivered(self):
+                if self.delivery_date is not None and self.status != "delivered":
+                        raise ValueError("delivery_date is only accepted with status delivered")
+                return self
+
+class BulkShipmentStatusUpdate(ShipmentStatusUpdate):
+        shipment_codes: List[str]
+
+class ShipmentStatusResult(BaseModel):
+        shipment_code: str
+        status: Optional[str] = None
+        error: Optional[str] = None
+
+class BulkShipmentStatusResponse(BaseModel):
+        updated: int
+        failed: int
+        results: List[ShipmentStatusResult]
+
 class NFCTagVerification(BaseModel):
         tag_id: str
 
@@ -80,10 +158,36 @@ class NFCTagResponse(BaseModel):
         manufacturer: Optional[str] = None
         shipment_code: Optional[str] = None
 
+class NFCTagBatchVerification(BaseModel):
+        tag_ids: List[str]
+
+class NFCTagBatchResult(NFCTagResponse):
+        tag_id: str
+
+class NFCReceiveResponse(BaseModel):
+        tags: List[NFCTagBatchResult]
+        shipments: List[ShipmentStatusResult]
+
+class NFCTagRegistration(BaseModel):
+        product_id: int
+        tag_ids: List[str]
+
+class NFCTagRegistrationResponse(BaseModel):
+        shipment_code: str
+        product_id: int
+        registered: int
+
 class NotificationCreate(BaseModel):
         shipment_code: str
         message: str
 
+class NotificationMarkRead(BaseModel):
+        # Every unread notification when omitted
+        ids: Optional[List[int]] = None
+
+class UnreadCountResponse(BaseModel):
+        unread: int
+
 class NotificationResponse(BaseModel):
         id: int
         user_id: int
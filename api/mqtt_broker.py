@@ -0,0 +1,296 @@
+"""
+A minimal MQTT 3.1.1 broker for running the API and the benchmarks offline.
+
+It keeps everything in memory and speaks just enough of the protocol for paho:
+CONNECT, PUBLISH (QoS 0 to 2 in, always QoS 0 out), retained messages,
+SUBSCRIBE and UNSUBSCRIBE with + and # wildcards, $share/{group}/{filter}
+shared subscriptions, PINGREQ and DISCONNECT. It is not meant for production.
+
+        python mqtt_broker.py --port 1883
+"""
+import argparse
+import asyncio
+import itertools
+import threading
+from typing import Optional
+
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+        filter_levels = topic_filter.split("/")
+        topic_levels = topic.split("/")
+        # Wildcards never match topics starting with $
+        if topic.startswith("$") and filter_levels[0] in ("+", "#"):
+                return False
+        for index, level in enumerate(filter_levels):
+                if level == "#":
+                        return True
+                if index >= len(topic_levels) or (level != "+" and level != topic_levels[index]):
+                        return False
+        return len(filter_levels) == len(topic_levels)
+
+def encode_length(length: int) -> bytes:
+        encoded = bytearray()
+        while True:
+                digit, length = length % 128, length // 128
+                encoded.append(digit | 0x80 if length else digit)
+                if not length:
+                        return bytes(encoded)
+
+def encode_string(value: str) -> bytes:
+        data = value.encode("utf-8")
+        return len(data).to_bytes(2, "big") + data
+
+def packet(kind: int, flags: int, body: bytes = b"") -> bytes:
+        return bytes([kind << 4 | flags]) + encode_length(len(body)) + body
+
+class _Reader:
+        def __init__(self, data: bytes):
+                self.data = data
+                self.offset = 0
+
+        def u8(self) -> int:
+                self.offset += 1
+                return self.data[self.offset - 1]
+
+        def u16(self) -> int:
+                self.offset += 2
+                return int.from_bytes(self.data[self.offset - 2:self.offset], "big")
+
+        def string(self) -> str:
+                return self.binary().decode("utf-8")
+
+        def binary(self) -> bytes:
+                length = self.u16()
+                self.offset += length
+                return self.data[self.offset - length:self.offset]
+
+        def rest(self) -> bytes:
+                return self.data[self.offset:]
+
+        def done(self) -> bool:
+                return self.offset >= len(self.data)
+
+class _Session:
+        def __init__(self, client_id: str, writer: asyncio.StreamWriter):
+                self.client_id = client_id
+                self.writer = writer
+                self.subscriptions = set()
+
+        def send(self, data: bytes):
+                if not self.writer.is_closing():
+                        self.writer.write(data)
+
+class LocalBroker:
+        """Runs on its own event loop thread, start() returns once it is listening."""
+        def __init__(self, host: str = "127.0.0.1", port: int = 1883):
+                self.host = host
+                self.port = port
+                self.published = 0
+                self.delivered = 0
+                self._sessions = {}
+                # Shared group and filter to members, and a counter for round robin
+                self._shared = {}
+                self._retained = {}
+                self._loop = None
+                self._server = None
+                self._thread = None
+                self._ready = threading.Event()
+                self._error = None
+
+        def start(self):
+                self._thread = threading.Thread(target=self._run, name="mqtt-broker", daemon=True)
+                self._thread.start()
+                self._ready.wait()
+                if self._error is not None:
+                        raise self._error
+                logger.info("Local MQTT broker listening on %s:%s", self.host, self.port)
+
+        def stop(self):
+                if self._loop is None:
+                        return
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join(timeout=5)
+                self._loop = None
+
+        def stats(self) -> dict:
+                return {"clients": len(self._sessions), "published": self.published, "delivered": self.delivered,
+                        "retained": len(self._retained)}
+
+        def _run(self):
+                loop = asyncio.new_event_loop()
+                try:
+                        self._server = loop.run_until_complete(asyncio.start_server(self._serve, self.host, self.port))
+                except OSError as e:
+                        self._error = e
+                        self._ready.set()
+                        loop.close()
+                        return
+                self.port = self._server.sockets[0].getsockname()[1]
+                self._loop = loop
+                self._ready.set()
+                try:
+                        loop.run_forever()
+                finally:
+                        self._server.close()
+                        for session in list(self._sessions.values()):
+                                session.writer.close()
+                        # Closed connections end their readers, let the client tasks finish
+                        tasks = asyncio.all_tasks(loop)
+                        if tasks:
+                                loop.run_until_complete(asyncio.wait(tasks, timeout=1))
+                        loop.close()
+
+        async def _read_packet(self, reader: asyncio.StreamReader):
+                header = (await reader.readexactly(1))[0]
+                length, multiplier = 0, 1
+                while True:
+                        digit = (await reader.readexactly(1))[0]
+                        length += (digit & 0x7F) * multiplier
+                        if not digit & 0x80:
+                                break
+                        multiplier *= 128
+                        if multiplier > 128 ** 3:
+                                raise ValueError("malformed remaining length")
+                return header >> 4, header & 0x0F, await reader.readexactly(length)
+
+        async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+                session = None
+                try:
+                        kind, _, body = await self._read_packet(reader)
+                        if kind != CONNECT:
+                                return
+                        session = self._connect(body, writer)
+                        if session is None:
+                                return
+                        while True:
+                                kind, flags, body = await self._read_packet(reader)
+                                if kind == DISCONNECT:
+                                        break
+                                self._handle(session, kind, flags, body)
+                                await writer.drain()
+                except (asyncio.IncompleteReadError, ConnectionError, ValueError, IndexError, UnicodeDecodeError):
+                        pass
+                finally:
+                        if session is not None and self._sessions.get(session.client_id) is session:
+                                self._drop(session)
+                        writer.close()
+
+        def _connect(self, body: bytes, writer: asyncio.StreamWriter) -> Optional[_Session]:
+                data = _Reader(body)
+                data.string()
+                level = data.u8()
+                flags = data.u8()
+                data.u16()
+                if level not in (3, 4):
+                        # Only 3.1 and 3.1.1, MQTT 5 adds properties this broker does not parse
+                        writer.write(packet(CONNACK, 0, b"\x00\x01"))
+                        return None
+                client_id = data.string() or f"anonymous-{id(writer)}"
+                if flags & 0x04:
+                        data.string()
+                        data.binary()
+                # Same client id takes over the existing session, like a real broker does
+                previous = self._sessions.get(client_id)
+                if previous is not None:
+                        self._drop(previous)
+                        previous.writer.close()
+                session = self._sessions[client_id] = _Session(client_id, writer)
+                writer.write(packet(CONNACK, 0, b"\x00\x00"))
+                return session
+
+        def _handle(self, session: _Session, kind: int, flags: int, body: bytes):
+                data = _Reader(body)
+                if kind == PUBLISH:
+                        qos = (flags >> 1) & 0x03
+                        topic = data.string()
+                        packet_id = data.u16() if qos else None
+                        payload = data.rest()
+                        if qos == 1:
+                                session.send(packet(PUBACK, 0, packet_id.to_bytes(2, "big")))
+                        elif qos == 2:
+                                session.send(packet(PUBREC, 0, packet_id.to_bytes(2, "big")))
+                        if flags & 0x01:
+                                if payload:
+                                        self._retained[topic] = payload
+                                else:
+                                        self._retained.pop(topic, None)
+                        self.publish(topic, payload)
+                elif kind == PUBREL:
+                        session.send(packet(PUBCOMP, 0, body[:2]))
+                elif kind == SUBSCRIBE:
+                        packet_id = data.u16()
+                        granted = bytearray()
+                        while not data.done():
+                                topic_filter = data.string()
+                                data.u8()
+                                self._subscribe(session, topic_filter)
+                                granted.append(0)
+                        session.send(packet(SUBACK, 0, packet_id.to_bytes(2, "big") + bytes(granted)))
+                elif kind == UNSUBSCRIBE:
+                        packet_id = data.u16()
+                        while not data.done():
+                                self._unsubscribe(session, data.string())
+                        session.send(packet(UNSUBACK, 0, packet_id.to_bytes(2, "big")))
+                elif kind == PINGREQ:
+                        session.send(packet(PINGRESP, 0))
+
+        def _subscribe(self, session: _Session, topic_filter: str):
+                session.subscriptions.add(topic_filter)
+                if topic_filter.startswith("$share/"):
+                        _, group, shared_filter = topic_filter.split("/", 2)
+                        members, _ = self._shared.setdefault((group, shared_filter), ([], itertools.count()))
+                        if session not in members:
+                                members.append(session)
+                        return
+                for topic, payload in self._retained.items():
+                        if topic_matches(topic_filter, topic):
+                                session.send(self._message(topic, payload, retain=True))
+
+        def _unsubscribe(self, session: _Session, topic_filter: str):
+                session.subscriptions.discard(topic_filter)
+                if topic_filter.startswith("$share/"):
+                        _, group, shared_filter = topic_filter.split("/", 2)
+                        entry = self._shared.get((group, shared_filter))
+                        if entry is not None and session in entry[0]:
+                                entry[0].remove(session)
+                                if not entry[0]:
+                                        del self._shared[(group, shared_filter)]
+
+        def _drop(self, session: _Session):
+                for topic_filter in list(session.subscriptions):
+                        self._unsubscribe(session, topic_filter)
+                self._sessions.pop(session.client_id, None)
+
+        def _message(self, topic: str, payload: bytes, retain: bool = False) -> bytes:
+                return packet(PUBLISH, 0x01 if retain else 0, encode_string(topic) + payload)
+
+        def publish(self, topic: str, payload: bytes):
+                """Deliver to every matching subscriber, and to one member of each matching shared group."""
+                self.published += 1
+                message = self._message(topic, payload)
+                for session in list(self._sessions.values()):
+                        if any(not f.startswith("$share/") and topic_matches(f, topic) for f in session.subscriptions):
+                                session.send(message)
+                                self.delivered += 1
+                for (_, shared_filter), (members, turn) in list(self._shared.items()):
+                        if members and topic_matches(shared_filter, topic):
+                                members[next(turn) % len(members)].send(message)
+                                self.delivered += 1
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=1883)
+        args = parser.parse_args()
+        broker = LocalBroker(args.host, args.port)
+        broker.start()
+        try:
+                threading.Event().wait()
+        except KeyboardInterrupt:
+                broker.stop()
@@ -1,96 +1,244 @@
 import json
+import math
+import os
+import socket
+import time
+import zlib
 import paho.mqtt.client as mqqt
+from constraints import constraint_cache
 from database import get_db
+from frames import decode_frame, device_timestamp, is_frame
+from ingest import IngestQueue, IngestWriter
+from logs import get_logger
+from metrics import Counter, Gauge
+from readings_cache import latest_readings
+from streaming import stream_hub
+from telemetry import query_readings
+
+MQTT_HOST = os.environ.get("REKSTI_MQTT_HOST", "broker.emqx.io")
+MQTT_PORT = int(os.environ.get("REKSTI_MQTT_PORT", "1883"))
+MQTT_USERNAME = os.environ.get("REKSTI_MQTT_USERNAME")
+MQTT_PASSWORD = os.environ.get("REKSTI_MQTT_PASSWORD")
+# Unique per process by default, workers sharing a client id kick each other off the broker
+MQTT_CLIENT_ID = os.environ.get("REKSTI_MQTT_CLIENT_ID") or f"reksti-gres-{socket.gethostname()}-{os.getpid()}"
+# Devices publish to DATA_TOPIC, or to DATA_TOPIC/{shipment_id}
+DATA_TOPIC = os.environ.get("REKSTI_MQTT_TOPIC", "/REKSTI/data")
+# Workers subscribed under the same group get a share of the messages each
+SHARED_GROUP = os.environ.get("REKSTI_MQTT_SHARED_GROUP")
+# Without a shared group every worker receives everything and persists only its own shard
+INGEST_SHARDS = int(os.environ.get("REKSTI_INGEST_SHARDS", "1"))
+INGEST_SHARD = int(os.environ.get("REKSTI_INGEST_SHARD", "0"))
+# Latest reading cache TTL with a shared group, other workers' readings only reach it through the database
+SHARED_CACHE_TTL = 5.0
+# Start mqtt_broker.LocalBroker in process on MQTT_PORT, for running offline
+EMBEDDED_BROKER = os.environ.get("REKSTI_MQTT_EMBEDDED") == "1"
+
+# Last message that did not belong to a shipment
+latest_general_data = None
+client = mqqt.Client(client_id=MQTT_CLIENT_ID, callback_api_version=mqqt.CallbackAPIVersion.VERSION2)
+embedded_broker = None
+# Only the ingest process subscribes, the others stay connected to publish
+subscribed = False
+ingest_queue = IngestQueue()
+ingest_writer = IngestWriter(ingest_queue)
+
+logger = get_logger(__name__)
+
+# Shipments silent for longer than this drop out of the last message age metric, in seconds
+LAST_SEEN_TTL = 60 * 60
+_last_seen = {}
+
+def _last_message_ages() -> dict:
+        now = time.monotonic()
+        for shipment_id, seen in list(_last_seen.items()):
+                if now - seen > LAST_SEEN_TTL:
+                        _last_seen.pop(shipment_id, None)
+        return {str(shipment_id): now - seen for shipment_id, seen in list(_last_seen.items())}
+
+mqtt_messages = Counter("reksti_mqtt_messages_total", "MQTT messages received")
+mqtt_unknown_shipment = Counter("reksti_mqtt_unknown_shipment_readings_total",
+                                "Readings of shipments that do not exist or are archived, dropped on arrival")
+mqtt_foreign_shard = Counter("reksti_mqtt_foreign_shard_total", "Readings left for the worker owning their shard")
+mqtt_parse_errors = Counter("reksti_mqtt_parse_errors_total", "MQTT messages that were not valid readings, JSON objects or binary frames")
+mqtt_frames = Counter("reksti_mqtt_binary_frames_total", "Binary frames received")
+mqtt_frame_readings = Counter("reksti_mqtt_binary_frame_readings_total", "Readings carried by binary frames")
+Gauge("reksti_shipment_last_message_age_seconds", "Seconds since the last reading per shipment", ("shipment_id",),
+      function=_last_message_ages)
+Gauge("reksti_ingest_queue_depth", "Readings waiting for the ingest writer", function=lambda: len(ingest_queue))
+Gauge("reksti_ingest_dropped_readings", "Readings dropped by the overload policy", function=lambda: ingest_queue.dropped)
+
+def subscriptions() -> list:
+        topics = [DATA_TOPIC, f"{DATA_TOPIC}/+"]
+        if SHARED_GROUP:
+                return [f"$share/{SHARED_GROUP}/{topic}" for topic in topics]
+        return topics
+
+def shard_of(shipment_id, shards: int) -> int:
+        # crc32 rather than hash() so every process agrees
+        return zlib.crc32(str(shipment_id).encode("utf-8")) % shards
+
+def owns_shipment(shipment_id) -> bool:
+        """Whether this worker persists the shipment's readings."""
+        if INGEST_SHARDS <= 1 or SHARED_GROUP:
+                return True
+        return shard_of(shipment_id, INGEST_SHARDS) == INGEST_SHARD
+
+def topic_shipment_id(topic: str):
+        """The shipment id of a per shipment topic, None for the shared topic."""
+        if not topic.startswith(DATA_TOPIC + "/"):
+                return None
+        suffix = topic[len(DATA_TOPIC) + 1:]
+        return int(suffix) if suffix.isdigit() else suffix or None
+
+def measurement(data: dict, key: str) -> float:
+        """A reading's temperature or humidity, 0 when the device leaves it out."""
+        value = data.get(key, 0)
+        # A bad value would fail the whole batch it is written in
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+                raise TypeError(f"{key} must be a number")
+        return float(value)
+
+def shipment_exists(shipment_id) -> bool:
+        """From the constraint cache, which only queries SQLite the first time it sees a shipment."""
+        envelope = constraint_cache.peek(shipment_id)
+        if envelope is None:
+                conn = get_db()
+                try:
+                        envelope = constraint_cache.get(conn, shipment_id)
+                finally:
+                        conn.close()
+        return envelope.exists
+
+def accept_readings(shipment_id, readings):
+        """Cache, stream and queue (temperature, humidity, timestamp, device_seq) readings of one shipment."""
+        # Made up ids from anyone on the broker must not evict cached shipments or add metric series
+        if not shipment_exists(shipment_id):
+                mqtt_unknown_shipment.inc(len(readings))
+                return
+        _last_seen[shipment_id] = time.monotonic()
+        # Persisted by the ingest writer thread, by the worker owning the shard. A backlog goes in one transaction
+        if owns_shipment(shipment_id):
+                ingest_queue.put_many([(shipment_id, *reading) for reading in readings])
+        else:
+                mqtt_foreign_shard.inc(len(readings))
+        temperature, humidity, timestamp, _ = max(readings, key=lambda reading: reading[2])
+        latest_readings.update(shipment_id, temperature, humidity, timestamp)
+        stream_hub.publish_reading(shipment_id, temperature, humidity, timestamp)
 
-# Store temperatures organized by shipment_id
-latest_temp_data = {}
-client = mqqt.Client(client_id="reksti-gres", callback_api_version=mqqt.CallbackAPIVersion.VERSION2)
-        
 def on_message(client, userdata, msg):
-        global latest_temp_data
-        payload = msg.payload.decode("utf-8")
+        global latest_general_data
+        mqtt_messages.inc()
         try:
+                if is_frame(msg.payload):
+                        shipment_id, readings = decode_frame(msg.payload)
+                        mqtt_frames.inc()
+                        mqtt_frame_readings.inc(len(readings))
+                        if readings:
+                                accept_readings(shipment_id, readings)
+                        return
+
+                payload = msg.payload.decode("utf-8")
                 data = json.loads(payload)
+                if not isinstance(data, dict):
+                        raise TypeError("payload is not an object")
+                topic_id = topic_shipment_id(msg.topic)
+                if topic_id is not None:
+                        data.setdefault("shipment_id", topic_id)
                 
                 if "shipment_id" in data:
                         shipment_id = data['shipment_id']
-                        # Update in-memory cache
-                        latest_temp_data[shipment_id] = data
-                        temperature = data.get('temperature', 0)
-                        humidity = data.get('humidity', 0)
-                        
-                        conn = get_db()
-                        cursor = conn.cursor()
-                        
-                        # Check if this shipment already has a temperature log
-                        cursor.execute("SELECT id FROM temperature_logs WHERE shipment_id = ? ORDER BY timestamp DESC LIMIT 1", 
-                                      (shipment_id,))
-                        existing_log = cursor.fetchone()
-                        
-                        if existing_log:
-                                # Update existing record
-                                cursor.execute("""
-                                        UPDATE temperature_logs 
-                                        SET temperature = ?, humidity = ?, timestamp = CURRENT_TIMESTAMP 
-                                        WHERE id = ?
-                                """, (temperature, humidity, existing_log['id']))
-                                print(f"Updated temperature log for shipment {shipment_id}: {temperature}°C, {humidity}% humidity")
-                        else:
-                                # Insert new record
-                                cursor.execute("""
-                                        INSERT INTO temperature_logs (shipment_id, temperature, humidity) 
-                                        VALUES (?, ?, ?)
-                                """, (shipment_id, temperature, humidity))
-                                print(f"Created new temperature log for shipment {shipment_id}: {temperature}°C, {humidity}% humidity")
-                        
-                        # Check and update constraint violations
-                        cursor.execute("""
-                                UPDATE shipments
-                                SET constraints_violated = 1
-                                WHERE id = ? AND (
-                                        EXISTS (
-                                                SELECT 1
-                                                FROM shipment_items si
-                                                JOIN products p ON si.product_id = p.id
-                                                WHERE si.shipment_id = shipments.id
-                                                AND (
-                                                        ? > p.max_temperature OR ? < p.min_temperature OR
-                                                        ? > p.max_humidity OR ? < p.min_humidity
-                                                )
-                                        )
-                                )
-                        """, (
-                                shipment_id, 
-                                temperature, temperature,
-                                humidity, humidity
-                        ))
-                        
-                        conn.commit()
-                        conn.close()
+                        # SQLite would store "1" under shipment 1, while every cache keys it apart from 1
+                        if type(shipment_id) is not int:
+                                raise TypeError("shipment_id must be an integer")
+                        temperature = measurement(data, 'temperature')
+                        humidity = measurement(data, 'humidity')
+                        # Device time and sequence number are optional, without them the reading is stamped on arrival
+                        timestamp = device_timestamp(data.get('timestamp'))
+                        seq = data.get('seq')
+                        if seq is not None and (isinstance(seq, bool) or not isinstance(seq, int)):
+                                raise TypeError("seq must be an integer")
+                        accept_readings(shipment_id, [(temperature, humidity, timestamp, seq)])
                 else:
                         # For messages without shipment_id, store as general data
-                        latest_temp_data["general"] = data
+                        latest_general_data = data
                         
-        except json.JSONDecodeError:
-                print("Invalid JSON received:", payload)
+        except (ValueError, TypeError):
+                mqtt_parse_errors.inc()
+                logger.warning("Invalid payload received: %r", msg.payload[:200])
                 
-def setup_mqtt():
-        client.connect("broker.emqx.io")
-        client.loop_start()
-        client.subscribe("/REKSTI/data")
+def on_connect(client, userdata, flags, reason_code, properties):
+        # Subscribing here restores the subscriptions after every reconnect
+        if reason_code.is_failure:
+                logger.error("MQTT connection to %s:%s refused: %s", MQTT_HOST, MQTT_PORT, reason_code)
+                return
+        if not subscribed:
+                logger.info("MQTT connected to %s:%s as %s, publishing only", MQTT_HOST, MQTT_PORT, MQTT_CLIENT_ID)
+                return
+        client.subscribe([(topic, 0) for topic in subscriptions()])
+        logger.info("MQTT connected to %s:%s as %s, listening on %s", MQTT_HOST, MQTT_PORT, MQTT_CLIENT_ID,
+                    ", ".join(subscriptions()))
+
+def setup_mqtt(subscribe: bool = True):
+        """Connect to the broker, and ingest what it delivers unless `subscribe` is False."""
+        global embedded_broker
+        if SHARED_GROUP:
+                latest_readings.ttl = min(latest_readings.ttl, SHARED_CACHE_TTL)
+                if INGEST_SHARDS > 1:
+                        logger.warning("REKSTI_MQTT_SHARED_GROUP already splits messages, REKSTI_INGEST_SHARDS is ignored")
+        if EMBEDDED_BROKER:
+                from mqtt_broker import LocalBroker
+                try:
+                        embedded_broker = LocalBroker(MQTT_HOST, MQTT_PORT)
+                        embedded_broker.start()
+                except OSError:
+                        # Another worker on this host already runs it
+                        embedded_broker = None
+        if subscribe:
+                subscribe_mqtt()
+        if MQTT_USERNAME:
+                client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+        client.on_connect = on_connect
         client.on_message = on_message
-        print("MQTT connected and listening on /REKSTI/data")
+        client.connect(MQTT_HOST, MQTT_PORT)
+        client.loop_start()
+
+def subscribe_mqtt():
+        """Start ingesting, on a client connected by setup_mqtt or about to be."""
+        global subscribed
+        ingest_writer.start()
+        subscribed = True
+        # Otherwise on_connect subscribes
+        if client.is_connected():
+                client.subscribe([(topic, 0) for topic in subscriptions()])
+                logger.info("MQTT listening on %s", ", ".join(subscriptions()))
+        
+def shutdown_mqtt():
+        client.loop_stop()
+        client.disconnect()
+        # Flushes readings still waiting in the queue
+        ingest_writer.stop()
+        if embedded_broker is not None:
+                embedded_broker.stop()
         
 def publish_mqqt_data(topic: str, payload: dict):
         client.publish(topic=topic, payload=json.dumps(payload))
+
+def publish_mqqt_batch(topic: str, payloads: list):
+        """Queue every payload on the client in one pass, the network loop sends them."""
+        for payload in payloads:
+                client.publish(topic=topic, payload=json.dumps(payload))
         
-def get_temp(shipment_code=None, limit=1):
+def get_temp(shipment_code=None, limit=1, start=None, end=None, resolution=None, manufacturer_id=None):
     """
     Get temperature data from the database using shipment_code
     
     Args:
             shipment_code: Optional code to filter by specific shipment
             limit: Number of records to return (default 1 for latest only)
+            start: Optional datetime, only readings at or after it
+            end: Optional datetime, only readings at or before it
+            resolution: Optional bucket width in seconds, None for raw readings
+            manufacturer_id: Without shipment_code, only this manufacturer's shipments
             
     Returns:
             Dictionary or list of temperature readings
@@ -99,57 +247,41 @@ def get_temp(shipment_code=None, limit=1):
     cursor = conn.cursor()
     
     try:
+        if shipment_code is not None and limit == 1 and start is None and end is None and resolution is None:
+            # Latest reading comes from memory, the database is only read on a miss
+            return latest_readings.get(conn, shipment_code) or {}
+
         if shipment_code is not None:
-            # Get readings for specific shipment using shipment_code
-            cursor.execute("""
-                SELECT tl.*, s.shipment_code, s.constraints_violated
-                FROM temperature_logs tl
-                JOIN shipments s ON tl.shipment_id = s.id
-                WHERE s.shipment_code = ?
-                ORDER BY tl.timestamp DESC
-                LIMIT ?
-            """, (shipment_code, limit))
-        else:
-            # Get latest reading for each shipment
-            cursor.execute("""
-                SELECT tl.*, s.shipment_code, s.constraints_violated
-                FROM temperature_logs tl
-                JOIN (
-                    SELECT shipment_id, MAX(timestamp) as max_ts
-                    FROM temperature_logs
-                    GROUP BY shipment_id
-                ) latest ON tl.shipment_id = latest.shipment_id AND tl.timestamp = latest.max_ts
-                JOIN shipments s ON tl.shipment_id = s.id
-            """)
-            
-        rows = cursor.fetchall()
-        
-        if not rows:
-            return {}
-        
-        if shipment_code is not None and limit == 1:
-            # Return single reading for specific shipment
-            if rows:
-                row = rows[0]
-                return {
-                    "shipment_code": row["shipment_code"],
-                    "temperature": row["temperature"],
-                    "humidity": row["humidity"],
-                    "timestamp": row["timestamp"],
-                    "constraints_violated": row["constraints_violated"]
-                }
-            return {}
-        else:
-            # Return list of readings
-            results = []
-            for row in rows:
-                results.append({
-                    "shipment_code": row["shipment_code"],
-                    "temperature": row["temperature"],
-                    "humidity": row["humidity"],
-                    "timestamp": row["timestamp"],
-                    "constraints_violated": row["constraints_violated"]
-                })
+            results = query_readings(conn, shipment_code, start, end, resolution, limit)
+            if not results:
+                return {}
             return results
+
+        # Latest reading for each active shipment, from the maintained snapshot table
+        query = """
+            SELECT s.shipment_code, s.status, s.constraints_violated,
+                lt.temperature, lt.humidity, lt.timestamp
+            FROM shipments s
+            LEFT JOIN latest_temperature lt ON lt.shipment_id = s.id
+            WHERE s.status != 'delivered'
+        """
+        params = ()
+        if manufacturer_id is not None:
+            query += " AND s.manufacturer_id = ?"
+            params = (manufacturer_id,)
+        cursor.execute(query, params)
+        
+        # Return list of readings, shipments without any reading yet have null values
+        results = []
+        for row in cursor.fetchall():
+            results.append({
+                "shipment_code": row["shipment_code"],
+                "status": row["status"],
+                "temperature": row["temperature"],
+                "humidity": row["humidity"],
+                "timestamp": row["timestamp"],
+                "constraints_violated": bool(row["constraints_violated"])
+            })
+        return results
     finally:
-        conn.close()
\ No newline at end of file
+        conn.close()
@@ -0,0 +1,226 @@
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+from sqlite3 import Connection
+
+from database import connect
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+# Verified tags whose details are kept in memory
+MAX_ENTRIES = 50000
+# Tags the membership filter is sized for before it has to grow
+FILTER_CAPACITY = 100000
+FILTER_ERROR_RATE = 0.01
+# How often tags registered by another process are picked up, when several processes serve
+SYNC_INTERVAL = 1.0
+MAX_BATCH_TAGS = 1000
+# Keys bound per IN (...) lookup
+LOOKUP_CHUNK = 500
+
+_TAG_DETAILS = """
+        SELECT nt.tag_id, p.name as product_name, u.username as manufacturer_name, s.shipment_code
+        FROM nfc_tags nt
+        JOIN products p ON nt.product_id = p.id
+        JOIN users u ON p.manufacturer_id = u.id
+        JOIN shipment_items si ON nt.shipment_item_id = si.id
+        JOIN shipments s ON si.shipment_id = s.id
+"""
+
+class TagAlreadyRegistered(ValueError):
+        pass
+
+class BloomFilter:
+        """Set membership with false positives but no false negatives."""
+        def __init__(self, capacity: int, error_rate: float = FILTER_ERROR_RATE):
+                self.capacity = max(capacity, 1)
+                self.error_rate = error_rate
+                self.size = max(8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+                self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+                self.count = 0
+                self._bits = bytearray((self.size + 7) // 8)
+
+        @property
+        def nbytes(self) -> int:
+                return len(self._bits)
+
+        def _positions(self, key: str):
+                digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+                first = int.from_bytes(digest[:8], "little")
+                second = int.from_bytes(digest[8:], "little") | 1
+                return [(first + i * second) % self.size for i in range(self.hashes)]
+
+        def add(self, key: str):
+                for position in self._positions(key):
+                        self._bits[position >> 3] |= 1 << (position & 7)
+                self.count += 1
+
+        def __contains__(self, key: str) -> bool:
+                return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+class TagIndex:
+        """
+        Answers NFC tag verification from memory.
+
+        Every registered tag id is in a Bloom filter, so a tag that was never
+        registered is rejected without a query. Details of verified tags are kept
+        in a bounded LRU, the rest are loaded in one query per batch.
+
+        Tags registered through this index are added to the filter at once. Tags
+        registered by another process are only added by sync, which start_sync runs
+        every SYNC_INTERVAL, so until then they are rejected as unknown.
+        """
+        def __init__(self, max_entries: int = MAX_ENTRIES, capacity: int = FILTER_CAPACITY):
+                self.max_entries = max_entries
+                self._filter = BloomFilter(capacity)
+                self._details = OrderedDict()
+                self._last_id = 0
+                self._lock = threading.Lock()
+                self._sync_stop = threading.Event()
+                self._sync_thread = None
+                self.hits = 0
+                self.rejected = 0
+                self.false_positives = 0
+                self.loaded = 0
+
+        def _store(self, row):
+                # Caller holds the lock
+                self._details[row["tag_id"]] = (row["product_name"], row["manufacturer_name"], row["shipment_code"])
+                self._details.move_to_end(row["tag_id"])
+                while len(self._details) > self.max_entries:
+                        self._details.popitem(last=False)
+
+        def _add_ids(self, conn: Connection, rows):
+                # Caller holds the lock
+                for row_id, tag_id in rows:
+                        self._filter.add(tag_id)
+                        self._last_id = max(self._last_id, row_id)
+                if self._filter.count > self._filter.capacity:
+                        self._rebuild(conn, self._filter.capacity * 2)
+
+        def _rebuild(self, conn: Connection, capacity: int):
+                # Caller holds the lock
+                self._filter = BloomFilter(capacity, self._filter.error_rate)
+                for row_id, tag_id in conn.execute("SELECT id, tag_id FROM nfc_tags"):
+                        self._filter.add(tag_id)
+                        self._last_id = max(self._last_id, row_id)
+
+        def load(self, conn: Connection) -> int:
+                """Fill the filter with every registered tag and cache the most recent ones."""
+                total = conn.execute("SELECT COUNT(*) FROM nfc_tags").fetchone()[0]
+                rows = conn.execute(f"{_TAG_DETAILS} ORDER BY nt.id DESC LIMIT ?", (self.max_entries,)).fetchall()
+                with self._lock:
+                        self._rebuild(conn, max(self._filter.capacity, total * 2))
+                        self._details.clear()
+                        for row in reversed(rows):
+                                self._store(row)
+                return total
+
+        def sync(self, conn: Connection):
+                """Pick up tags registered since the last sync, possibly by another process."""
+                with self._lock:
+                        last_id = self._last_id
+                rows = conn.execute("SELECT id, tag_id FROM nfc_tags WHERE id > ?", (last_id,)).fetchall()
+                with self._lock:
+                        self._add_ids(conn, rows)
+
+        def _run_sync(self, interval: float):
+                # Holds its own connection rather than taking a pool slot every interval
+                conn = connect()
+                try:
+                        while not self._sync_stop.wait(interval):
+                                try:
+                                        self.sync(conn)
+                                except Exception:
+                                        logger.exception("Syncing NFC tags failed")
+                finally:
+                        conn.close()
+
+        def start_sync(self, interval: float = SYNC_INTERVAL):
+                """sync in the background, so verify never has to query for a tag it does not know."""
+                self._sync_stop.clear()
+                self._sync_thread = threading.Thread(target=self._run_sync, args=(interval,), name="nfc-sync", daemon=True)
+                self._sync_thread.start()
+
+        def stop_sync(self, timeout: float = 5.0):
+                self._sync_stop.set()
+                if self._sync_thread is not None:
+                        self._sync_thread.join(timeout)
+                        self._sync_thread = None
+
+        def verify(self, conn: Connection, tag_ids: list) -> dict:
+                """
+                Look up many tags at once.
+
+                Returns:
+                        Dictionary of tag id to (product name, manufacturer, shipment code), None for unknown tags
+                """
+                results = {}
+                pending = []
+                with self._lock:
+                        for tag_id in dict.fromkeys(tag_ids):
+                                details = self._details.get(tag_id)
+                                if details is not None:
+                                        self.hits += 1
+                                        self._details.move_to_end(tag_id)
+                                        results[tag_id] = details
+                                elif tag_id in self._filter:
+                                        pending.append(tag_id)
+                                else:
+                                        results[tag_id] = None
+                                        self.rejected += 1
+
+                for start in range(0, len(pending), LOOKUP_CHUNK):
+                        chunk = pending[start:start + LOOKUP_CHUNK]
+                        rows = conn.execute(f"{_TAG_DETAILS} WHERE nt.tag_id IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                        with self._lock:
+                                self.loaded += len(rows)
+                                for row in rows:
+                                        self._store(row)
+                                        results[row["tag_id"]] = self._details[row["tag_id"]]
+                                self.false_positives += len(chunk) - len(rows)
+                        for tag_id in chunk:
+                                results.setdefault(tag_id, None)
+                return results
+
+        def register(self, conn: Connection, shipment_item_id: int, product_id: int, tag_ids: list) -> int:
+                """
+                Attach tags to a shipment item in one transaction.
+                Raises TagAlreadyRegistered with the offending ids if any already exist.
+                """
+                tag_ids = list(dict.fromkeys(tag_ids))
+                existing = []
+                for start in range(0, len(tag_ids), LOOKUP_CHUNK):
+                        chunk = tag_ids[start:start + LOOKUP_CHUNK]
+                        existing += [row[0] for row in conn.execute(
+                                f"SELECT tag_id FROM nfc_tags WHERE tag_id IN ({','.join('?' * len(chunk))})", chunk
+                        )]
+                if existing:
+                        raise TagAlreadyRegistered(existing)
+
+                try:
+                        conn.executemany("INSERT INTO nfc_tags (tag_id, product_id, shipment_item_id) VALUES (?, ?, ?)",
+                                         [(tag_id, product_id, shipment_item_id) for tag_id in tag_ids])
+                        conn.commit()
+                except Exception:
+                        conn.rollback()
+                        raise
+                self.sync(conn)
+                return len(tag_ids)
+
+        def stats(self) -> dict:
+                with self._lock:
+                        return {
+                                "tags": self._filter.count,
+                                "cached": len(self._details),
+                                "capacity": self.max_entries,
+                                "filter_bytes": self._filter.nbytes,
+                                "hits": self.hits,
+                                "rejected": self.rejected,
+                                "loaded": self.loaded,
+                                "false_positives": self.false_positives
+                        }
+
+tag_index = TagIndex()
@@ -0,0 +1,168 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from sqlite3 import Connection
+from typing import Optional
+
+from constraints import ConstraintCache, constraint_cache
+from http_cache import versions
+from responses import iso_datetime
+from shipments import decode_cursor, encode_cursor
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_MARK_READ = 1000
+# At most one automatic violation notification per shipment per window, in seconds
+NOTIFY_INTERVAL = 15 * 60
+# (shipment, window) pairs remembered as notified, the dedup key catches anything older
+MAX_NOTIFIED_WINDOWS = 10000
+
+_NOTIFICATION_COLUMNS = """
+        SELECT n.id, n.user_id, n.shipment_id, n.message, n.read, n.created_at, s.shipment_code
+        FROM notifications n
+        JOIN shipments s ON n.shipment_id = s.id
+"""
+
+def _notification_dict(row) -> dict:
+        # Shaped like NotificationResponse serializes it
+        notification = dict(row)
+        notification["read"] = bool(notification["read"])
+        notification["created_at"] = iso_datetime(notification["created_at"])
+        return notification
+
+def fetch_notifications(conn: Connection, user_id: int, limit: Optional[int] = None,
+                        cursor: Optional[str] = None, unread_only: bool = False):
+        """
+        A user's notifications newest first on (created_at, id).
+
+        Returns:
+                Tuple of (list of notification dicts, next cursor or None)
+        """
+        clauses = ["n.user_id = ?"]
+        args = [user_id]
+        if unread_only:
+                clauses.append("n.read = 0")
+        if cursor is not None:
+                created_at, last_id = decode_cursor(cursor)
+                clauses.append("(n.created_at < ? OR (n.created_at = ? AND n.id < ?))")
+                args.extend([created_at, created_at, last_id])
+
+        sql = f"{_NOTIFICATION_COLUMNS} WHERE {' AND '.join(clauses)} ORDER BY n.created_at DESC, n.id DESC"
+        if limit is not None:
+                # One extra row tells us whether another page exists
+                sql += " LIMIT ?"
+                args.append(limit + 1)
+        rows = conn.execute(sql, args).fetchall()
+
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+        return [_notification_dict(row) for row in rows], next_cursor
+
+def unread_count(conn: Connection, user_id: int) -> int:
+        row = conn.execute("SELECT unread FROM unread_counts WHERE user_id = ?", (user_id,)).fetchone()
+        return row["unread"] if row else 0
+
+def mark_read(conn: Connection, user_id: int, notification_ids: Optional[list] = None) -> int:
+        """Mark the given notifications, or all of them when no ids are given, as read."""
+        if notification_ids is None:
+                cursor = conn.execute("UPDATE notifications SET read = 1 WHERE user_id = ? AND read = 0", (user_id,))
+        else:
+                cursor = conn.execute(f"""
+                        UPDATE notifications SET read = 1
+                        WHERE user_id = ? AND read = 0 AND id IN ({','.join('?' * len(notification_ids))})
+                """, (user_id, *notification_ids))
+        conn.commit()
+        return cursor.rowcount
+
+def _window(timestamp: Optional[str], interval: int) -> int:
+        moment = datetime.fromisoformat(timestamp) if timestamp else datetime.utcnow()
+        return int((moment - datetime(1970, 1, 1)).total_seconds()) // interval
+
+class ViolationNotifier:
+        """
+        Turns out-of-bounds readings into notifications for the shipment's
+        manufacturer and recipient.
+
+        Each shipment gets at most one notification per `interval` window of reading
+        time, so a late reading still notifies for the window it belongs to. The window
+        is part of the row's dedup key, so a retried batch or a second process cannot
+        store it twice either.
+        """
+        def __init__(self, interval: int = NOTIFY_INTERVAL, cache: ConstraintCache = constraint_cache):
+                self.interval = interval
+                self.cache = cache
+                self._notified = OrderedDict()
+                self._lock = threading.Lock()
+                self.created = 0
+                self.suppressed = 0
+
+        def violations(self, conn: Connection, readings) -> dict:
+                """Newest out-of-bounds reading per shipment and window."""
+                latest = {}
+                for reading in readings:
+                        shipment_id, temperature, humidity, timestamp = reading[:4]
+                        if not self.cache.get(conn, shipment_id).fails(temperature, humidity):
+                                continue
+                        key = (shipment_id, _window(timestamp, self.interval))
+                        current = latest.get(key)
+                        if current is None or (timestamp or "") >= (current[3] or ""):
+                                latest[key] = reading
+                return latest
+
+        def notify(self, conn: Connection, readings) -> int:
+                """Store notifications for the violating readings of a batch, returns how many were created."""
+                violations = self.violations(conn, readings)
+                due = {}
+                with self._lock:
+                        for key, reading in violations.items():
+                                if key in self._notified:
+                                        self.suppressed += 1
+                                        continue
+                                due[key] = reading
+                if not due:
+                        return 0
+
+                shipment_ids = list({shipment_id for shipment_id, _ in due})
+                shipments = {row["id"]: row for row in conn.execute(f"""
+                        SELECT id, shipment_code, manufacturer_id, recipient_id FROM shipments
+                        WHERE id IN ({','.join('?' * len(shipment_ids))})
+                """, shipment_ids)}
+                rows = []
+                for (shipment_id, window), reading in sorted(due.items(), key=lambda item: item[0][1]):
+                        shipment = shipments.get(shipment_id)
+                        if shipment is None:
+                                continue
+                        _, temperature, humidity, timestamp = reading[:4]
+                        message = (f"Shipment {shipment['shipment_code']} is outside its limits: "
+                                   f"{temperature} C, {humidity}% humidity at {timestamp or 'now'} UTC")
+                        for user_id in (shipment["manufacturer_id"], shipment["recipient_id"]):
+                                if user_id is not None:
+                                        rows.append((user_id, shipment_id, message, f"violation:{window}"))
+
+                try:
+                        cursor = conn.executemany("""
+                                INSERT OR IGNORE INTO notifications (user_id, shipment_id, message, read, dedup_key)
+                                VALUES (?, ?, ?, 0, ?)
+                        """, rows)
+                        conn.commit()
+                except Exception:
+                        conn.rollback()
+                        raise
+                if cursor.rowcount:
+                        versions.bump("notifications", *{row[0] for row in rows})
+
+                with self._lock:
+                        for key in due:
+                                self._notified[key] = True
+                        self.created += cursor.rowcount
+                        while len(self._notified) > MAX_NOTIFIED_WINDOWS:
+                                self._notified.popitem(last=False)
+                return cursor.rowcount
+
+        def stats(self) -> dict:
+                with self._lock:
+                        return {"created": self.created, "suppressed": self.suppressed}
+
+violation_notifier = ViolationNotifier()
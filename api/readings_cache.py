@@ -0,0 +1,191 @@
+import threading
+import time
+from collections import OrderedDict
+from sqlite3 import Connection
+from typing import Optional
+
+# Shipments whose latest reading is kept in memory
+MAX_ENTRIES = 10000
+# Seconds an entry is trusted before it is reloaded from the database
+TTL = 10 * 60
+
+_LATEST_READING = """
+        SELECT s.id, s.shipment_code, s.status, s.constraints_violated,
+                lt.temperature, lt.humidity, lt.timestamp
+        FROM shipments s
+        LEFT JOIN latest_temperature lt ON lt.shipment_id = s.id
+"""
+
+class _Entry:
+        __slots__ = ("shipment_id", "shipment_code", "temperature", "humidity", "timestamp",
+                     "constraints_violated", "cached_at")
+
+        def __init__(self, shipment_id, shipment_code=None, temperature=None, humidity=None,
+                     timestamp=None, constraints_violated=False):
+                self.shipment_id = shipment_id
+                self.shipment_code = shipment_code
+                self.temperature = temperature
+                self.humidity = humidity
+                self.timestamp = timestamp
+                self.constraints_violated = constraints_violated
+                self.cached_at = time.monotonic()
+
+        def as_reading(self) -> Optional[dict]:
+                if self.timestamp is None:
+                        return None
+                return {
+                        "shipment_code": self.shipment_code,
+                        "temperature": self.temperature,
+                        "humidity": self.humidity,
+                        "timestamp": self.timestamp,
+                        "constraints_violated": self.constraints_violated
+                }
+
+class LatestReadingCache:
+        """
+        Newest reading per shipment, addressable by shipment id or code.
+        Least recently used entries are evicted past `max_entries`.
+        """
+        def __init__(self, max_entries: int = MAX_ENTRIES, ttl: float = TTL):
+                self.max_entries = max_entries
+                self.ttl = ttl
+                self._entries = OrderedDict()
+                self._ids_by_code = {}
+                self._lock = threading.Lock()
+                self.hits = 0
+                self.misses = 0
+                self.evictions = 0
+                self.expirations = 0
+
+        def __len__(self):
+                with self._lock:
+                        return len(self._entries)
+
+        def _store(self, entry: _Entry):
+                # Caller holds the lock
+                self._entries[entry.shipment_id] = entry
+                self._entries.move_to_end(entry.shipment_id)
+                if entry.shipment_code is not None:
+                        self._ids_by_code[entry.shipment_code] = entry.shipment_id
+                while len(self._entries) > self.max_entries:
+                        self._drop(next(iter(self._entries)))
+                        self.evictions += 1
+
+        def _drop(self, shipment_id):
+                entry = self._entries.pop(shipment_id, None)
+                if entry is not None and entry.shipment_code is not None:
+                        self._ids_by_code.pop(entry.shipment_code, None)
+
+        def _entry_from_row(self, row) -> _Entry:
+                return _Entry(row["id"], row["shipment_code"], row["temperature"], row["humidity"],
+                              row["timestamp"], bool(row["constraints_violated"]))
+
+        def register(self, shipment_id, shipment_code: str, constraints_violated: bool = False):
+                """Make a new shipment addressable by code before its first reading."""
+                with self._lock:
+                        self._store(_Entry(shipment_id, shipment_code, constraints_violated=constraints_violated))
+
+        def update(self, shipment_id, temperature, humidity, timestamp):
+                with self._lock:
+                        entry = self._entries.get(shipment_id)
+                        if entry is None:
+                                entry = _Entry(shipment_id)
+                        elif entry.timestamp is not None and timestamp is not None and timestamp < entry.timestamp:
+                                # Older than what we already have
+                                return
+                        entry.temperature = temperature
+                        entry.humidity = humidity
+                        entry.timestamp = timestamp
+                        entry.cached_at = time.monotonic()
+                        self._store(entry)
+
+        def mark_violated(self, shipment_id):
+                with self._lock:
+                        entry = self._entries.get(shipment_id)
+                        if entry is not None:
+                                entry.constraints_violated = True
+
+        def evict(self, shipment_id):
+                with self._lock:
+                        self._drop(shipment_id)
+
+        def get(self, conn: Connection, shipment_code: str) -> Optional[dict]:
+                """
+                Latest reading for a shipment, loaded from the database on a miss.
+                Returns None when the shipment is unknown or has no readings.
+                """
+                with self._lock:
+                        entry = self._entries.get(self._ids_by_code.get(shipment_code))
+                        if entry is not None and time.monotonic() - entry.cached_at > self.ttl:
+                                self._drop(entry.shipment_id)
+                                self.expirations += 1
+                                entry = None
+                        if entry is not None:
+                                self.hits += 1
+                                self._entries.move_to_end(entry.shipment_id)
+                                return entry.as_reading()
+                        self.misses += 1
+
+                row = conn.execute(f"{_LATEST_READING} WHERE s.shipment_code = ?", (shipment_code,)).fetchone()
+                if row is None:
+                        return None
+                entry = self._entry_from_row(row)
+                if row["status"] != "delivered":
+                        with self._lock:
+                                current = self._entries.get(entry.shipment_id)
+                                # A reading may have arrived while we were querying
+                                if current is not None and current.timestamp is not None and (
+                                                entry.timestamp is None or current.timestamp > entry.timestamp):
+                                        current.shipment_code = shipment_code
+                                        current.constraints_violated = current.constraints_violated or entry.constraints_violated
+                                        self._store(current)
+                                        return current.as_reading()
+                                self._store(entry)
+                return entry.as_reading()
+
+        def warm(self, conn: Connection) -> int:
+                """Load the latest reading of the most recently active undelivered shipments."""
+                rows = conn.execute(f"""
+                        {_LATEST_READING}
+                        WHERE s.status != 'delivered' AND lt.shipment_id IS NOT NULL
+                        ORDER BY lt.timestamp DESC
+                        LIMIT ?
+                """, (self.max_entries,)).fetchall()
+                with self._lock:
+                        # Oldest first so the most recently active end up least likely to be evicted
+                        for row in reversed(rows):
+                                self._store(self._entry_from_row(row))
+                return len(rows)
+
+        def evict_delivered(self, conn: Connection) -> int:
+                """Drop every cached shipment that has since been delivered."""
+                with self._lock:
+                        cached = list(self._entries)
+                delivered = []
+                for start in range(0, len(cached), 500):
+                        chunk = cached[start:start + 500]
+                        delivered += [row[0] for row in conn.execute(
+                                f"SELECT id FROM shipments WHERE status = 'delivered' AND id IN ({','.join('?' * len(chunk))})",
+                                chunk
+                        )]
+                with self._lock:
+                        for shipment_id in delivered:
+                                if shipment_id in self._entries:
+                                        self._drop(shipment_id)
+                                        self.evictions += 1
+                return len(delivered)
+
+        def stats(self) -> dict:
+                with self._lock:
+                        lookups = self.hits + self.misses
+                        return {
+                                "size": len(self._entries),
+                                "capacity": self.max_entries,
+                                "hits": self.hits,
+                                "misses": self.misses,
+                                "hit_rate": self.hits / lookups if lookups else 0,
+                                "evictions": self.evictions,
+                                "expirations": self.expirations
+                        }
+
+latest_readings = LatestReadingCache()
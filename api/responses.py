@@ -0,0 +1,50 @@
+"""
+JSON responses for large listings.
+
+FastAPI validates whatever a route returns against its response_model and then
+encodes it with the stdlib json module. For listings of thousands of rows both
+steps cost more than the query. Routes that already build rows in exactly the
+response shape can return `trusted(rows, response)` instead, which skips the
+validation; response_model still documents the route in the OpenAPI schema.
+
+orjson is used for encoding when installed, the stdlib json otherwise.
+"""
+import json
+from typing import Optional
+
+from fastapi import Response
+from fastapi.responses import JSONResponse
+
+try:
+        import orjson
+except ImportError:
+        orjson = None
+
+def dumps(content) -> bytes:
+        if orjson is None:
+                return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+class FastJSONResponse(JSONResponse):
+        """Same output as JSONResponse, encoded with orjson when available."""
+        def render(self, content) -> bytes:
+                return dumps(content)
+
+class TrustedResponse(FastJSONResponse):
+        """Content already in the shape of the route's response_model."""
+
+def trusted(content, response: Optional[Response] = None) -> TrustedResponse:
+        """
+        Return `content` without validating it. Headers and the status code set on
+        the route's injected `response`, like X-Next-Cursor, are carried over.
+        """
+        if response is None:
+                return TrustedResponse(content)
+        trusted_response = TrustedResponse(content, status_code=response.status_code or 200)
+        trusted_response.raw_headers.extend(
+                (name, value) for name, value in response.raw_headers if name != b"content-length")
+        return trusted_response
+
+def iso_datetime(value: Optional[str]) -> Optional[str]:
+        """A stored "YYYY-MM-DD HH:MM:SS" timestamp as pydantic serializes a datetime."""
+        return value.replace(" ", "T", 1) if value else value
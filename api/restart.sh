@@ -1,3 +1,2 @@
-rm reksti.db
-touch reksti.db
-uvicorn app:app --reload
\ No newline at end of file
+python migrations.py
+uvicorn app:app --reload
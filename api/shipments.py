@@ -0,0 +1,270 @@
+import base64
+import json
+import uuid
+from datetime import date, timedelta
+from sqlite3 import Connection
+from typing import Optional
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Columns a listing may be ordered by, newest first, with id as tie breaker
+SORT_COLUMNS = ("created_at", "shipping_date")
+STATUSES = ("prepared", "shipped", "delivered")
+# Days listed by shipment_summary, the most recent ones when more match
+MAX_SUMMARY_DAYS = 366
+
+MAX_BULK_SHIPMENTS = 1000
+# Keys bound per IN (...) lookup, well under SQLite's variable limit
+LOOKUP_CHUNK = 500
+
+class InvalidCursor(ValueError):
+        pass
+
+def encode_cursor(sort_value, shipment_id: int) -> str:
+        raw = json.dumps([sort_value, shipment_id]).encode("utf-8")
+        return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str):
+        try:
+                padded = cursor + "=" * (-len(cursor) % 4)
+                sort_value, shipment_id = json.loads(base64.urlsafe_b64decode(padded))
+                return sort_value, int(shipment_id)
+        except (ValueError, TypeError):
+                raise InvalidCursor(cursor)
+
+# Dates under their own names, ORDER BY would otherwise pick the alias over the column
+_SHIPMENT_COLUMNS = """
+        id, shipment_code, date(shipping_date) AS shipping_day, date(delivery_date) AS delivery_day,
+        recipient_name, recipient_address, recipient_phone, status, constraints_violated, additional_info
+"""
+
+def _shipment_dict(row) -> dict:
+        return {
+                "shipment_code": row["shipment_code"],
+                "shipping_date": row["shipping_day"],
+                "delivery_date": row["delivery_day"],
+                "recipient_name": row["recipient_name"],
+                "recipient_address": row["recipient_address"],
+                "recipient_phone": row["recipient_phone"],
+                "status": row["status"],
+                "constraints_violated": bool(row["constraints_violated"]),
+                "items": [],
+                "additional_info": row["additional_info"]
+        }
+
+def _item_dict(row) -> dict:
+        return {
+                "product_id": row["product_id"],
+                "product_name": row["product_name"],
+                "quantity": row["quantity"],
+                "constraints_violated": bool(row["constraints_violated"])
+        }
+
+def fetch_shipments(conn: Connection, where: str, params: tuple = (), order_by: str = "created_at",
+                    limit: Optional[int] = None, cursor: Optional[str] = None):
+        """
+        Load shipments matching `where` together with their items in two queries.
+
+        Rows are ordered newest first on (order_by, id). When `limit` is given the
+        returned cursor points past the last row, otherwise it is None. Shipments
+        come out exactly as ShipmentResponse serializes them, so routes can return
+        them without validation.
+
+        Returns:
+                Tuple of (list of shipment dicts, next cursor or None)
+        """
+        if order_by not in SORT_COLUMNS:
+                raise ValueError(f"Cannot order shipments by {order_by}")
+
+        clauses = [f"({where})"]
+        args = list(params)
+        if cursor is not None:
+                sort_value, last_id = decode_cursor(cursor)
+                clauses.append(f"({order_by} < ? OR ({order_by} = ? AND id < ?))")
+                args.extend([sort_value, sort_value, last_id])
+
+        selection = f"FROM shipments WHERE {' AND '.join(clauses)} ORDER BY {order_by} DESC, id DESC"
+        if limit is not None:
+                # One extra row tells us whether another page exists
+                selection += " LIMIT ?"
+                args.append(limit + 1)
+
+        cursor_obj = conn.cursor()
+        # The raw sort column for the cursor
+        cursor_obj.execute(f"SELECT {_SHIPMENT_COLUMNS}, {order_by} AS sort_value {selection}", args)
+        rows = cursor_obj.fetchall()
+
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+                rows = rows[:limit]
+                last = rows[-1]
+                next_cursor = encode_cursor(last["sort_value"], last["id"])
+
+        if not rows:
+                return [], None
+
+        shipments = {row["id"]: _shipment_dict(row) for row in rows}
+
+        # Same filter as above, so the item lookup stays a single query for any page size
+        cursor_obj.execute(f"""
+                SELECT si.shipment_id, si.product_id, p.name as product_name, si.quantity, si.constraints_violated
+                FROM shipment_items si
+                JOIN products p ON si.product_id = p.id
+                WHERE si.shipment_id IN (SELECT id {selection})
+                ORDER BY si.id
+        """, args)
+
+        for item in cursor_obj.fetchall():
+                shipment = shipments.get(item["shipment_id"])
+                if shipment is not None:
+                        shipment["items"].append(_item_dict(item))
+
+        return list(shipments.values()), next_cursor
+
+def search_query(text: str) -> Optional[str]:
+        """
+        Free text as an FTS5 query for rows containing every word, each word a
+        prefix and quoted so FTS5 syntax in the input stays literal. None for no words.
+        """
+        words = text.split()
+        if not words:
+                return None
+        return " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+def shipment_filter(user_column: str, user_id: int, status=None, shipped_from: Optional[date] = None,
+                    shipped_to: Optional[date] = None, violated: Optional[bool] = None,
+                    product_code: Optional[str] = None, recipient: Optional[str] = None,
+                    search: Optional[str] = None):
+        """
+        WHERE clause for one user's shipments narrowed by any of the filters.
+        The shipping date range is compared against the stored column, so the
+        (user, shipping_date) indexes serve it.
+
+        Returns:
+                Tuple of (where, params) for fetch_shipments and shipment_summary
+        """
+        clauses = [f"{user_column} = ?"]
+        params = [user_id]
+        if status:
+                clauses.append(f"status IN ({','.join('?' * len(status))})")
+                params.extend(status)
+        if shipped_from is not None:
+                clauses.append("shipping_date >= ?")
+                params.append(shipped_from.isoformat())
+        if shipped_to is not None:
+                clauses.append("shipping_date < ?")
+                params.append((shipped_to + timedelta(days=1)).isoformat())
+        if violated is not None:
+                clauses.append("constraints_violated = ?")
+                params.append(int(violated))
+        if product_code:
+                clauses.append("""id IN (
+                        SELECT si.shipment_id FROM shipment_items si
+                        JOIN products p ON si.product_id = p.id
+                        WHERE p.product_code = ?
+                )""")
+                params.append(product_code)
+        if recipient:
+                clauses.append("recipient_name = ?")
+                params.append(recipient)
+        terms = search_query(search) if search else None
+        if terms:
+                clauses.append("id IN (SELECT rowid FROM shipments_fts WHERE shipments_fts MATCH ?)")
+                params.append(terms)
+        return " AND ".join(clauses), tuple(params)
+
+def shipment_summary(conn: Connection, where: str, params: tuple = ()) -> dict:
+        """Counts per status and per shipping day, and the violation rate, of the shipments matching `where`."""
+        by_status = dict.fromkeys(STATUSES, 0)
+        violated = 0
+        for status, count, flagged in conn.execute(f"""
+                SELECT status, COUNT(*), SUM(constraints_violated) FROM shipments
+                WHERE {where}
+                GROUP BY status
+        """, params):
+                by_status[status] = count
+                violated += flagged or 0
+
+        by_day = [{"date": day, "shipments": count, "violated": flagged or 0} for day, count, flagged in conn.execute(f"""
+                SELECT date(shipping_date), COUNT(*), SUM(constraints_violated) FROM shipments
+                WHERE {where}
+                GROUP BY shipping_date
+                ORDER BY shipping_date DESC
+                LIMIT ?
+        """, params + (MAX_SUMMARY_DAYS,))]
+
+        total = sum(by_status.values())
+        return {
+                "total": total,
+                "violated": violated,
+                "violation_rate": violated / total if total else 0.0,
+                "by_status": by_status,
+                "by_day": by_day
+        }
+
+def _lookup(conn: Connection, sql: str, keys) -> dict:
+        """Map the first column to the second for every key, `sql` has an IN ({}) slot."""
+        keys = list(keys)
+        found = {}
+        for start in range(0, len(keys), LOOKUP_CHUNK):
+                chunk = keys[start:start + LOOKUP_CHUNK]
+                for row in conn.execute(sql.format(",".join("?" * len(chunk))), chunk):
+                        found[row[0]] = row[1]
+        return found
+
+def create_shipments(conn: Connection, shipments: list, manufacturer_id: int):
+        """
+        Insert many shipments in a single transaction.
+
+        Product codes and recipients are resolved with one IN (...) query each.
+        A shipment referencing an unknown product is reported and skipped, the
+        others are still stored.
+
+        Returns:
+                Tuple of (per shipment results in input order, dict of created shipment code to id)
+        """
+        products = _lookup(conn, "SELECT product_code, id FROM products WHERE product_code IN ({})",
+                           {item.product_code for shipment in shipments for item in shipment.items})
+        recipients = _lookup(conn, "SELECT username, id FROM users WHERE role = 'recipient' AND username IN ({})",
+                             {shipment.recipient_name for shipment in shipments})
+
+        results = []
+        accepted = []
+        for index, shipment in enumerate(shipments):
+                missing = [item.product_code for item in shipment.items if item.product_code not in products]
+                if missing:
+                        results.append({"index": index, "shipment_code": None,
+                                        "error": f"Product with code {missing[0]} not found"})
+                        continue
+                shipment_code = f"SHIP-{uuid.uuid4().hex[:8].upper()}"
+                results.append({"index": index, "shipment_code": shipment_code, "error": None})
+                accepted.append((shipment_code, shipment))
+
+        if not accepted:
+                return results, {}
+
+        try:
+                conn.executemany("""
+                        INSERT INTO shipments (shipment_code, manufacturer_id, recipient_id, recipient_name, recipient_address,
+                        recipient_phone, shipping_date, additional_info)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, [(
+                        shipment_code, manufacturer_id, recipients.get(shipment.recipient_name), shipment.recipient_name,
+                        shipment.recipient_address, shipment.recipient_phone,
+                        shipment.shipping_date, shipment.additional_info
+                ) for shipment_code, shipment in accepted])
+
+                # executemany does not report rowids, read them back by the codes just generated
+                ids = _lookup(conn, "SELECT shipment_code, id FROM shipments WHERE shipment_code IN ({})",
+                              [shipment_code for shipment_code, _ in accepted])
+                conn.executemany("INSERT INTO shipment_items (shipment_id, product_id, quantity) VALUES (?, ?, ?)", [
+                        (ids[shipment_code], products[item.product_code], item.quantity)
+                        for shipment_code, shipment in accepted for item in shipment.items
+                ])
+                conn.commit()
+        except Exception:
+                conn.rollback()
+                raise
+
+        return results, ids
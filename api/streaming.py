@@ -0,0 +1,134 @@
+import asyncio
+import threading
+from collections import deque
+
+# Violation events kept for a subscriber that is not reading; older ones are dropped
+MAX_PENDING_EVENTS = 100
+# Seconds between keep-alive comments on idle SSE streams
+HEARTBEAT_INTERVAL = 15.0
+
+class Subscription:
+        """
+        One client's view of a shipment stream. Lives on the event loop.
+
+        Readings are coalesced so a slow consumer only ever sees the newest one,
+        violation events are queued.
+        """
+        def __init__(self, shipment_id: int, shipment_code: str):
+                self.shipment_id = shipment_id
+                self.shipment_code = shipment_code
+                self.dropped_events = 0
+                self.coalesced_readings = 0
+                self._reading = None
+                self._events = deque()
+                self._wake = asyncio.Event()
+
+        def offer(self, message: dict, coalesce: bool):
+                if coalesce:
+                        if self._reading is not None:
+                                self.coalesced_readings += 1
+                        self._reading = message
+                else:
+                        if len(self._events) >= MAX_PENDING_EVENTS:
+                                self._events.popleft()
+                                self.dropped_events += 1
+                        self._events.append(message)
+                self._wake.set()
+
+        def drain(self) -> list:
+                messages = list(self._events)
+                self._events.clear()
+                if self._reading is not None:
+                        messages.append(self._reading)
+                        self._reading = None
+                self._wake.clear()
+                return messages
+
+        async def next(self, timeout=None) -> list:
+                """Wait for messages, returns an empty list if `timeout` passes first."""
+                if not self._events and self._reading is None:
+                        try:
+                                await asyncio.wait_for(self._wake.wait(), timeout)
+                        except asyncio.TimeoutError:
+                                return []
+                return self.drain()
+
+class StreamHub:
+        """
+        Fans readings and violation events out to subscribers per shipment.
+
+        publish_* may be called from any thread, delivery always happens on the
+        event loop that owns the subscriptions.
+        """
+        def __init__(self):
+                self._subscribers = {}
+                self._violated = {}
+                self._lock = threading.Lock()
+                self._loop = None
+                self.published = 0
+
+        def subscriber_count(self) -> int:
+                with self._lock:
+                        return sum(len(subs) for subs in self._subscribers.values())
+
+        def shipment_ids(self) -> list:
+                with self._lock:
+                        return list(self._subscribers)
+
+        def subscribe(self, shipment_id: int, shipment_code: str, violated: bool) -> Subscription:
+                self._loop = asyncio.get_running_loop()
+                subscription = Subscription(shipment_id, shipment_code)
+                with self._lock:
+                        self._subscribers.setdefault(shipment_id, set()).add(subscription)
+                        self._violated.setdefault(shipment_id, violated)
+                return subscription
+
+        def unsubscribe(self, subscription: Subscription):
+                with self._lock:
+                        subs = self._subscribers.get(subscription.shipment_id)
+                        if subs is None:
+                                return
+                        subs.discard(subscription)
+                        if not subs:
+                                del self._subscribers[subscription.shipment_id]
+                                self._violated.pop(subscription.shipment_id, None)
+
+        def _publish(self, shipment_id, build, coalesce: bool):
+                with self._lock:
+                        subs = self._subscribers.get(shipment_id)
+                        if not subs:
+                                return
+                        subs = list(subs)
+                        violated = self._violated.get(shipment_id, False)
+                self.published += 1
+                loop = self._loop
+                if loop is None or loop.is_closed():
+                        return
+                for subscription in subs:
+                        message = build(subscription.shipment_code, violated)
+                        loop.call_soon_threadsafe(subscription.offer, message, coalesce)
+
+        def publish_reading(self, shipment_id, temperature, humidity, timestamp):
+                self._publish(shipment_id, lambda code, violated: {
+                        "type": "reading",
+                        "shipment_code": code,
+                        "temperature": temperature,
+                        "humidity": humidity,
+                        "timestamp": timestamp,
+                        "constraints_violated": violated
+                }, coalesce=True)
+
+        def publish_violation(self, shipment_id, temperature, humidity, timestamp):
+                with self._lock:
+                        if shipment_id in self._violated:
+                                self._violated[shipment_id] = True
+                self._publish(shipment_id, lambda code, violated: {
+                        "type": "violation",
+                        "shipment_code": code,
+                        "temperature": temperature,
+                        "humidity": humidity,
+                        "timestamp": timestamp,
+                        "constraints_violated": True
+                }, coalesce=False)
+
+stream_hub = StreamHub()
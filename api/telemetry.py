@@ -0,0 +1,267 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from sqlite3 import Connection
+from typing import Optional
+
+from database import get_db
+from lifecycle import archive_delivered
+from logs import get_logger
+from metrics import timed
+from readings_cache import latest_readings
+
+logger = get_logger(__name__)
+
+# Raw readings are kept this long before being folded into rollups
+RAW_RETENTION = timedelta(hours=48)
+# Device sequence numbers looked up per query when dropping resent readings
+SEQ_LOOKUP_CHUNK = 500
+# Width of a rollup bucket in seconds
+ROLLUP_INTERVAL = 60
+# How often the retention worker compacts old readings, in seconds
+COMPACT_EVERY = 10 * 60
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+RESOLUTION_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+_retention_stop = threading.Event()
+
+def format_timestamp(value: datetime) -> str:
+        # Stored timestamps are naive UTC, as produced by CURRENT_TIMESTAMP
+        if value.tzinfo is not None:
+                value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.strftime(TIMESTAMP_FORMAT)
+
+def parse_resolution(resolution: Optional[str]) -> Optional[int]:
+        """
+        Convert a resolution such as "30s", "1m", "15m", "1h" to seconds.
+        None or "raw" means no downsampling.
+        """
+        if resolution is None or resolution == "raw":
+                return None
+        unit = RESOLUTION_UNITS.get(resolution[-1:])
+        if unit is None or not resolution[:-1].isdigit() or int(resolution[:-1]) <= 0:
+                raise ValueError(f"Invalid resolution {resolution}")
+        return int(resolution[:-1]) * unit
+
+def fresh_readings(conn: Connection, readings) -> list:
+        """
+        Drop readings whose (shipment_id, device_seq) is already stored or repeated
+        earlier in `readings`. Readings without a sequence number are always kept.
+
+        Readings compacted away are covered by device_seq_watermarks: a sequence
+        number up to the shipment's watermark, on a reading from before the
+        compaction cutoff or without a device time, is taken as already stored.
+        Newer readings below the watermark are kept, the device was reset.
+        """
+        seqs = {}
+        for reading in readings:
+                if reading[4] is not None:
+                        seqs.setdefault(reading[0], set()).add(reading[4])
+        watermarks = {}
+        shipment_ids = list(seqs)
+        for start in range(0, len(shipment_ids), SEQ_LOOKUP_CHUNK):
+                chunk = shipment_ids[start:start + SEQ_LOOKUP_CHUNK]
+                for shipment_id, device_seq, compacted_before in conn.execute(f"""
+                        SELECT shipment_id, device_seq, compacted_before FROM device_seq_watermarks
+                        WHERE shipment_id IN ({','.join('?' * len(chunk))})
+                """, chunk):
+                        watermarks[shipment_id] = (device_seq, compacted_before)
+        stored = set()
+        for shipment_id, values in seqs.items():
+                values = list(values)
+                for start in range(0, len(values), SEQ_LOOKUP_CHUNK):
+                        chunk = values[start:start + SEQ_LOOKUP_CHUNK]
+                        stored.update((shipment_id, row[0]) for row in conn.execute(f"""
+                                SELECT device_seq FROM temperature_logs
+                                WHERE shipment_id = ? AND device_seq IN ({','.join('?' * len(chunk))}) AND device_seq IS NOT NULL
+                        """, (shipment_id, *chunk)))
+
+        fresh = []
+        for reading in readings:
+                if reading[4] is not None:
+                        key = (reading[0], reading[4])
+                        if key in stored:
+                                continue
+                        watermark = watermarks.get(reading[0])
+                        if (watermark is not None and reading[4] <= watermark[0]
+                                        and (reading[3] is None or reading[3] < watermark[1])):
+                                continue
+                        stored.add(key)
+                fresh.append(reading)
+        return fresh
+
+def append_readings(conn: Connection, readings):
+        """
+        Append readings to temperature_logs in a single executemany.
+
+        Args:
+                readings: Iterable of (shipment_id, temperature, humidity, timestamp, device_seq) tuples,
+                          timestamp may be None to use the database clock, device_seq may be None
+        """
+        # A reading stored by another writer since fresh_readings ran is skipped, not an error
+        conn.executemany("""
+                INSERT INTO temperature_logs (shipment_id, temperature, humidity, timestamp, device_seq)
+                VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?)
+                ON CONFLICT (shipment_id, device_seq) WHERE device_seq IS NOT NULL DO NOTHING
+        """, readings)
+
+def update_latest(conn: Connection, readings):
+        """Keep latest_temperature pointing at the newest of `readings` for each shipment."""
+        newest = {}
+        for reading in readings:
+                current = newest.get(reading[0])
+                if current is None or (reading[3] or "") >= (current[3] or ""):
+                        newest[reading[0]] = reading
+        conn.executemany("""
+                INSERT INTO latest_temperature (shipment_id, temperature, humidity, timestamp)
+                VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+                ON CONFLICT (shipment_id) DO UPDATE SET
+                        temperature = excluded.temperature,
+                        humidity = excluded.humidity,
+                        timestamp = excluded.timestamp
+                WHERE excluded.timestamp >= latest_temperature.timestamp
+        """, [reading[:4] for reading in newest.values()])
+
+@timed()
+def compact(conn: Connection, now: Optional[datetime] = None):
+        """
+        Fold raw readings older than RAW_RETENTION into ROLLUP_INTERVAL buckets
+        and delete them from temperature_logs. Returns the number of raw rows removed.
+        """
+        now = now or datetime.utcnow()
+        cutoff = now - RAW_RETENTION
+        # Align to a bucket boundary so a bucket is never split across two runs
+        epoch_seconds = int((cutoff - datetime(1970, 1, 1)).total_seconds())
+        cutoff = datetime(1970, 1, 1) + timedelta(seconds=epoch_seconds - epoch_seconds % ROLLUP_INTERVAL)
+        cutoff = format_timestamp(cutoff)
+
+        cursor = conn.cursor()
+        cursor.execute("""
+                INSERT INTO temperature_rollups (shipment_id, bucket_start, sample_count,
+                min_temperature, max_temperature, avg_temperature,
+                min_humidity, max_humidity, avg_humidity)
+                SELECT shipment_id,
+                        datetime((CAST(strftime('%s', timestamp) AS INTEGER) / ?) * ?, 'unixepoch') AS bucket,
+                        COUNT(*), MIN(temperature), MAX(temperature), AVG(temperature),
+                        MIN(humidity), MAX(humidity), AVG(humidity)
+                FROM temperature_logs
+                WHERE timestamp < ?
+                GROUP BY shipment_id, bucket
+                ON CONFLICT (shipment_id, bucket_start) DO UPDATE SET
+                        avg_temperature = (avg_temperature * sample_count + excluded.avg_temperature * excluded.sample_count)
+                                / (sample_count + excluded.sample_count),
+                        avg_humidity = (avg_humidity * sample_count + excluded.avg_humidity * excluded.sample_count)
+                                / (sample_count + excluded.sample_count),
+                        sample_count = sample_count + excluded.sample_count,
+                        min_temperature = MIN(min_temperature, excluded.min_temperature),
+                        max_temperature = MAX(max_temperature, excluded.max_temperature),
+                        min_humidity = MIN(min_humidity, excluded.min_humidity),
+                        max_humidity = MAX(max_humidity, excluded.max_humidity)
+        """, (ROLLUP_INTERVAL, ROLLUP_INTERVAL, cutoff))
+        # Deleting the rows deletes what fresh_readings checks resent readings against
+        cursor.execute("""
+                INSERT INTO device_seq_watermarks (shipment_id, device_seq, compacted_before)
+                SELECT shipment_id, MAX(device_seq), ?
+                FROM temperature_logs
+                WHERE timestamp < ? AND device_seq IS NOT NULL
+                GROUP BY shipment_id
+                ON CONFLICT (shipment_id) DO UPDATE SET
+                        device_seq = MAX(device_seq, excluded.device_seq),
+                        compacted_before = excluded.compacted_before
+        """, (cutoff, cutoff))
+        cursor.execute("DELETE FROM temperature_logs WHERE timestamp < ?", (cutoff,))
+        removed = cursor.rowcount
+        conn.commit()
+        return removed
+
+def _retention_loop():
+        while not _retention_stop.wait(COMPACT_EVERY):
+                conn = get_db()
+                try:
+                        compact(conn)
+                        archive_delivered(conn)
+                        latest_readings.evict_delivered(conn)
+                except Exception:
+                        # Try again next round rather than losing the worker
+                        logger.exception("Telemetry retention failed")
+                finally:
+                        conn.close()
+
+def start_retention_worker():
+        _retention_stop.clear()
+        thread = threading.Thread(target=_retention_loop, name="telemetry-retention", daemon=True)
+        thread.start()
+        return thread
+
+def stop_retention_worker():
+        _retention_stop.set()
+
+def query_readings(conn: Connection, shipment_code: str, start: Optional[datetime] = None,
+                   end: Optional[datetime] = None, resolution: Optional[int] = None, limit: int = 1):
+        """
+        Readings for one shipment, newest first, from both raw logs and rollups,
+        or their archive tables once the shipment is archived.
+
+        With a resolution (in seconds) readings are grouped into buckets of that
+        width and carry min/max/avg values, otherwise raw readings are returned
+        and rolled-up minutes appear as a single averaged reading.
+        """
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, shipment_code, constraints_violated, archived_at FROM shipments WHERE shipment_code = ?",
+                       (shipment_code,))
+        shipment = cursor.fetchone()
+        if not shipment:
+                return []
+
+        start = format_timestamp(start) if start else "0000-00-00 00:00:00"
+        end = format_timestamp(end) if end else "9999-12-31 23:59:59"
+        args = (shipment["id"], start, end, shipment["id"], start, end)
+        suffix = "_archive" if shipment["archived_at"] else ""
+        samples = f"""
+                SELECT timestamp AS ts, temperature AS min_t, temperature AS max_t, temperature AS avg_t,
+                        humidity AS min_h, humidity AS max_h, humidity AS avg_h, 1 AS n, id AS seq
+                FROM temperature_logs{suffix}
+                WHERE shipment_id = ? AND timestamp >= ? AND timestamp <= ?
+                UNION ALL
+                SELECT bucket_start, min_temperature, max_temperature, avg_temperature,
+                        min_humidity, max_humidity, avg_humidity, sample_count, 0
+                FROM temperature_rollups{suffix}
+                WHERE shipment_id = ? AND bucket_start >= ? AND bucket_start <= ?
+        """
+
+        if resolution is None:
+                cursor.execute(f"""
+                        SELECT ts, avg_t, avg_h FROM ({samples})
+                        ORDER BY ts DESC, seq DESC
+                        LIMIT ?
+                """, args + (limit,))
+                return [{
+                        "shipment_code": shipment["shipment_code"],
+                        "temperature": row["avg_t"],
+                        "humidity": row["avg_h"],
+                        "timestamp": row["ts"],
+                        "constraints_violated": bool(shipment["constraints_violated"])
+                } for row in cursor.fetchall()]
+
+        cursor.execute(f"""
+                SELECT datetime((CAST(strftime('%s', ts) AS INTEGER) / ?) * ?, 'unixepoch') AS bucket,
+                        MIN(min_t) AS min_t, MAX(max_t) AS max_t, SUM(avg_t * n) / SUM(n) AS avg_t,
+                        MIN(min_h) AS min_h, MAX(max_h) AS max_h, SUM(avg_h * n) / SUM(n) AS avg_h,
+                        SUM(n) AS n
+                FROM ({samples})
+                GROUP BY bucket
+                ORDER BY bucket DESC
+                LIMIT ?
+        """, (resolution, resolution) + args + (limit,))
+        return [{
+                "shipment_code": shipment["shipment_code"],
+                "temperature": row["avg_t"],
+                "humidity": row["avg_h"],
+                "min_temperature": row["min_t"],
+                "max_temperature": row["max_t"],
+                "min_humidity": row["min_h"],
+                "max_humidity": row["max_h"],
+                "sample_count": row["n"],
+                "timestamp": row["bucket"],
+                "constraints_violated": bool(shipment["constraints_violated"])
+        } for row in cursor.fetchall()]
@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+
+import pytest
+
+# Tests import the api modules the same way app.py does
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if API_DIR not in sys.path:
+        sys.path.insert(0, API_DIR)
+
+import database
+
+def reset_state():
+        """Empty the in-memory singletons, each test starts from its own database."""
+        from auth import token_cache
+        from constraints import constraint_cache
+        from excursions import excursion_aggregator
+        from http_cache import response_cache, versions
+        from nfc import tag_index
+        from notifications import violation_notifier
+        from readings_cache import latest_readings
+        from streaming import stream_hub
+
+        for singleton in (token_cache, constraint_cache, excursion_aggregator, response_cache, versions, tag_index,
+                          violation_notifier, latest_readings, stream_hub):
+                singleton.__init__()
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+        """A connection to a fresh, fully migrated database."""
+        # init_db reads schema.sql relative to the working directory
+        monkeypatch.chdir(API_DIR)
+        monkeypatch.setattr(database, "DATABASE", str(tmp_path / "test.db"))
+        database.init_db()
+        reset_state()
+        conn = database.connect()
+        yield conn
+        conn.close()
+        database.close_pool()
+
+def add_user(conn, username: str, role: str) -> int:
+        user_id = conn.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, 'x', ?)",
+                               (username, f"{username}@example.com", role)).lastrowid
+        conn.commit()
+        return user_id
+
+def add_shipment(conn, code: str, manufacturer_id: int, recipient_id=None, max_temperature=None,
+                 shipping_date: str = "2026-01-01") -> int:
+        """A prepared shipment of one item, of a product limited to `max_temperature` when given."""
+        shipment_id = conn.execute("""
+                INSERT INTO shipments (shipment_code, manufacturer_id, recipient_id, recipient_name, recipient_address,
+                recipient_phone, shipping_date)
+                VALUES (?, ?, ?, 'Recipient', 'Address', '0800', ?)
+        """, (code, manufacturer_id, recipient_id, shipping_date)).lastrowid
+        product_id = conn.execute("""
+                INSERT INTO products (product_code, manufacturer_id, name, max_temperature) VALUES (?, ?, 'Vaccine', ?)
+        """, (f"PROD-{code}", manufacturer_id, max_temperature)).lastrowid
+        conn.execute("INSERT INTO shipment_items (shipment_id, product_id, quantity) VALUES (?, ?, 1)",
+                     (shipment_id, product_id))
+        conn.commit()
+        return shipment_id
+
+@pytest.fixture
+def manufacturer(conn) -> int:
+        return add_user(conn, "maker", "manufacturer")
+
+@pytest.fixture
+def recipient(conn) -> int:
+        return add_user(conn, "receiver", "recipient")
+
+@pytest.fixture
+def client(conn):
+        """The app without its startup, so no broker or background worker is involved."""
+        from fastapi.testclient import TestClient
+
+        import app
+
+        return TestClient(app.app)
+
+def headers(user_id: int, role: str) -> dict:
+        from auth import create_token
+
+        token = create_token({"sub": f"user{user_id}", "user_id": user_id, "role": role})
+        return {"Authorization": f"Bearer {token}"}
+
+def wait_for(condition, timeout: float = 5.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+                assert time.monotonic() < deadline, "timed out"
+                time.sleep(0.02)
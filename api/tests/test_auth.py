@@ -0,0 +1,19 @@
+from auth import token_cache
+from conftest import headers
+
+def test_logout_outlives_a_restart(conn, client, manufacturer):
+        auth = headers(manufacturer, "manufacturer")
+        assert client.post("/api/logout", headers=auth).status_code == 200
+        assert client.get("/api/products", headers=auth).status_code == 401
+
+        # What startup does with a fresh process
+        token_cache.__init__()
+        token_cache.sync(conn)
+        assert client.get("/api/products", headers=auth).status_code == 401
+
+def test_logout_keeps_other_tokens(conn, client, manufacturer):
+        first, second = headers(manufacturer, "manufacturer"), headers(manufacturer, "manufacturer")
+        client.post("/api/logout", headers=first)
+        token_cache.__init__()
+        token_cache.sync(conn)
+        assert client.get("/api/products", headers=second).status_code == 200
@@ -0,0 +1,41 @@
+import constraints
+from conftest import add_shipment
+from constraints import ConstraintCache, evaluate_readings, known_readings
+
+def test_unknown_shipments_are_bounded_and_expire(conn, manufacturer, monkeypatch):
+        shipment_id = add_shipment(conn, "SHIP-1", manufacturer, max_temperature=8.0)
+        cache = ConstraintCache(max_entries=10, max_missing=3)
+        assert cache.get(conn, shipment_id).exists
+        # A flood of made up ids only cycles through the unknown entries
+        for unknown in range(1000, 1100):
+                assert not cache.get(conn, unknown).exists
+        assert len(cache) == 1 + 3
+        assert cache.get(conn, shipment_id).exists
+
+        assert known_readings(conn, [(1099, 5.0, 50.0, None, None)], cache) == []
+        conn.execute("""
+                INSERT INTO shipments (id, shipment_code, manufacturer_id, recipient_name, recipient_address,
+                recipient_phone, shipping_date)
+                VALUES (1099, 'SHIP-LATE', ?, 'Recipient', 'Address', '0800', '2026-01-01')
+        """, (manufacturer,))
+        conn.commit()
+        monkeypatch.setattr(constraints, "MISSING_TTL", 0.0)
+        assert len(known_readings(conn, [(1099, 5.0, 50.0, None, None)], cache)) == 1
+
+def test_existing_shipments_evicted_least_recently_used(conn, manufacturer):
+        shipment_ids = [add_shipment(conn, f"SHIP-{i}", manufacturer) for i in range(3)]
+        cache = ConstraintCache(max_entries=2)
+        for shipment_id in shipment_ids:
+                cache.get(conn, shipment_id)
+        assert len(cache) == 2
+
+def test_flags_written_once(conn, manufacturer):
+        shipment_id = add_shipment(conn, "SHIP-1", manufacturer, max_temperature=8.0)
+        cache = ConstraintCache()
+        flipped, changed = evaluate_readings(conn, [(shipment_id, 5.0, 50.0, None, None),
+                                                    (shipment_id, 9.0, 50.0, "t1", None),
+                                                    (shipment_id, 10.0, 50.0, "t2", None)], cache)
+        conn.commit()
+        assert flipped == {shipment_id: (shipment_id, 9.0, 50.0, "t1", None)} and changed == {shipment_id}
+        assert conn.execute("SELECT constraints_violated FROM shipment_items").fetchone()[0] == 1
+        assert evaluate_readings(conn, [(shipment_id, 11.0, 50.0, "t3", None)], cache) == ({}, set())
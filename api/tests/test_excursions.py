@@ -0,0 +1,43 @@
+import time
+from datetime import datetime, timedelta
+
+from conftest import add_shipment, headers, wait_for
+from excursions import excursion_aggregator
+from ingest import IngestQueue, IngestWriter
+from telemetry import format_timestamp
+
+def test_statistics_saved_once_ingest_goes_quiet(conn, client, manufacturer, monkeypatch):
+        add_shipment(conn, "SHIP-1", manufacturer, max_temperature=8.0)
+        monkeypatch.setattr(excursion_aggregator, "save_interval", 0.5)
+        excursion_aggregator._last_save = time.monotonic()
+        queue = IngestQueue()
+        writer = IngestWriter(queue, flush_interval=0.05)
+        writer.start()
+        try:
+                now = datetime.utcnow()
+                queue.put_many([(1, 5.0, 50.0, format_timestamp(now - timedelta(minutes=4 - i)), None) for i in range(4)])
+                wait_for(lambda: writer.written == 4)
+                # No more readings, only the idle writer can save them
+                time.sleep(1.0)
+                response = client.get("/api/shipments/SHIP-1/excursions", headers=headers(manufacturer, "manufacturer"))
+        finally:
+                writer.stop()
+        assert response.status_code == 200
+        assert response.json()["readings"] == 4
+
+def test_listing_is_paged_by_default(conn, client, manufacturer):
+        from shipments import DEFAULT_PAGE_SIZE
+
+        for i in range(DEFAULT_PAGE_SIZE + 1):
+                add_shipment(conn, f"SHIP-{i}", manufacturer)
+        response = client.get("/api/excursions", headers=headers(manufacturer, "manufacturer"))
+        assert len(response.json()) == DEFAULT_PAGE_SIZE
+        assert response.headers["X-Next-Cursor"]
+
+def test_listing_only_the_requested_shipments(conn, client, manufacturer, recipient):
+        for i in range(3):
+                add_shipment(conn, f"SHIP-{i}", manufacturer)
+        add_shipment(conn, "OTHER", recipient)
+        response = client.get("/api/excursions?shipment_code=SHIP-0&shipment_code=SHIP-2&shipment_code=OTHER",
+                              headers=headers(manufacturer, "manufacturer"))
+        assert sorted(summary["shipment_code"] for summary in response.json()) == ["SHIP-0", "SHIP-2"]
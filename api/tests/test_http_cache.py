@@ -0,0 +1,36 @@
+from conftest import add_shipment, add_user, headers
+
+def test_unchanged_listing_is_not_modified(conn, client, manufacturer):
+        add_shipment(conn, "SHIP-1", manufacturer)
+        auth = headers(manufacturer, "manufacturer")
+        first = client.get("/api/shipments", headers=auth)
+        etag = first.headers["ETag"]
+        assert etag.startswith('W/"')
+
+        response = client.get("/api/shipments", headers={**auth, "If-None-Match": etag})
+        assert response.status_code == 304 and response.content == b""
+
+        body = {"shipping_date": "2026-02-01", "recipient_name": "receiver", "recipient_address": "Address",
+                "recipient_phone": "0800", "items": [{"product_code": "PROD-SHIP-1", "quantity": 1}]}
+        assert client.post("/api/shipments", json=body, headers=auth).status_code == 200
+        response = client.get("/api/shipments", headers={**auth, "If-None-Match": etag})
+        assert response.status_code == 200 and len(response.json()) == 2
+        assert response.headers["ETag"] != etag
+
+def test_etag_does_not_bypass_ownership(conn, client, manufacturer):
+        other = add_user(conn, "other", "manufacturer")
+        add_shipment(conn, "SHIP-1", manufacturer)
+        add_shipment(conn, "SHIP-2", other)
+        auth = headers(manufacturer, "manufacturer")
+        etag = client.get("/api/shipments/SHIP-1", headers=auth).headers["ETag"]
+
+        assert client.get("/api/shipments/SHIP-1", headers={**auth, "If-None-Match": etag}).status_code == 304
+        # The ETag is built from the user's counters, so it matches for any shipment
+        assert client.get("/api/shipments/SHIP-2", headers={**auth, "If-None-Match": etag}).status_code == 403
+        assert client.get("/api/shipments/MISSING", headers={**auth, "If-None-Match": etag}).status_code == 403
+
+def test_etags_are_per_user(conn, client, manufacturer):
+        other = add_user(conn, "other", "manufacturer")
+        etag = client.get("/api/shipments", headers=headers(manufacturer, "manufacturer")).headers["ETag"]
+        response = client.get("/api/shipments", headers={**headers(other, "manufacturer"), "If-None-Match": etag})
+        assert response.status_code == 200
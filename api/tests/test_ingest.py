@@ -0,0 +1,63 @@
+import threading
+import time
+
+import pytest
+
+from ingest import IngestQueue
+
+def reading(shipment_id: int, seq: int):
+        return (shipment_id, 5.0, 50.0, f"2026-01-01 00:00:{seq:02d}", seq)
+
+def test_unknown_policy_is_rejected():
+        with pytest.raises(ValueError):
+                IngestQueue(policy="drop_all")
+
+def test_drop_newest_keeps_what_was_queued():
+        queue = IngestQueue(maxsize=2, policy="drop_newest")
+        assert queue.put(reading(1, 1)) and queue.put(reading(1, 2))
+        assert not queue.put(reading(1, 3))
+        assert not queue.put_many([reading(2, 1), reading(2, 2)])
+        assert queue.get_batch(10, 0) == [reading(1, 1), reading(1, 2)]
+        assert queue.dropped == 3
+
+def test_drop_oldest_makes_room():
+        queue = IngestQueue(maxsize=2, policy="drop_oldest")
+        for seq in (1, 2, 3):
+                assert queue.put(reading(1, seq))
+        assert queue.get_batch(10, 0) == [reading(1, 2), reading(1, 3)]
+        assert queue.dropped == 1
+
+def test_coalesce_keeps_the_newest_overflow_reading_per_shipment():
+        queue = IngestQueue(maxsize=1, policy="coalesce")
+        queue.put(reading(1, 1))
+        queue.put(reading(2, 1))
+        queue.put(reading(2, 2))
+        queue.put_many([reading(3, 1), reading(3, 3), reading(3, 2)])
+        assert len(queue) == 3
+        # Overflow readings come after everything that was queued before them
+        assert queue.get_batch(10, 0) == [reading(1, 1), reading(2, 2), reading(3, 3)]
+        assert (queue.coalesced, queue.dropped) == (3, 0)
+
+def test_block_waits_for_the_writer():
+        queue = IngestQueue(maxsize=1, policy="block", block_timeout=5.0)
+        queue.put(reading(1, 1))
+        threading.Timer(0.1, queue.get_batch, (10, 0)).start()
+        started = time.monotonic()
+        assert queue.put(reading(1, 2))
+        assert 0.05 < time.monotonic() - started < 5.0
+        assert queue.get_batch(10, 1.0) == [reading(1, 2)]
+
+def test_block_coalesces_after_its_timeout():
+        queue = IngestQueue(maxsize=1, policy="block", block_timeout=0.05)
+        queue.put(reading(1, 1))
+        assert queue.put(reading(2, 1))
+        assert queue.get_batch(10, 0) == [reading(1, 1), reading(2, 1)]
+        assert queue.dropped == 0
+
+def test_backlog_is_never_split_across_batches():
+        queue = IngestQueue()
+        queue.put(reading(1, 1))
+        queue.put_many([reading(2, seq) for seq in range(1, 5)])
+        queue.put(reading(3, 1))
+        assert len(queue.get_batch(2, 0)) == 5
+        assert queue.get_batch(2, 0) == [reading(3, 1)]
@@ -0,0 +1,60 @@
+from datetime import date, datetime
+
+import pytest
+from pydantic import ValidationError
+
+from conftest import add_shipment
+from lifecycle import transition_shipments
+from models import BulkShipmentStatusUpdate, ShipmentStatusUpdate
+
+@pytest.fixture
+def shipment(conn):
+        manufacturer_id = conn.execute("""
+                INSERT INTO users (username, email, password, role)
+                VALUES ('maker', 'maker@example.com', 'x', 'manufacturer')
+        """).lastrowid
+        conn.execute("""
+                INSERT INTO shipments (shipment_code, manufacturer_id, recipient_name, recipient_address,
+                recipient_phone, shipping_date)
+                VALUES ('SHIP-1', ?, 'Recipient', 'Address', '0800', '2026-01-01')
+        """, (manufacturer_id,))
+        conn.commit()
+        return manufacturer_id
+
+def delivery_date(conn):
+        return conn.execute("SELECT status, delivery_date FROM shipments WHERE shipment_code = 'SHIP-1'").fetchone()
+
+def test_delivery_date_rejected_unless_delivered():
+        with pytest.raises(ValidationError):
+                ShipmentStatusUpdate(status="shipped", delivery_date=date(2026, 1, 5))
+        with pytest.raises(ValidationError):
+                BulkShipmentStatusUpdate(status="shipped", delivery_date=date(2026, 1, 5), shipment_codes=["SHIP-1"])
+        assert ShipmentStatusUpdate(status="delivered", delivery_date=date(2026, 1, 5)).delivery_date == date(2026, 1, 5)
+
+def test_shipping_ignores_delivery_date(conn, shipment):
+        results, changed = transition_shipments(conn, ["SHIP-1"], "shipped", shipment, "manufacturer", date(2026, 1, 5))
+        assert results[0]["error"] is None and changed
+        assert tuple(delivery_date(conn)) == ("shipped", None)
+
+def test_delivering_sets_delivery_date(conn, shipment):
+        transition_shipments(conn, ["SHIP-1"], "shipped", shipment, "manufacturer")
+        transition_shipments(conn, ["SHIP-1"], "delivered", shipment, "manufacturer", date(2026, 1, 5))
+        assert tuple(delivery_date(conn)) == ("delivered", "2026-01-05")
+
+def test_readings_racing_the_archiver_are_dropped(conn, manufacturer, monkeypatch):
+        from constraints import constraint_cache
+        from ingest import write_batch
+        from lifecycle import archive_delivered
+
+        shipment_id = add_shipment(conn, "SHIP-2", manufacturer)
+        conn.execute("UPDATE shipments SET status = 'delivered', delivery_date = '2026-01-05' WHERE id = ?", (shipment_id,))
+        conn.commit()
+        write_batch(conn, [(shipment_id, 4.0, 50.0, "2026-01-02 10:00:00", None)])
+        # The writer still holds the envelope, as between the archiver's commit and its invalidation
+        monkeypatch.setattr(constraint_cache, "invalidate", lambda shipment_id: None)
+        assert archive_delivered(conn, now=datetime(2026, 3, 1)) == 1
+
+        stored, _, _, _ = write_batch(conn, [(shipment_id, 5.0, 50.0, "2026-01-02 10:01:00", None)])
+        assert stored == []
+        assert conn.execute("SELECT COUNT(*) FROM temperature_logs").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM temperature_logs_archive").fetchone()[0] == 1
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+import mqtt_handler
+
+class Message:
+        def __init__(self, payload, topic=mqtt_handler.DATA_TOPIC):
+                self.payload = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+                self.topic = topic
+
+@pytest.fixture
+def received(monkeypatch):
+        """Readings on_message accepts, instead of caching and queueing them."""
+        readings = []
+        monkeypatch.setattr(mqtt_handler, "accept_readings",
+                            lambda shipment_id, batch: readings.extend((shipment_id, *reading) for reading in batch))
+        return readings
+
+def parse_errors() -> float:
+        return mqtt_handler.mqtt_parse_errors.labels().value
+
+@pytest.mark.parametrize("payload", [
+        {"shipment_id": "1", "temperature": 5.0, "humidity": 50.0},
+        {"shipment_id": 1.0, "temperature": 5.0, "humidity": 50.0},
+        {"shipment_id": True, "temperature": 5.0, "humidity": 50.0},
+        {"shipment_id": 1, "temperature": "hot", "humidity": 50.0},
+        {"shipment_id": 1, "temperature": None, "humidity": 50.0},
+        {"shipment_id": 1, "temperature": 5.0, "humidity": 50.0, "seq": "7"},
+        b'{"shipment_id": 1, "temperature": NaN}',
+        b"not json",
+])
+def test_invalid_readings_are_parse_errors(received, payload):
+        before = parse_errors()
+        mqtt_handler.on_message(None, None, Message(payload))
+        assert received == []
+        assert parse_errors() == before + 1
+
+def test_shipment_id_from_topic(received):
+        mqtt_handler.on_message(None, None, Message({"temperature": 5, "humidity": 50, "seq": 3},
+                                                    f"{mqtt_handler.DATA_TOPIC}/12"))
+        assert [(shipment_id, temperature, seq) for shipment_id, temperature, _, _, seq in received] == [(12, 5.0, 3)]
+        before = parse_errors()
+        mqtt_handler.on_message(None, None, Message({"temperature": 5, "humidity": 50}, f"{mqtt_handler.DATA_TOPIC}/abc"))
+        assert parse_errors() == before + 1
+
+def test_unknown_shipments_are_not_cached_streamed_or_queued(conn, manufacturer, monkeypatch):
+        from conftest import add_shipment
+        from ingest import IngestQueue
+        from readings_cache import latest_readings
+
+        monkeypatch.setattr(mqtt_handler, "ingest_queue", IngestQueue())
+        shipment_id = add_shipment(conn, "SHIP-1", manufacturer)
+        latest_readings.register(shipment_id, "SHIP-1")
+        for forged in range(100, 110):
+                mqtt_handler.accept_readings(forged, [(5.0, 50.0, "2026-01-01 00:00:00", None)])
+        assert len(mqtt_handler.ingest_queue) == 0
+        assert not any(forged in mqtt_handler._last_seen for forged in range(100, 110))
+        assert len(latest_readings) == 1
+
+        mqtt_handler.accept_readings(shipment_id, [(5.0, 50.0, "2026-01-01 00:00:00", None)])
+        assert len(mqtt_handler.ingest_queue) == 1
+        assert shipment_id in mqtt_handler._last_seen
@@ -0,0 +1,85 @@
+import pytest
+
+from conftest import add_shipment, headers, wait_for
+from nfc import BloomFilter, TagAlreadyRegistered, TagIndex, tag_index
+
+def register_elsewhere(conn, tag_id: str):
+        """A tag inserted by another process, behind the index's back."""
+        item_id, product_id = conn.execute("SELECT id, product_id FROM shipment_items").fetchone()
+        conn.execute("INSERT INTO nfc_tags (tag_id, product_id, shipment_item_id) VALUES (?, ?, ?)",
+                     (tag_id, product_id, item_id))
+        conn.commit()
+
+def test_unknown_tags_are_rejected_without_a_query(conn, manufacturer):
+        add_shipment(conn, "SHIP-1", manufacturer)
+        index = TagIndex()
+        index.load(conn)
+        register_elsewhere(conn, "TAG-1")
+
+        statements = []
+        conn.set_trace_callback(statements.append)
+        assert index.verify(conn, ["TAG-1", "TAG-2"]) == {"TAG-1": None, "TAG-2": None}
+        conn.set_trace_callback(None)
+        assert statements == []
+
+        index.sync(conn)
+        assert index.verify(conn, ["TAG-1"]) == {"TAG-1": ("Vaccine", "maker", "SHIP-1")}
+
+def test_background_sync_picks_up_other_processes_tags(conn, manufacturer):
+        add_shipment(conn, "SHIP-1", manufacturer)
+        index = TagIndex()
+        index.load(conn)
+        index.start_sync(0.05)
+        try:
+                register_elsewhere(conn, "TAG-1")
+                wait_for(lambda: index.verify(conn, ["TAG-1"])["TAG-1"] is not None)
+        finally:
+                index.stop_sync()
+
+def test_bloom_filter_has_no_false_negatives():
+        bloom = BloomFilter(1000, 0.01)
+        added = [f"TAG-{i}" for i in range(1000)]
+        for key in added:
+                bloom.add(key)
+        assert all(key in bloom for key in added)
+        false_positives = sum(f"OTHER-{i}" in bloom for i in range(10000))
+        assert false_positives < 300
+
+def test_index_grows_its_filter(conn, manufacturer):
+        add_shipment(conn, "SHIP-1", manufacturer)
+        item_id, product_id = conn.execute("SELECT id, product_id FROM shipment_items").fetchone()
+        index = TagIndex(capacity=4)
+        index.register(conn, item_id, product_id, [f"TAG-{i}" for i in range(10)])
+        assert index.stats()["tags"] == 10
+        found = index.verify(conn, [f"TAG-{i}" for i in range(10)])
+        assert all(details is not None for details in found.values())
+
+def test_register_rejects_existing_tags(conn, manufacturer):
+        add_shipment(conn, "SHIP-1", manufacturer)
+        item_id, product_id = conn.execute("SELECT id, product_id FROM shipment_items").fetchone()
+        tag_index.register(conn, item_id, product_id, ["TAG-1"])
+        with pytest.raises(TagAlreadyRegistered) as raised:
+                tag_index.register(conn, item_id, product_id, ["TAG-2", "TAG-1"])
+        assert raised.value.args[0] == ["TAG-1"]
+        assert conn.execute("SELECT COUNT(*) FROM nfc_tags").fetchone()[0] == 1
+
+def test_batch_verify(conn, client, manufacturer):
+        add_shipment(conn, "SHIP-1", manufacturer)
+        product_id = conn.execute("SELECT product_id FROM shipment_items").fetchone()[0]
+        auth = headers(manufacturer, "manufacturer")
+        response = client.post("/api/shipments/SHIP-1/tags", json={"product_id": product_id, "tag_ids": ["TAG-1", "TAG-2"]},
+                               headers=auth)
+        assert response.json()["registered"] == 2
+
+        response = client.post("/api/verify-nfc/batch", json={"tag_ids": ["TAG-2", "FORGED", "TAG-1", "TAG-2"]}, headers=auth)
+        results = response.json()
+        assert [result["tag_id"] for result in results] == ["TAG-2", "FORGED", "TAG-1", "TAG-2"]
+        assert [result["is_authentic"] for result in results] == [True, False, True, True]
+        assert results[0]["shipment_code"] == "SHIP-1" and results[0]["manufacturer"] == "maker"
+
+def test_batch_verify_is_bounded(conn, client, manufacturer):
+        from nfc import MAX_BATCH_TAGS
+
+        tag_ids = [f"TAG-{i}" for i in range(MAX_BATCH_TAGS + 1)]
+        response = client.post("/api/verify-nfc/batch", json={"tag_ids": tag_ids}, headers=headers(manufacturer, "manufacturer"))
+        assert response.status_code == 413
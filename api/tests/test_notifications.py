@@ -0,0 +1,51 @@
+from conftest import add_shipment, headers
+from notifications import ViolationNotifier, mark_read, unread_count
+
+def notification_ids(conn, user_id: int) -> list:
+        return [row[0] for row in conn.execute("SELECT id FROM notifications WHERE user_id = ? ORDER BY id", (user_id,))]
+
+def test_unread_counter_follows_the_notifications(conn, manufacturer):
+        shipment_id = add_shipment(conn, "SHIP-1", manufacturer)
+        for read in (0, 0, 0, 1):
+                conn.execute("INSERT INTO notifications (user_id, shipment_id, message, read) VALUES (?, ?, 'm', ?)",
+                             (manufacturer, shipment_id, read))
+        conn.commit()
+        first, second, third, already_read = notification_ids(conn, manufacturer)
+        assert unread_count(conn, manufacturer) == 3
+
+        assert mark_read(conn, manufacturer, [first, already_read]) == 1
+        assert unread_count(conn, manufacturer) == 2
+        conn.execute("UPDATE notifications SET read = 0 WHERE id = ?", (first,))
+        conn.execute("DELETE FROM notifications WHERE id IN (?, ?)", (second, already_read))
+        conn.commit()
+        assert unread_count(conn, manufacturer) == 2
+        assert mark_read(conn, manufacturer) == 2
+        assert unread_count(conn, manufacturer) == 0
+
+def test_violations_notify_once_per_window(conn, manufacturer, recipient):
+        shipment_id = add_shipment(conn, "SHIP-1", manufacturer, recipient, max_temperature=8.0)
+        readings = [(shipment_id, 9.0, 50.0, "2026-01-01 10:01:00", 1), (shipment_id, 9.5, 50.0, "2026-01-01 10:02:00", 2)]
+        notifier = ViolationNotifier()
+        assert notifier.notify(conn, readings) == 2
+        assert notifier.notify(conn, readings) == 0
+        # A second process, or a restart, only has the dedup key to go by
+        assert ViolationNotifier().notify(conn, readings) == 0
+        assert unread_count(conn, manufacturer) == unread_count(conn, recipient) == 1
+
+        later = [(shipment_id, 9.0, 50.0, "2026-01-01 10:20:00", 3)]
+        assert ViolationNotifier().notify(conn, later) == 2
+        assert unread_count(conn, recipient) == 2
+
+def test_readings_within_limits_do_not_notify(conn, manufacturer, recipient):
+        shipment_id = add_shipment(conn, "SHIP-1", manufacturer, recipient, max_temperature=8.0)
+        assert ViolationNotifier().notify(conn, [(shipment_id, 7.0, 50.0, "2026-01-01 10:01:00", 1)]) == 0
+
+def test_unread_count_route(conn, client, manufacturer, recipient):
+        add_shipment(conn, "SHIP-1", manufacturer, recipient)
+        auth = headers(recipient, "recipient")
+        assert client.get("/api/notifications/unread-count", headers=auth).json() == {"unread": 0}
+        client.post("/api/notifications", json={"shipment_code": "SHIP-1", "message": "Check the seals"},
+                    headers=headers(manufacturer, "manufacturer"))
+        assert client.get("/api/notifications/unread-count", headers=auth).json() == {"unread": 1}
+        assert client.post("/api/notifications/read", json={}, headers=auth).json() == {"unread": 0}
+        assert client.get("/api/notifications/unread-count", headers=auth).json() == {"unread": 0}
@@ -0,0 +1,52 @@
+import pytest
+
+from conftest import add_shipment, headers
+
+def test_pages_cover_every_shipment_once_newest_first(conn, client, manufacturer):
+        codes = [f"SHIP-{i}" for i in range(5)]
+        for code in codes:
+                add_shipment(conn, code, manufacturer)
+        auth = headers(manufacturer, "manufacturer")
+
+        seen = []
+        response = client.get("/api/shipments?limit=2", headers=auth)
+        while True:
+                assert len(response.json()) <= 2
+                seen += [shipment["shipment_code"] for shipment in response.json()]
+                cursor = response.headers.get("X-Next-Cursor")
+                if not cursor:
+                        break
+                response = client.get(f"/api/shipments?limit=2&cursor={cursor}", headers=auth)
+        # Created in the same second, so the id breaks the tie
+        assert seen == codes[::-1]
+
+@pytest.mark.parametrize("path", ["/api/shipments", "/api/shipments/search", "/api/excursions", "/api/notifications"])
+@pytest.mark.parametrize("cursor", ["not-a-cursor", "WzFd", "bnVsbA"])
+def test_invalid_cursor_is_rejected(conn, client, manufacturer, path, cursor):
+        response = client.get(f"{path}?cursor={cursor}", headers=headers(manufacturer, "manufacturer"))
+        assert response.status_code == 400
+
+def test_bulk_create_stores_the_valid_shipments(conn, client, manufacturer):
+        add_shipment(conn, "SHIP-1", manufacturer)
+
+        def shipment(product_code):
+                return {"shipping_date": "2026-02-01", "recipient_name": "receiver", "recipient_address": "Address",
+                        "recipient_phone": "0800", "items": [{"product_code": product_code, "quantity": 2}]}
+
+        body = [shipment("PROD-SHIP-1"), shipment("UNKNOWN"), shipment("PROD-SHIP-1")]
+        response = client.post("/api/shipments/bulk", json=body, headers=headers(manufacturer, "manufacturer"))
+        assert response.status_code == 200
+        result = response.json()
+        assert (result["created"], result["failed"]) == (2, 1)
+        assert [entry["index"] for entry in result["results"]] == [0, 1, 2]
+        assert result["results"][1] == {"index": 1, "shipment": None, "error": "Product with code UNKNOWN not found"}
+        created = [result["results"][i]["shipment"] for i in (0, 2)]
+        assert all(shipment["items"][0]["quantity"] == 2 for shipment in created)
+        assert conn.execute("SELECT COUNT(*) FROM shipments").fetchone()[0] == 3
+
+def test_bulk_create_without_valid_shipments_stores_nothing(conn, client, manufacturer):
+        body = [{"shipping_date": "2026-02-01", "recipient_name": "receiver", "recipient_address": "Address",
+                 "recipient_phone": "0800", "items": [{"product_code": "UNKNOWN", "quantity": 1}]}]
+        result = client.post("/api/shipments/bulk", json=body, headers=headers(manufacturer, "manufacturer")).json()
+        assert (result["created"], result["failed"]) == (0, 1)
+        assert conn.execute("SELECT COUNT(*) FROM shipments").fetchone()[0] == 0
@@ -0,0 +1,44 @@
+import time
+
+from conftest import add_shipment, headers
+
+def ticket(client, code: str, user_id: int, role: str) -> str:
+        response = client.post(f"/api/stream/temperature/{code}/ticket", headers=headers(user_id, role))
+        assert response.status_code == 200
+        return response.json()["ticket"]
+
+def test_ticket_only_opens_its_own_shipment(conn, client, manufacturer):
+        add_shipment(conn, "SHIP-1", manufacturer)
+        add_shipment(conn, "SHIP-2", manufacturer)
+        issued = ticket(client, "SHIP-1", manufacturer, "manufacturer")
+
+        with client.websocket_connect(f"/api/ws/temperature/SHIP-1?ticket={issued}"):
+                pass
+        response = client.get(f"/api/stream/temperature/SHIP-2?ticket={issued}")
+        assert response.status_code == 401
+
+def test_tickets_are_only_issued_for_own_shipments(conn, client, manufacturer, recipient):
+        add_shipment(conn, "SHIP-1", manufacturer)
+        response = client.post("/api/stream/temperature/SHIP-1/ticket", headers=headers(recipient, "recipient"))
+        assert response.status_code == 403
+
+def test_access_token_is_not_accepted_in_the_url(conn, client, manufacturer):
+        add_shipment(conn, "SHIP-1", manufacturer)
+        token = headers(manufacturer, "manufacturer")["Authorization"][7:]
+        assert client.get(f"/api/stream/temperature/SHIP-1?ticket={token}").status_code == 401
+        assert client.get(f"/api/stream/temperature/SHIP-1?token={token}").status_code == 401
+
+def test_ticket_is_not_an_access_token(conn, client, manufacturer):
+        add_shipment(conn, "SHIP-1", manufacturer)
+        issued = ticket(client, "SHIP-1", manufacturer, "manufacturer")
+        response = client.get("/api/shipments", headers={"Authorization": f"Bearer {issued}"})
+        assert response.status_code == 401
+
+def test_expired_ticket_is_rejected(conn, client, manufacturer, monkeypatch):
+        import auth
+
+        add_shipment(conn, "SHIP-1", manufacturer)
+        monkeypatch.setattr(auth, "STREAM_TICKET_EXPIRE", 1)
+        issued = ticket(client, "SHIP-1", manufacturer, "manufacturer")
+        time.sleep(1.1)
+        assert client.get(f"/api/stream/temperature/SHIP-1?ticket={issued}").status_code == 401
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from telemetry import RAW_RETENTION, append_readings, compact, format_timestamp, fresh_readings
+
+@pytest.fixture
+def shipment_id(conn):
+        manufacturer_id = conn.execute("""
+                INSERT INTO users (username, email, password, role)
+                VALUES ('maker', 'maker@example.com', 'x', 'manufacturer')
+        """).lastrowid
+        shipment_id = conn.execute("""
+                INSERT INTO shipments (shipment_code, manufacturer_id, recipient_name, recipient_address,
+                recipient_phone, shipping_date)
+                VALUES ('SHIP-1', ?, 'Recipient', 'Address', '0800', '2026-01-01')
+        """, (manufacturer_id,)).lastrowid
+        conn.commit()
+        return shipment_id
+
+def test_resent_readings_stay_deduplicated_after_compaction(conn, shipment_id):
+        now = datetime(2026, 3, 1, 12, 0)
+        old = format_timestamp(now - RAW_RETENTION - timedelta(hours=1))
+        recent = format_timestamp(now - timedelta(minutes=5))
+        backlog = [(shipment_id, 5.0, 50.0, old, 1), (shipment_id, 5.0, 50.0, old, 2), (shipment_id, 5.0, 50.0, recent, 3)]
+        append_readings(conn, backlog)
+        conn.commit()
+        assert compact(conn, now) == 2
+
+        assert fresh_readings(conn, backlog) == []
+        # Readings without device time, and newer readings of a reset device, are not resends
+        untimed = (shipment_id, 5.0, 50.0, None, 2)
+        reset = (shipment_id, 5.0, 50.0, format_timestamp(now), 1)
+        assert fresh_readings(conn, [untimed, reset]) == [reset]
+
+def test_resent_readings_are_dropped(conn, shipment_id):
+        from ingest import write_batch
+
+        first = (shipment_id, 5.0, 50.0, "2026-01-01 10:00:00", 1)
+        second = (shipment_id, 5.5, 50.0, "2026-01-01 10:01:00", 2)
+        stored, duplicates, _, _ = write_batch(conn, [first, second, first])
+        assert (len(stored), duplicates) == (2, 1)
+        # A logger resending its whole buffer only adds the new reading
+        third = (shipment_id, 6.0, 50.0, "2026-01-01 10:02:00", 3)
+        stored, duplicates, _, _ = write_batch(conn, [first, second, third])
+        assert (stored, duplicates) == ([third], 2)
+        # Readings without a sequence number are never deduplicated
+        untracked = (shipment_id, 6.0, 50.0, "2026-01-01 10:02:00", None)
+        stored, _, _, _ = write_batch(conn, [untracked, untracked])
+        assert len(stored) == 2
+        assert conn.execute("SELECT COUNT(*) FROM temperature_logs").fetchone()[0] == 5
@@ -0,0 +1,239 @@
+"""
+Running the API as REKSTI_WORKERS processes on one database.
+
+One process at a time ingests: the one holding an exclusive lock on a file
+next to the database. It runs the MQTT subscription, the ingest writer, the
+excursion statistics and the retention worker. The others serve requests and
+only publish to MQTT. Every process keeps trying the lock, so another one
+takes over within ELECTION_INTERVAL when the ingest process exits.
+
+Readings reach the other processes through the database. Their latest reading
+cache expires after FOLLOWER_CACHE_TTL, and a StreamPoller feeds their live
+streams from latest_temperature. ETag counters and token revocations are
+signalled through SharedCounters, a memory mapped file every process maps.
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager, nullcontext
+
+try:
+        import fcntl
+except ImportError:
+        fcntl = None
+
+import database
+from logs import get_logger
+from streaming import StreamHub, stream_hub
+
+logger = get_logger(__name__)
+
+WORKERS = int(os.environ.get("REKSTI_WORKERS", "1"))
+# Seconds between attempts of a serving process to become the ingest process
+ELECTION_INTERVAL = 2.0
+# Latest reading cache TTL of every process, readings are only written by the ingest process
+FOLLOWER_CACHE_TTL = 1.0
+# Seconds between polls of latest_temperature for the shipments streamed by a serving process
+STREAM_POLL_INTERVAL = 1.0
+# Counters in the shared file, keys hash into one of these
+SHARED_SLOTS = 1 << 16
+# Shipment ids bound per IN (...) lookup
+LOOKUP_CHUNK = 500
+
+def state_path(name: str) -> str:
+        """A file the workers share, next to the database."""
+        return f"{database.DATABASE}-{name}"
+
+def multiprocess() -> bool:
+        if WORKERS > 1 and fcntl is None:
+                raise RuntimeError("REKSTI_WORKERS above 1 needs fcntl, which this platform lacks")
+        return WORKERS > 1
+
+@contextmanager
+def exclusive(name: str):
+        """Hold an exclusive lock on the state file `name` against the other processes."""
+        with open(state_path(name), "a+b") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                        yield f
+                finally:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+
+def migration_lock():
+        """Workers starting together apply migrations one at a time."""
+        return exclusive("migrate.lock") if multiprocess() else nullcontext()
+
+class SharedCounters:
+        """
+        Counters in a memory mapped file shared by every worker.
+
+        Keys hash to one of `slots` counters, so unrelated keys may share one,
+        which only makes a reader see a change that was not its own. Increments
+        are serialized with flock; reads take no lock. The header holds the epoch
+        the file was created in, removing the file starts a new one.
+        """
+        HEADER = struct.Struct("<8sQ")
+        COUNTER = struct.Struct("<Q")
+        MAGIC = b"reksti01"
+
+        def __init__(self, path: str, slots: int = SHARED_SLOTS):
+                self.path = path
+                self.slots = slots
+                size = self.HEADER.size + slots * self.COUNTER.size
+                self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+                # flock does not exclude threads sharing the descriptor
+                self._lock = threading.Lock()
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+                try:
+                        if os.fstat(self._fd).st_size != size or os.pread(self._fd, len(self.MAGIC), 0) != self.MAGIC:
+                                os.ftruncate(self._fd, 0)
+                                os.ftruncate(self._fd, size)
+                                os.pwrite(self._fd, self.HEADER.pack(self.MAGIC, time.time_ns() // 1000), 0)
+                        self._map = mmap.mmap(self._fd, size)
+                finally:
+                        fcntl.flock(self._fd, fcntl.LOCK_UN)
+                _, self.epoch = self.HEADER.unpack_from(self._map)
+
+        def _offset(self, key: str) -> int:
+                return self.HEADER.size + zlib.crc32(key.encode("utf-8")) % self.slots * self.COUNTER.size
+
+        def get(self, key: str) -> int:
+                return self.COUNTER.unpack_from(self._map, self._offset(key))[0]
+
+        def increment(self, *keys):
+                offsets = {self._offset(key) for key in keys}
+                with self._lock:
+                        fcntl.flock(self._fd, fcntl.LOCK_EX)
+                        try:
+                                for offset in offsets:
+                                        self.COUNTER.pack_into(self._map, offset, self.COUNTER.unpack_from(self._map, offset)[0] + 1)
+                        finally:
+                                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+        @staticmethod
+        def reset(path: str):
+                """Drop the counters, for a launcher starting a fresh set of workers."""
+                try:
+                        os.remove(path)
+                except FileNotFoundError:
+                        pass
+
+class IngestElection:
+        """Runs `on_elected` once this process holds the ingest lock, trying every `interval` seconds."""
+        def __init__(self, interval: float = ELECTION_INTERVAL):
+                self.interval = interval
+                self.leader = False
+                self._file = None
+                self._stop = threading.Event()
+                self._thread = None
+
+        def _try(self, on_elected) -> bool:
+                f = open(state_path("ingest.lock"), "a+b")
+                try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                        f.close()
+                        return False
+                self._file = f
+                self.leader = True
+                logger.info("Process %d is now the ingest process", os.getpid())
+                on_elected()
+                return True
+
+        def _run(self, on_elected):
+                while not self._stop.wait(self.interval):
+                        try:
+                                if self._try(on_elected):
+                                        return
+                        except Exception:
+                                logger.exception("Taking over ingest failed")
+
+        def start(self, on_elected):
+                self._stop.clear()
+                if self._try(on_elected):
+                        return
+                self._thread = threading.Thread(target=self._run, args=(on_elected,), name="ingest-election", daemon=True)
+                self._thread.start()
+
+        def stop(self):
+                """Stop trying and release the lock, call once ingest has stopped."""
+                self._stop.set()
+                if self._file is not None:
+                        self._file.close()
+                        self._file = None
+                self.leader = False
+
+class StreamPoller:
+        """
+        Feeds the live streams of a process that does not ingest. New readings and
+        newly flagged violations of streamed shipments are read from
+        latest_temperature every `interval` seconds.
+        """
+        def __init__(self, hub: StreamHub, interval: float = STREAM_POLL_INTERVAL):
+                self.hub = hub
+                self.interval = interval
+                # shipment id to (timestamp, violated) as last published
+                self._seen = {}
+                self._stop = threading.Event()
+                self._thread = None
+                self.polls = 0
+
+        def poll(self, conn):
+                shipment_ids = self.hub.shipment_ids()
+                self._seen = {shipment_id: seen for shipment_id, seen in self._seen.items() if shipment_id in shipment_ids}
+                for start in range(0, len(shipment_ids), LOOKUP_CHUNK):
+                        chunk = shipment_ids[start:start + LOOKUP_CHUNK]
+                        for row in conn.execute(f"""
+                                SELECT s.id, s.constraints_violated, lt.temperature, lt.humidity, lt.timestamp
+                                FROM shipments s
+                                LEFT JOIN latest_temperature lt ON lt.shipment_id = s.id
+                                WHERE s.id IN ({','.join('?' * len(chunk))})
+                        """, chunk):
+                                shipment_id, violated, temperature, humidity, timestamp = row
+                                previous = self._seen.get(shipment_id)
+                                self._seen[shipment_id] = (timestamp, bool(violated))
+                                # The stream opened with the state of its first poll
+                                if previous is None or timestamp is None:
+                                        continue
+                                if violated and not previous[1]:
+                                        self.hub.publish_violation(shipment_id, temperature, humidity, timestamp)
+                                if timestamp != previous[0]:
+                                        self.hub.publish_reading(shipment_id, temperature, humidity, timestamp)
+                self.polls += 1
+
+        def _run(self):
+                while not self._stop.wait(self.interval):
+                        if not self.hub.subscriber_count():
+                                continue
+                        conn = database.get_db()
+                        try:
+                                self.poll(conn)
+                        except Exception:
+                                logger.exception("Polling streamed shipments failed")
+                        finally:
+                                conn.close()
+
+        def start(self):
+                if self._thread is not None and self._thread.is_alive():
+                        return
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="stream-poller", daemon=True)
+                self._thread.start()
+
+        def stop(self):
+                self._stop.set()
+                self._thread = None
+
+election = IngestElection()
+stream_poller = StreamPoller(stream_hub)
+
+def stats() -> dict:
+        return {
+                "workers": WORKERS,
+                "pid": os.getpid(),
+                "ingest": election.leader or not multiprocess(),
+                "stream_polls": stream_poller.polls
+        }
@@ -114,23 +114,10 @@ class _HistoriPesananPageState extends State<HistoriPesananPage> {
       // This is where you'd call your actual _logicService.getOrder()
       // The response should be List<dynamic> as per your JSON.
 
-      // Simulating what your _logicService.getOrder() might do,
-      // including the JSON structure and a slight delay.
-
-      List<dynamic> rawShipmentData = await _logicService.getOrder();
-
-      // Filter mock data by the selected date (for simulation purposes)
-      // In a real scenario, your API would handle this filtering.
-      final String formattedSelectedDate = DateFormat(
-        'yyyy-MM-dd',
-      ).format(date);
-      rawShipmentData =
-          rawShipmentData
-              .where(
-                (shipment) =>
-                    shipment['shipping_date'] == formattedSelectedDate,
-              )
-              .toList();
+      // The API only returns the orders shipped on the selected date
+      final List<dynamic> rawShipmentData = await _logicService.getOrder(
+        date: DateFormat('yyyy-MM-dd').format(date),
+      );
 
       if (!mounted) return;
 
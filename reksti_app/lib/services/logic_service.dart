@@ -10,9 +10,17 @@ class LogicService {
   final TokenStorageService tokenStorage = TokenStorageService();
   // This is your postData function, now as a method of AuthService
 
-  Future<dynamic> getOrder() async {
+  Future<dynamic> getOrder({String? date, int? limit, String? cursor}) async {
     // Renamed for clarity
-    final url = Uri.parse('http://103.59.160.119:3240/api/orders');
+    // Pass limit (and the X-Next-Cursor of the previous page) to fetch one page
+    // Pass date (yyyy-MM-dd) to only fetch the orders shipped that day
+    final path = date != null ? '/api/orders/$date' : '/api/orders';
+    final url = Uri.parse('http://103.59.160.119:3240$path').replace(
+      queryParameters: {
+        if (limit != null) 'limit': '$limit',
+        if (cursor != null) 'cursor': cursor,
+      },
+    );
 
     String? token = await tokenStorage.getAccessToken();
     String? tokenType = await tokenStorage.getTokenType();
@@ -4,41 +4,65 @@ import { useState, useEffect } from 'react';
 import { UserCircleIcon } from '@heroicons/react/24/outline';
 import { useAuth } from '@/contexts/AuthContext';
 import ShipmentDetail from '@/components/ShipmentDetail';
-import { Shipment } from '@/types';
-import { getShipments } from '@/lib/api';
+import { ExcursionSummary, Shipment, ShipmentFilters, ShipmentSummary } from '@/types';
+import { getExcursions, getShipmentSummary, searchShipments } from '@/lib/api';
 
-function isShipped(shippingDate: string): boolean {
-  const shipmentDate = new Date(shippingDate);
-  const currentDate = new Date();
-  // Reset time portion for date comparison
-  shipmentDate.setHours(0, 0, 0, 0);
-  currentDate.setHours(0, 0, 0, 0);
-  return shipmentDate < currentDate; // Changed from <= to <
+const PAGE_SIZE = 50;
+
+// Reported with the status the page has always shown for past shipping dates
+const asShipped = (shipment: Shipment): Shipment => ({ ...shipment, status: 'Shipped' });
+
+// Shipments whose shipping date has passed, filtered by the API
+function shippedFilters(): ShipmentFilters {
+  const yesterday = new Date();
+  yesterday.setDate(yesterday.getDate() - 1);
+  const month = String(yesterday.getMonth() + 1).padStart(2, '0');
+  const day = String(yesterday.getDate()).padStart(2, '0');
+  return { shipped_to: `${yesterday.getFullYear()}-${month}-${day}` };
 }
 
 export default function Reports() {
   const [shipments, setShipments] = useState<Shipment[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [summary, setSummary] = useState<ShipmentSummary | null>(null);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState('');
   const [selectedShipment, setSelectedShipment] = useState<Shipment | null>(null);
+  const [excursions, setExcursions] = useState<Record<string, ExcursionSummary>>({});
   const { username } = useAuth();
 
   useEffect(() => {
     fetchShipments();
   }, []);
 
-  const fetchShipments = async () => {
+  // Excursion statistics are kept up to date by the API as readings arrive, fetched for the shown page only
+  const fetchExcursions = async (page: Shipment[]) => {
+    if (page.length === 0) return;
+    const summaries = await getExcursions(page.length, undefined, page.map((shipment) => shipment.shipment_code));
+    setExcursions((current) => ({
+      ...current,
+      ...Object.fromEntries(summaries.map((summary: ExcursionSummary) => [summary.shipment_code, summary]))
+    }));
+  };
+
+  const fetchShipments = async (cursor?: string) => {
     try {
-      const data = await getShipments();
-      // Filter shipments based on shipping date
-      const shippedShipments = data.filter((shipment: Shipment) => 
-        isShipped(shipment.shipping_date)
-      ).map((shipment: Shipment) => ({
-        ...shipment,
-        // Override status based on date
-        status: 'Shipped'
-      }));
-      setShipments(shippedShipments);
+      const filters = shippedFilters();
+      if (cursor) {
+        const page = await searchShipments(filters, PAGE_SIZE, cursor);
+        setShipments((current) => [...current, ...page.shipments.map(asShipped)]);
+        setNextCursor(page.nextCursor);
+        await fetchExcursions(page.shipments);
+        return;
+      }
+      const [page, counts] = await Promise.all([
+        searchShipments(filters, PAGE_SIZE),
+        getShipmentSummary(filters)
+      ]);
+      setShipments(page.shipments.map(asShipped));
+      setNextCursor(page.nextCursor);
+      setSummary(counts);
+      await fetchExcursions(page.shipments);
     } catch (err) {
       setError('Failed to load shipment reports');
     } finally {
@@ -69,6 +93,12 @@ export default function Reports() {
           <h2 className="text-lg font-medium text-gray-900">
             Shipped Items Report
           </h2>
+          {summary && (
+            <p className="text-sm text-gray-700 mt-1">
+              {summary.total} shipped, {summary.violated} with constraint violations
+              {' '}({(summary.violation_rate * 100).toFixed(1)}%)
+            </p>
+          )}
         </div>
 
         {loading ? (
@@ -98,6 +128,14 @@ export default function Reports() {
                     <p className="text-sm text-gray-700">
                       Shipped Date: {new Date(shipment.shipping_date).toLocaleDateString()}
                     </p>
+                    {excursions[shipment.shipment_code]?.readings > 0 && (
+                      <p className="text-sm text-gray-500 mt-1">
+                        Out of range: {excursions[shipment.shipment_code].minutes_out_of_range} min
+                        {' '}({excursions[shipment.shipment_code].excursions} excursions),
+                        peak deviation {excursions[shipment.shipment_code].peak_temperature_deviation.toFixed(1)} °C,
+                        MKT {excursions[shipment.shipment_code].mean_kinetic_temperature?.toFixed(1) ?? '-'} °C
+                      </p>
+                    )}
                   </div>
                   <div className="flex flex-col items-end space-y-2">
                     <span className={`
@@ -115,6 +153,14 @@ export default function Reports() {
                 </div>
               </div>
             ))}
+            {nextCursor && (
+              <button
+                onClick={() => fetchShipments(nextCursor)}
+                className="px-4 py-2 text-sm text-purple-600 hover:text-purple-700"
+              >
+                Load more
+              </button>
+            )}
           </div>
         )}
       </div>
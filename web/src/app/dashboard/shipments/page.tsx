@@ -6,7 +6,9 @@ import { useAuth } from '@/contexts/AuthContext';
 import ShipmentDetail from '@/components/ShipmentDetail';
 import ShipmentForm from '@/components/ShipmentForm';
 import { Shipment } from '@/types';
-import { getShipments } from '@/lib/api';
+import { searchShipments } from '@/lib/api';
+
+const PAGE_SIZE = 50;
 
 const getShipmentStatus = (shipment: Shipment) => {
   if (shipment.status === 'Delivered') {
@@ -35,6 +37,8 @@ const getShipmentStatus = (shipment: Shipment) => {
 
 export default function Shipments() {
   const [shipments, setShipments] = useState<Shipment[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [search, setSearch] = useState('');
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState('');
   const [selectedShipment, setSelectedShipment] = useState<Shipment | null>(null);
@@ -45,10 +49,12 @@ export default function Shipments() {
     fetchShipments();
   }, []);
 
-  const fetchShipments = async () => {
+  // Searched and paged by the API, only the shown page is downloaded
+  const fetchShipments = async (cursor?: string) => {
     try {
-      const data = await getShipments();
-      setShipments(data);
+      const page = await searchShipments({ q: search.trim() || undefined }, PAGE_SIZE, cursor);
+      setShipments((current) => cursor ? [...current, ...page.shipments] : page.shipments);
+      setNextCursor(page.nextCursor);
     } catch (err) {
       setError('Failed to load shipments');
     } finally {
@@ -85,6 +91,21 @@ export default function Shipments() {
           <h2 className="text-lg font-medium text-gray-900">
             All Shipments
           </h2>
+          <form
+            onSubmit={(e) => {
+              e.preventDefault();
+              fetchShipments();
+            }}
+            className="mt-2"
+          >
+            <input
+              type="search"
+              value={search}
+              onChange={(e) => setSearch(e.target.value)}
+              placeholder="Search recipient, address or notes"
+              className="w-full px-3 py-2 text-sm border border-gray-300 rounded-lg focus:outline-none focus:ring-2 focus:ring-purple-500"
+            />
+          </form>
         </div>
 
         {loading ? (
@@ -138,6 +159,14 @@ export default function Shipments() {
                 </div>
               </div>
             ))}
+            {nextCursor && (
+              <button
+                onClick={() => fetchShipments(nextCursor)}
+                className="px-4 py-2 text-sm text-purple-600 hover:text-purple-700"
+              >
+                Load more
+              </button>
+            )}
           </div>
         )}
       </div>
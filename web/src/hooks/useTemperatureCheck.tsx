@@ -1,5 +1,5 @@
 import { useState, useEffect } from 'react';
-import { getAuthHeader } from '@/lib/api';
+import { getAuthHeader, getStreamTicket } from '@/lib/api';
 import { API_BASE_URL } from '@/lib/api';
 
 interface TemperatureData {
@@ -9,6 +9,7 @@ interface TemperatureData {
   shipment_code: string;
 }
 
+// Streams readings over Server-Sent Events, falling back to polling every `interval` ms
 export function useTemperatureCheck(shipmentCode: string | undefined, interval = 5000) {
   const [data, setData] = useState<TemperatureData | null>(null);
   const [error, setError] = useState<string | null>(null);
@@ -19,13 +20,17 @@ export function useTemperatureCheck(shipmentCode: string | undefined, interval =
       return;
     }
 
+    let timer: ReturnType<typeof setInterval> | undefined;
+    let source: EventSource | undefined;
+    let cancelled = false;
+
     const checkTemperature = async () => {
       try {
         const headers = await getAuthHeader();
         const response = await fetch(`${API_BASE_URL}/temperature/${shipmentCode}`, {
           headers
         });
-        
+
         if (!response.ok) {
           throw new Error('Failed to fetch temperature data');
         }
@@ -39,10 +44,44 @@ export function useTemperatureCheck(shipmentCode: string | undefined, interval =
       }
     };
 
-    checkTemperature();
-    const timer = setInterval(checkTemperature, interval);
-    return () => clearInterval(timer);
+    const startPolling = () => {
+      if (timer) return;
+      checkTemperature();
+      timer = setInterval(checkTemperature, interval);
+    };
+
+    const startStream = async () => {
+      const ticket = await getStreamTicket(shipmentCode);
+      if (cancelled) return;
+      source = new EventSource(
+        `${API_BASE_URL}/stream/temperature/${shipmentCode}?ticket=${encodeURIComponent(ticket)}`
+      );
+      const onMessage = (event: MessageEvent) => {
+        setData(JSON.parse(event.data));
+        setError(null);
+      };
+      source.addEventListener('reading', onMessage);
+      source.addEventListener('violation', onMessage);
+      source.onerror = () => {
+        source?.close();
+        startPolling();
+      };
+    };
+
+    if (typeof EventSource !== 'undefined') {
+      startStream().catch(() => {
+        if (!cancelled) startPolling();
+      });
+    } else {
+      startPolling();
+    }
+
+    return () => {
+      cancelled = true;
+      source?.close();
+      if (timer) clearInterval(timer);
+    };
   }, [shipmentCode, interval]);
 
   return { data, error };
-}
\ No newline at end of file
+}
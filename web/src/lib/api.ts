@@ -1,4 +1,4 @@
-import { CreateProductData, CreateShipmentData } from "@/types";
+import { CreateProductData, CreateShipmentData, ShipmentFilters } from "@/types";
 
 interface RegisterData {
   username: string;
@@ -118,10 +118,14 @@ export async function createProduct(productData: any) {
 }
 
 
-export async function getShipments() {
+export async function getShipments(limit?: number, cursor?: string) {
   try {
     const headers = await getAuthHeader();
-    const response = await fetch(`${API_BASE_URL}/shipments`, {
+    const params = new URLSearchParams();
+    if (limit) params.set('limit', String(limit));
+    if (cursor) params.set('cursor', cursor);
+    const query = params.toString() ? `?${params}` : '';
+    const response = await fetch(`${API_BASE_URL}/shipments${query}`, {
       headers
     });
     if (!response.ok) throw new Error('Failed to fetch shipments');
@@ -132,6 +136,53 @@ export async function getShipments() {
   }
 }
 
+function filterParams(filters: ShipmentFilters) {
+  const params = new URLSearchParams();
+  filters.status?.forEach((status) => params.append('status', status));
+  if (filters.shipped_from) params.set('shipped_from', filters.shipped_from);
+  if (filters.shipped_to) params.set('shipped_to', filters.shipped_to);
+  if (filters.violated !== undefined) params.set('violated', String(filters.violated));
+  if (filters.product_code) params.set('product_code', filters.product_code);
+  if (filters.recipient) params.set('recipient', filters.recipient);
+  if (filters.q) params.set('q', filters.q);
+  return params;
+}
+
+// One page of the shipments matching the filters, and the cursor of the next page if there is one
+export async function searchShipments(filters: ShipmentFilters = {}, limit?: number, cursor?: string) {
+  try {
+    const headers = await getAuthHeader();
+    const params = filterParams(filters);
+    if (limit) params.set('limit', String(limit));
+    if (cursor) params.set('cursor', cursor);
+    const response = await fetch(`${API_BASE_URL}/shipments/search?${params}`, {
+      headers
+    });
+    if (!response.ok) throw new Error('Failed to search shipments');
+    return {
+      shipments: await response.json(),
+      nextCursor: response.headers.get('X-Next-Cursor')
+    };
+  } catch (error) {
+    console.error('Error searching shipments:', error);
+    throw error;
+  }
+}
+
+export async function getShipmentSummary(filters: ShipmentFilters = {}) {
+  try {
+    const headers = await getAuthHeader();
+    const response = await fetch(`${API_BASE_URL}/shipments/summary?${filterParams(filters)}`, {
+      headers
+    });
+    if (!response.ok) throw new Error('Failed to fetch shipment summary');
+    return response.json();
+  } catch (error) {
+    console.error('Error fetching shipment summary:', error);
+    throw error;
+  }
+}
+
 export async function createShipment(shipmentData: CreateShipmentData) {
   const headers = await getAuthHeader();
   const response = await fetch(`${API_BASE_URL}/shipments`, {
@@ -160,4 +211,35 @@ export async function getRecentShipments() {
     console.error('Error fetching recent shipments:', error);
     throw error;
   }
-}
\ No newline at end of file
+}
+
+// A short lived ticket for opening the live temperature stream, which cannot carry headers
+export async function getStreamTicket(shipmentCode: string): Promise<string> {
+  const headers = await getAuthHeader();
+  const response = await fetch(`${API_BASE_URL}/stream/temperature/${shipmentCode}/ticket`, {
+    method: 'POST',
+    headers
+  });
+  if (!response.ok) throw new Error('Failed to get a stream ticket');
+  const data = await response.json();
+  return data.ticket;
+}
+
+export async function getExcursions(limit?: number, cursor?: string, shipmentCodes: string[] = []) {
+  try {
+    const headers = await getAuthHeader();
+    const params = new URLSearchParams();
+    if (limit) params.set('limit', String(limit));
+    if (cursor) params.set('cursor', cursor);
+    shipmentCodes.forEach((code) => params.append('shipment_code', code));
+    const query = params.toString() ? `?${params}` : '';
+    const response = await fetch(`${API_BASE_URL}/excursions${query}`, {
+      headers
+    });
+    if (!response.ok) throw new Error('Failed to fetch excursions');
+    return response.json();
+  } catch (error) {
+    console.error('Error fetching excursions:', error);
+    throw error;
+  }
+}
@@ -56,4 +56,45 @@ export interface CreateProductData {
   min_temperature: number;
   max_humidity: number;
   min_humidity: number;
-}
\ No newline at end of file
+}
+
+export interface ExcursionSummary {
+  shipment_code: string;
+  status: string;
+  constraints_violated: boolean;
+  readings: number;
+  first_reading_at: string | null;
+  last_reading_at: string | null;
+  minutes_out_of_range: number;
+  excursions: number;
+  out_of_range: boolean;
+  peak_temperature_deviation: number;
+  peak_humidity_deviation: number;
+  min_temperature: number | null;
+  max_temperature: number | null;
+  mean_kinetic_temperature: number | null;
+}
+
+export interface ShipmentFilters {
+  status?: string[];
+  shipped_from?: string;
+  shipped_to?: string;
+  violated?: boolean;
+  product_code?: string;
+  recipient?: string;
+  q?: string;
+}
+
+export interface DailyShipments {
+  date: string;
+  shipments: number;
+  violated: number;
+}
+
+export interface ShipmentSummary {
+  total: number;
+  violated: number;
+  violation_rate: number;
+  by_status: Record<string, number>;
+  by_day: DailyShipments[];
+}